@@ -19,6 +19,13 @@
 
 #include <Python.h>
 #include <stdint.h>
+#include <limits.h>
+#ifdef HAVE_ZLIB
+#include <zlib.h>
+#endif
+
+#define OFS_DELTA 6
+#define REF_DELTA 7
 
 static int py_is_sha(PyObject *sha)
 {
@@ -181,6 +188,251 @@ static PyObject *py_apply_delta(PyObject *self, PyObject *args)
 	return ret_list;
 }
 
+/* Size of the blocks of the base buffer that are indexed by create_delta. */
+#define DELTA_BLOCK_SIZE 16
+/* Largest copy and insert that fit in a single delta instruction. */
+#define DELTA_MAX_COPY_SIZE 0x10000
+#define DELTA_MAX_INSERT_SIZE 0x7f
+/* Maximum number of candidates considered per hash bucket. */
+#define DELTA_HASH_LIMIT 64
+#define DELTA_HASH_MULTIPLIER 0x01000193U
+
+struct delta_index_entry {
+	uint32_t hash;
+	size_t offset;
+	Py_ssize_t next;
+};
+
+struct delta_buffer {
+	uint8_t *data;
+	size_t len;
+	size_t alloc;
+};
+
+static int delta_buffer_reserve(struct delta_buffer *buf, size_t extra)
+{
+	uint8_t *data;
+	size_t alloc;
+	if (buf->len + extra <= buf->alloc)
+		return 0;
+	alloc = buf->alloc * 2;
+	if (alloc < buf->len + extra)
+		alloc = buf->len + extra;
+	data = realloc(buf->data, alloc);
+	if (data == NULL)
+		return -1;
+	buf->data = data;
+	buf->alloc = alloc;
+	return 0;
+}
+
+static int delta_put_size(struct delta_buffer *buf, size_t size)
+{
+	if (delta_buffer_reserve(buf, 10) < 0)
+		return -1;
+	while (size >= 0x80) {
+		buf->data[buf->len++] = (size & 0x7f) | 0x80;
+		size >>= 7;
+	}
+	buf->data[buf->len++] = size;
+	return 0;
+}
+
+static int delta_put_insert(struct delta_buffer *buf, const uint8_t *data,
+							size_t len)
+{
+	while (len > 0) {
+		size_t n = len < DELTA_MAX_INSERT_SIZE ? len : DELTA_MAX_INSERT_SIZE;
+		if (delta_buffer_reserve(buf, n + 1) < 0)
+			return -1;
+		buf->data[buf->len++] = n;
+		memcpy(buf->data + buf->len, data, n);
+		buf->len += n;
+		data += n;
+		len -= n;
+	}
+	return 0;
+}
+
+static int delta_put_copy(struct delta_buffer *buf, size_t offset, size_t len)
+{
+	while (len > 0) {
+		size_t n = len < DELTA_MAX_COPY_SIZE ? len : DELTA_MAX_COPY_SIZE;
+		size_t op_index;
+		uint8_t op = 0x80;
+		int i;
+		if (delta_buffer_reserve(buf, 8) < 0)
+			return -1;
+		op_index = buf->len++;
+		for (i = 0; i < 4; i++) {
+			if ((offset >> (i * 8)) & 0xff) {
+				buf->data[buf->len++] = (offset >> (i * 8)) & 0xff;
+				op |= 1 << i;
+			}
+		}
+		for (i = 0; i < 3; i++) {
+			if ((n >> (i * 8)) & 0xff) {
+				buf->data[buf->len++] = (n >> (i * 8)) & 0xff;
+				op |= 1 << (4 + i);
+			}
+		}
+		buf->data[op_index] = op;
+		offset += n;
+		len -= n;
+	}
+	return 0;
+}
+
+static uint32_t delta_block_hash(const uint8_t *data)
+{
+	uint32_t hash = 0;
+	int i;
+	for (i = 0; i < DELTA_BLOCK_SIZE; i++)
+		hash = hash * DELTA_HASH_MULTIPLIER + data[i];
+	return hash;
+}
+
+/*
+ * Create a delta from base to target.
+ *
+ * The aligned blocks of the base are stored in a hash table, keyed by a
+ * Rabin-Karp style hash of their contents. The target is then scanned with a
+ * rolling version of the same hash, and each candidate match is verified and
+ * extended in both directions. The longest match found becomes a copy
+ * instruction; unmatched data is inserted literally.
+ */
+static int create_delta(const uint8_t *base, size_t base_len,
+						const uint8_t *target, size_t target_len,
+						struct delta_buffer *out)
+{
+	size_t num_blocks = base_len / DELTA_BLOCK_SIZE;
+	size_t table_size = 16, mask, i;
+	Py_ssize_t *table = NULL;
+	struct delta_index_entry *entries = NULL;
+	uint32_t hash = 0, top_factor = 1;
+	size_t pos = 0, insert_start = 0;
+	int ret = -1;
+
+	if (delta_put_size(out, base_len) < 0 ||
+		delta_put_size(out, target_len) < 0)
+		return -1;
+
+	while (table_size < num_blocks)
+		table_size <<= 1;
+	mask = table_size - 1;
+	table = malloc(table_size * sizeof(Py_ssize_t));
+	entries = malloc((num_blocks ? num_blocks : 1) *
+					 sizeof(struct delta_index_entry));
+	if (table == NULL || entries == NULL)
+		goto out;
+	for (i = 0; i < table_size; i++)
+		table[i] = -1;
+	/* Insert backwards, so chains start with the earliest occurrence. */
+	for (i = num_blocks; i > 0; i--) {
+		struct delta_index_entry *entry = &entries[i - 1];
+		entry->offset = (i - 1) * DELTA_BLOCK_SIZE;
+		entry->hash = delta_block_hash(base + entry->offset);
+		entry->next = table[entry->hash & mask];
+		table[entry->hash & mask] = i - 1;
+	}
+
+	for (i = 1; i < DELTA_BLOCK_SIZE; i++)
+		top_factor *= DELTA_HASH_MULTIPLIER;
+
+	if (target_len >= DELTA_BLOCK_SIZE)
+		hash = delta_block_hash(target);
+	while (pos + DELTA_BLOCK_SIZE <= target_len) {
+		size_t best_len = 0, best_offset = 0;
+		Py_ssize_t e;
+		int n = 0;
+		for (e = table[hash & mask]; e >= 0 && n < DELTA_HASH_LIMIT;
+			 e = entries[e].next, n++) {
+			size_t offset = entries[e].offset, len, max_len;
+			if (entries[e].hash != hash)
+				continue;
+			if (memcmp(base + offset, target + pos, DELTA_BLOCK_SIZE))
+				continue;
+			max_len = base_len - offset;
+			if (target_len - pos < max_len)
+				max_len = target_len - pos;
+			len = DELTA_BLOCK_SIZE;
+			while (len < max_len && base[offset + len] == target[pos + len])
+				len++;
+			if (len > best_len) {
+				best_len = len;
+				best_offset = offset;
+			}
+		}
+		if (best_len == 0) {
+			if (pos + DELTA_BLOCK_SIZE < target_len)
+				hash = (hash - target[pos] * top_factor) *
+					DELTA_HASH_MULTIPLIER + target[pos + DELTA_BLOCK_SIZE];
+			pos++;
+			continue;
+		}
+		/* Grow the match backwards into data that would be inserted. */
+		while (pos > insert_start && best_offset > 0 &&
+			   base[best_offset - 1] == target[pos - 1]) {
+			pos--;
+			best_offset--;
+			best_len++;
+		}
+		if (delta_put_insert(out, target + insert_start,
+							 pos - insert_start) < 0 ||
+			delta_put_copy(out, best_offset, best_len) < 0)
+			goto out;
+		pos += best_len;
+		insert_start = pos;
+		if (pos + DELTA_BLOCK_SIZE <= target_len)
+			hash = delta_block_hash(target + pos);
+	}
+	if (delta_put_insert(out, target + insert_start,
+						 target_len - insert_start) < 0)
+		goto out;
+	ret = 0;
+
+out:
+	free(table);
+	free(entries);
+	return ret;
+}
+
+static PyObject *py_create_delta(PyObject *self, PyObject *args)
+{
+	PyObject *py_base_buf, *py_target_buf, *ret;
+	struct delta_buffer out = { NULL, 0, 0 };
+	int result;
+
+	if (!PyArg_ParseTuple(args, "OO", &py_base_buf, &py_target_buf))
+		return NULL;
+
+	py_base_buf = py_chunked_as_string(py_base_buf);
+	if (py_base_buf == NULL)
+		return NULL;
+
+	py_target_buf = py_chunked_as_string(py_target_buf);
+	if (py_target_buf == NULL) {
+		Py_DECREF(py_base_buf);
+		return NULL;
+	}
+
+	result = create_delta(
+		(uint8_t *)PyString_AS_STRING(py_base_buf),
+		PyString_GET_SIZE(py_base_buf),
+		(uint8_t *)PyString_AS_STRING(py_target_buf),
+		PyString_GET_SIZE(py_target_buf), &out);
+	Py_DECREF(py_base_buf);
+	Py_DECREF(py_target_buf);
+	if (result < 0) {
+		free(out.data);
+		return PyErr_NoMemory();
+	}
+
+	ret = PyString_FromStringAndSize((char *)out.data, out.len);
+	free(out.data);
+	return ret;
+}
+
 static PyObject *py_bisect_find_sha(PyObject *self, PyObject *args)
 {
 	PyObject *unpack_name;
@@ -226,18 +478,530 @@ static PyObject *py_bisect_find_sha(PyObject *self, PyObject *args)
 	Py_RETURN_NONE;
 }
 
+#ifdef HAVE_ZLIB
+/* The functions below read objects from packs; they are only built when
+ * zlib is available, and pack.py falls back to Python otherwise. */
+
+static PyObject *zlib_error_cls;
+static PyObject *unpacked_object_cls;
+
+/* Size of the chunks read_zlib_chunks requests from read_some by default. */
+#define ZLIB_BUFSIZE 4096
+
+/* Largest output buffer read_zlib allocates before any data is inflated. */
+#define ZLIB_MAX_INITIAL_SIZE (1 << 20)
+
+static PyObject *crc32_as_py(uLong crc)
+{
+	return PyInt_FromSize_t((size_t)(crc & 0xffffffffUL));
+}
+
+static PyObject *ull_as_py(unsigned PY_LONG_LONG value)
+{
+	if (value <= LONG_MAX)
+		return PyInt_FromLong((long)value);
+	return PyLong_FromUnsignedLongLong(value);
+}
+
+static int crc32_from_py(PyObject *py_crc32, uLong *crc)
+{
+	unsigned long value;
+
+	if (PyLong_Check(py_crc32))
+		value = PyLong_AsUnsignedLongMask(py_crc32);
+	else
+		value = PyInt_AsUnsignedLongMask(py_crc32);
+	if (value == (unsigned long)-1 && PyErr_Occurred())
+		return -1;
+	*crc = value & 0xffffffffUL;
+	return 0;
+}
+
+/* Read a single byte through a read callback. */
+static int read_byte(PyObject *read, uint8_t *byte, int compute_crc32,
+		     uLong *crc)
+{
+	PyObject *data;
+	Py_buffer view;
+
+	data = PyObject_CallFunction(read, "i", 1);
+	if (data == NULL)
+		return -1;
+	if (!PyArg_Parse(data, "s*", &view)) {
+		Py_DECREF(data);
+		return -1;
+	}
+	if (view.len != 1) {
+		PyErr_Format(PyExc_TypeError,
+			"ord() expected a character, but string of length %zd found",
+			view.len);
+		PyBuffer_Release(&view);
+		Py_DECREF(data);
+		return -1;
+	}
+	*byte = ((uint8_t *)view.buf)[0];
+	if (compute_crc32)
+		*crc = crc32(*crc, byte, 1);
+	PyBuffer_Release(&view);
+	Py_DECREF(data);
+	return 0;
+}
+
+static PyObject *py_take_msb_bytes(PyObject *self, PyObject *args,
+				   PyObject *kwargs)
+{
+	PyObject *read, *py_crc32 = Py_None, *ret, *py_byte;
+	uLong crc = 0;
+	int compute_crc32;
+	uint8_t byte;
+	char *kwlist[] = { "read", "crc32", NULL };
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|O", kwlist,
+					 &read, &py_crc32))
+		return NULL;
+
+	compute_crc32 = (py_crc32 != Py_None);
+	if (compute_crc32 && crc32_from_py(py_crc32, &crc) == -1)
+		return NULL;
+
+	ret = PyList_New(0);
+	if (ret == NULL)
+		return NULL;
+	do {
+		if (read_byte(read, &byte, compute_crc32, &crc) == -1)
+			goto error;
+		py_byte = PyInt_FromLong(byte);
+		if (py_byte == NULL)
+			goto error;
+		if (PyList_Append(ret, py_byte) == -1) {
+			Py_DECREF(py_byte);
+			goto error;
+		}
+		Py_DECREF(py_byte);
+	} while (byte & 0x80);
+
+	if (compute_crc32)
+		return Py_BuildValue("(NN)", ret, crc32_as_py(crc));
+	return Py_BuildValue("(NO)", ret, Py_None);
+
+error:
+	Py_DECREF(ret);
+	return NULL;
+}
+
+static void set_zlib_error(z_stream *zst, int status)
+{
+	if (zst->msg != NULL)
+		PyErr_Format(zlib_error_cls,
+			"Error %d while decompressing data: %.200s", status, zst->msg);
+	else
+		PyErr_Format(zlib_error_cls,
+			"Error %d while decompressing data", status);
+}
+
+/* Inflate the zlib stream that read_some returns into unpacked.
+ *
+ * The object is inflated straight into a single string of the size given
+ * by unpacked.decomp_len, which is appended to unpacked.decomp_chunks.
+ * As that size comes from the pack, the string starts out at most
+ * ZLIB_MAX_INITIAL_SIZE bytes long and grows as data is inflated.
+ * The GIL is released while inflating.
+ *
+ * Returns the data read past the end of the stream.
+ */
+static PyObject *read_zlib(PyObject *read_some, PyObject *unpacked,
+			   int include_comp, Py_ssize_t buffer_size)
+{
+	PyObject *py_decomp_len, *py_crc32, *decomp_chunks, *py_chunk;
+	PyObject *comp_chunks = NULL, *decomp = NULL, *add = NULL;
+	PyObject *unused = NULL;
+	Py_ssize_t decomp_len, out_size, out_pos = 0, consumed;
+	Py_buffer view;
+	int compute_crc32, status = Z_OK;
+	uLong crc = 0;
+	z_stream zst;
+	char *out;
+
+	py_decomp_len = PyObject_GetAttrString(unpacked, "decomp_len");
+	if (py_decomp_len == NULL)
+		return NULL;
+	decomp_len = PyNumber_AsSsize_t(py_decomp_len, PyExc_OverflowError);
+	Py_DECREF(py_decomp_len);
+	if (decomp_len == -1 && PyErr_Occurred())
+		return NULL;
+	if (decomp_len < 0) {
+		PyErr_SetString(PyExc_ValueError,
+			"non-negative zlib data stream size expected");
+		return NULL;
+	}
+
+	py_crc32 = PyObject_GetAttrString(unpacked, "crc32");
+	if (py_crc32 == NULL)
+		return NULL;
+	compute_crc32 = (py_crc32 != Py_None);
+	if (compute_crc32 && crc32_from_py(py_crc32, &crc) == -1) {
+		Py_DECREF(py_crc32);
+		return NULL;
+	}
+	Py_DECREF(py_crc32);
+
+	decomp_chunks = PyObject_GetAttrString(unpacked, "decomp_chunks");
+	if (decomp_chunks == NULL)
+		return NULL;
+	if (!PyList_Check(decomp_chunks)) {
+		PyErr_SetString(PyExc_TypeError, "decomp_chunks is not a list");
+		Py_DECREF(decomp_chunks);
+		return NULL;
+	}
+
+	if (include_comp) {
+		comp_chunks = PyList_New(0);
+		if (comp_chunks == NULL) {
+			Py_DECREF(decomp_chunks);
+			return NULL;
+		}
+	}
+
+	/* One spare byte to notice streams that are longer than announced. */
+	out_size = decomp_len < ZLIB_MAX_INITIAL_SIZE ?
+		decomp_len + 1 : ZLIB_MAX_INITIAL_SIZE;
+	decomp = PyString_FromStringAndSize(NULL, out_size);
+	if (decomp == NULL)
+		goto error;
+	out = PyString_AS_STRING(decomp);
+
+	memset(&zst, 0, sizeof(zst));
+	status = inflateInit(&zst);
+	if (status != Z_OK) {
+		set_zlib_error(&zst, status);
+		goto error;
+	}
+
+	while (status != Z_STREAM_END) {
+		add = PyObject_CallFunction(read_some, "n", buffer_size);
+		if (add == NULL)
+			goto error_inflate;
+		if (!PyArg_Parse(add, "s*", &view))
+			goto error_inflate;
+		if (view.len == 0) {
+			PyBuffer_Release(&view);
+			PyErr_SetString(zlib_error_cls,
+				"EOF before end of zlib stream");
+			goto error_inflate;
+		}
+
+		zst.next_in = (Bytef *)view.buf;
+		zst.avail_in = (uInt)view.len;
+		for (;;) {
+			Py_BEGIN_ALLOW_THREADS
+			do {
+				Py_ssize_t left = out_size - out_pos;
+				zst.next_out = (Bytef *)(out + out_pos);
+				zst.avail_out = left > UINT_MAX ?
+					UINT_MAX : (uInt)left;
+				status = inflate(&zst, Z_NO_FLUSH);
+				out_pos = (char *)zst.next_out - out;
+			} while (status == Z_OK && zst.avail_in > 0 &&
+				 out_pos < out_size);
+			Py_END_ALLOW_THREADS
+
+			if (status != Z_OK && status != Z_STREAM_END &&
+			    status != Z_BUF_ERROR) {
+				PyBuffer_Release(&view);
+				set_zlib_error(&zst, status);
+				goto error_inflate;
+			}
+			if (status == Z_STREAM_END || out_pos < out_size)
+				break;
+			if (out_size > decomp_len) {
+				PyBuffer_Release(&view);
+				PyErr_SetString(zlib_error_cls,
+					"decompressed data does not match expected size");
+				goto error_inflate;
+			}
+			/* The output is full but more was announced. */
+			out_size = out_size > decomp_len / 2 ?
+				decomp_len + 1 : out_size * 2;
+			if (_PyString_Resize(&decomp, out_size) == -1) {
+				PyBuffer_Release(&view);
+				goto error_inflate;
+			}
+			out = PyString_AS_STRING(decomp);
+		}
+		consumed = view.len - zst.avail_in;
+		if (compute_crc32) {
+			Py_BEGIN_ALLOW_THREADS
+			crc = crc32(crc, (Bytef *)view.buf, (uInt)consumed);
+			Py_END_ALLOW_THREADS
+		}
+		if (include_comp && consumed > 0) {
+			py_chunk = PyString_FromStringAndSize(view.buf, consumed);
+			if (py_chunk == NULL ||
+			    PyList_Append(comp_chunks, py_chunk) == -1) {
+				Py_XDECREF(py_chunk);
+				PyBuffer_Release(&view);
+				goto error_inflate;
+			}
+			Py_DECREF(py_chunk);
+		}
+		if (status == Z_STREAM_END && zst.avail_in > 0) {
+			unused = PyString_FromStringAndSize(
+				(char *)zst.next_in, zst.avail_in);
+			if (unused == NULL) {
+				PyBuffer_Release(&view);
+				goto error_inflate;
+			}
+		}
+		PyBuffer_Release(&view);
+		Py_CLEAR(add);
+	}
+	inflateEnd(&zst);
+
+	/* The stream may end right at the end of a read; the caller expects
+	 * data following it. */
+	while (unused == NULL) {
+		add = PyObject_CallFunction(read_some, "n", buffer_size);
+		if (add == NULL)
+			goto error;
+		if (!PyArg_Parse(add, "s*", &view))
+			goto error;
+		if (view.len == 0) {
+			PyBuffer_Release(&view);
+			PyErr_SetString(zlib_error_cls,
+				"EOF before end of zlib stream");
+			goto error;
+		}
+		unused = PyString_FromStringAndSize(view.buf, view.len);
+		PyBuffer_Release(&view);
+		if (unused == NULL)
+			goto error;
+		Py_CLEAR(add);
+	}
+
+	if (out_pos != decomp_len) {
+		PyErr_SetString(zlib_error_cls,
+			"decompressed data does not match expected size");
+		goto error;
+	}
+	if (_PyString_Resize(&decomp, decomp_len) == -1)
+		goto error;
+	if (PyList_Append(decomp_chunks, decomp) == -1)
+		goto error;
+	Py_CLEAR(decomp);
+
+	if (compute_crc32)
+		py_crc32 = crc32_as_py(crc);
+	else {
+		py_crc32 = Py_None;
+		Py_INCREF(py_crc32);
+	}
+	if (py_crc32 == NULL)
+		goto error;
+	status = PyObject_SetAttrString(unpacked, "crc32", py_crc32);
+	Py_DECREF(py_crc32);
+	if (status == -1)
+		goto error;
+	if (include_comp) {
+		if (PyObject_SetAttrString(unpacked, "comp_chunks",
+					   comp_chunks) == -1)
+			goto error;
+		Py_DECREF(comp_chunks);
+	}
+	Py_DECREF(decomp_chunks);
+	return unused;
+
+error_inflate:
+	inflateEnd(&zst);
+error:
+	Py_XDECREF(add);
+	Py_XDECREF(unused);
+	Py_XDECREF(decomp);
+	Py_XDECREF(comp_chunks);
+	Py_DECREF(decomp_chunks);
+	return NULL;
+}
+
+static PyObject *py_read_zlib_chunks(PyObject *self, PyObject *args,
+				     PyObject *kwargs)
+{
+	PyObject *read_some, *unpacked, *py_include_comp = Py_False;
+	Py_ssize_t buffer_size = ZLIB_BUFSIZE;
+	int include_comp;
+	char *kwlist[] = { "read_some", "unpacked", "include_comp",
+			   "buffer_size", NULL };
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|On", kwlist,
+					 &read_some, &unpacked,
+					 &py_include_comp, &buffer_size))
+		return NULL;
+	include_comp = PyObject_IsTrue(py_include_comp);
+	if (include_comp == -1)
+		return NULL;
+	return read_zlib(read_some, unpacked, include_comp, buffer_size);
+}
+
+static PyObject *py_unpack_object(PyObject *self, PyObject *args,
+				  PyObject *kwargs)
+{
+	PyObject *read_all, *read_some = Py_None;
+	PyObject *py_compute_crc32 = Py_False, *py_include_comp = Py_False;
+	PyObject *delta_base = NULL, *py_crc32, *py_size, *unpacked, *unused;
+	Py_ssize_t zlib_bufsize = ZLIB_BUFSIZE;
+	int compute_crc32, include_comp, type_num, shift;
+	unsigned PY_LONG_LONG size, delta_base_offset;
+	uLong crc = 0;
+	uint8_t byte;
+	char *kwlist[] = { "read_all", "read_some", "compute_crc32",
+			   "include_comp", "zlib_bufsize", NULL };
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OOOn", kwlist,
+					 &read_all, &read_some,
+					 &py_compute_crc32, &py_include_comp,
+					 &zlib_bufsize))
+		return NULL;
+	if (read_some == Py_None)
+		read_some = read_all;
+	compute_crc32 = PyObject_IsTrue(py_compute_crc32);
+	if (compute_crc32 == -1)
+		return NULL;
+	include_comp = PyObject_IsTrue(py_include_comp);
+	if (include_comp == -1)
+		return NULL;
+
+	/* Object header: type and size. */
+	if (read_byte(read_all, &byte, compute_crc32, &crc) == -1)
+		return NULL;
+	type_num = (byte >> 4) & 0x07;
+	size = byte & 0x0f;
+	shift = 4;
+	while (byte & 0x80) {
+		if (read_byte(read_all, &byte, compute_crc32, &crc) == -1)
+			return NULL;
+		if (shift > 57) {
+			PyErr_SetString(PyExc_ValueError,
+				"object size in pack header is too large");
+			return NULL;
+		}
+		size += (unsigned PY_LONG_LONG)(byte & 0x7f) << shift;
+		shift += 7;
+	}
+
+	if (type_num == OFS_DELTA) {
+		if (read_byte(read_all, &byte, compute_crc32, &crc) == -1)
+			return NULL;
+		delta_base_offset = byte & 0x7f;
+		while (byte & 0x80) {
+			if (read_byte(read_all, &byte, compute_crc32, &crc) == -1)
+				return NULL;
+			if (delta_base_offset >> 56) {
+				PyErr_SetString(PyExc_ValueError,
+					"delta base offset is too large");
+				return NULL;
+			}
+			delta_base_offset = ((delta_base_offset + 1) << 7) +
+				(byte & 0x7f);
+		}
+		delta_base = ull_as_py(delta_base_offset);
+		if (delta_base == NULL)
+			return NULL;
+	} else if (type_num == REF_DELTA) {
+		Py_buffer view;
+		delta_base = PyObject_CallFunction(read_all, "i", 20);
+		if (delta_base == NULL)
+			return NULL;
+		if (compute_crc32) {
+			if (!PyArg_Parse(delta_base, "s*", &view)) {
+				Py_DECREF(delta_base);
+				return NULL;
+			}
+			crc = crc32(crc, (Bytef *)view.buf, (uInt)view.len);
+			PyBuffer_Release(&view);
+		}
+	} else {
+		delta_base = Py_None;
+		Py_INCREF(delta_base);
+	}
+
+	if (compute_crc32)
+		py_crc32 = crc32_as_py(crc);
+	else {
+		py_crc32 = Py_None;
+		Py_INCREF(py_crc32);
+	}
+	if (py_crc32 == NULL) {
+		Py_DECREF(delta_base);
+		return NULL;
+	}
+	py_size = ull_as_py(size);
+	if (py_size == NULL) {
+		Py_DECREF(delta_base);
+		Py_DECREF(py_crc32);
+		return NULL;
+	}
+
+	unpacked = PyObject_CallFunction(unpacked_object_cls, "iOOO", type_num,
+					 delta_base, py_size, py_crc32);
+	Py_DECREF(delta_base);
+	Py_DECREF(py_size);
+	Py_DECREF(py_crc32);
+	if (unpacked == NULL)
+		return NULL;
+
+	unused = read_zlib(read_some, unpacked, include_comp, zlib_bufsize);
+	if (unused == NULL) {
+		Py_DECREF(unpacked);
+		return NULL;
+	}
+	return Py_BuildValue("(NN)", unpacked, unused);
+}
+#endif /* HAVE_ZLIB */
 
 static PyMethodDef py_pack_methods[] = {
 	{ "apply_delta", (PyCFunction)py_apply_delta, METH_VARARGS, NULL },
 	{ "bisect_find_sha", (PyCFunction)py_bisect_find_sha, METH_VARARGS, NULL },
+	{ "create_delta", (PyCFunction)py_create_delta, METH_VARARGS, NULL },
+#ifdef HAVE_ZLIB
+	{ "take_msb_bytes", (PyCFunction)py_take_msb_bytes,
+	  METH_VARARGS | METH_KEYWORDS, NULL },
+	{ "read_zlib_chunks", (PyCFunction)py_read_zlib_chunks,
+	  METH_VARARGS | METH_KEYWORDS, NULL },
+	{ "unpack_object", (PyCFunction)py_unpack_object,
+	  METH_VARARGS | METH_KEYWORDS, NULL },
+#endif
 	{ NULL, NULL, 0, NULL }
 };
 
 void init_pack(void)
 {
 	PyObject *m;
+#ifdef HAVE_ZLIB
+	PyObject *zlib_mod, *pack_mod;
+#endif
 
 	m = Py_InitModule3("_pack", py_pack_methods, NULL);
 	if (m == NULL)
 		return;
+
+#ifdef HAVE_ZLIB
+
+	zlib_mod = PyImport_ImportModule("zlib");
+	if (zlib_mod == NULL)
+		return;
+
+	zlib_error_cls = PyObject_GetAttrString(zlib_mod, "error");
+	Py_DECREF(zlib_mod);
+	if (zlib_error_cls == NULL)
+		return;
+
+	/* This is a circular import but should be safe since this module is
+	 * imported at the very bottom of pack.py. */
+	pack_mod = PyImport_ImportModule("dulwich.pack");
+	if (pack_mod == NULL)
+		return;
+
+	unpacked_object_cls = PyObject_GetAttrString(pack_mod, "UnpackedObject");
+	Py_DECREF(pack_mod);
+	if (unpacked_object_cls == NULL)
+		return;
+#endif
 }
@@ -176,17 +176,20 @@ class GitClient(object):
             self._fetch_capabilities.remove('thin-pack')
 
     def send_pack(self, path, determine_wants, generate_pack_contents,
-                  progress=None):
+                  progress=None, atomic=False):
         """Upload a pack to a remote repository.
 
         :param path: Repository path
         :param generate_pack_contents: Function that can return a sequence of the
             shas of the objects to upload.
         :param progress: Optional progress function
+        :param atomic: Whether the server should update all refs or none
 
         :raises SendPackError: if server rejects the pack data
         :raises UpdateRefsError: if the server supports report-status
                                  and rejects ref updates
+        :raises SendPackError: if atomic is set and the server does not
+            support atomic updates
         """
         raise NotImplementedError(self.send_pack)
 
@@ -224,6 +227,16 @@ class GitClient(object):
         """
         raise NotImplementedError(self.fetch_pack)
 
+    def _negotiate_receive_pack_capabilities(self, server_capabilities,
+                                             atomic):
+        negotiated_capabilities = self._send_capabilities & server_capabilities
+        if atomic:
+            if 'atomic' not in server_capabilities:
+                raise SendPackError(
+                    'the receiving end does not support atomic pushes')
+            negotiated_capabilities.add('atomic')
+        return negotiated_capabilities
+
     def _parse_status_report(self, proto):
         unpack = proto.read_pkt_line().strip()
         if unpack != 'unpack ok':
@@ -422,21 +435,30 @@ class TraditionalGitClient(GitClient):
         raise NotImplementedError()
 
     def send_pack(self, path, determine_wants, generate_pack_contents,
-                  progress=None):
+                  progress=None, atomic=False):
         """Upload a pack to a remote repository.
 
         :param path: Repository path
         :param generate_pack_contents: Function that can return a sequence of the
             shas of the objects to upload.
         :param progress: Optional callback called with progress updates
+        :param atomic: Whether the server should update all refs or none
 
         :raises SendPackError: if server rejects the pack data
         :raises UpdateRefsError: if the server supports report-status
                                  and rejects ref updates
+        :raises SendPackError: if atomic is set and the server does not
+            support atomic updates
         """
         proto, unused_can_read = self._connect('receive-pack', path)
         old_refs, server_capabilities = read_pkt_refs(proto)
-        negotiated_capabilities = self._send_capabilities & server_capabilities
+        try:
+            negotiated_capabilities = (
+                self._negotiate_receive_pack_capabilities(
+                    server_capabilities, atomic))
+        except SendPackError:
+            proto.write_pkt_line(None)
+            raise
 
         if 'report-status' in negotiated_capabilities:
             self._report_status_parser = ReportStatusParser()
@@ -648,17 +670,20 @@ class LocalGitClient(GitClient):
         # Ignore the thin_packs argument
 
     def send_pack(self, path, determine_wants, generate_pack_contents,
-                  progress=None):
+                  progress=None, atomic=False):
         """Upload a pack to a remote repository.
 
         :param path: Repository path
         :param generate_pack_contents: Function that can return a sequence of the
             shas of the objects to upload.
         :param progress: Optional progress function
+        :param atomic: Whether the server should update all refs or none
 
         :raises SendPackError: if server rejects the pack data
         :raises UpdateRefsError: if the server supports report-status
                                  and rejects ref updates
+        :raises SendPackError: if atomic is set and the server does not
+            support atomic updates
         """
         raise NotImplementedError(self.send_pack)
 
@@ -958,22 +983,26 @@ class HttpGitClient(GitClient):
         return resp
 
     def send_pack(self, path, determine_wants, generate_pack_contents,
-                  progress=None):
+                  progress=None, atomic=False):
         """Upload a pack to a remote repository.
 
         :param path: Repository path
         :param generate_pack_contents: Function that can return a sequence of the
             shas of the objects to upload.
         :param progress: Optional progress function
+        :param atomic: Whether the server should update all refs or none
 
         :raises SendPackError: if server rejects the pack data
         :raises UpdateRefsError: if the server supports report-status
                                  and rejects ref updates
+        :raises SendPackError: if atomic is set and the server does not
+            support atomic updates
         """
         url = self._get_url(path)
         old_refs, server_capabilities = self._discover_references(
             "git-receive-pack", url)
-        negotiated_capabilities = self._send_capabilities & server_capabilities
+        negotiated_capabilities = self._negotiate_receive_pack_capabilities(
+            server_capabilities, atomic)
 
         if 'report-status' in negotiated_capabilities:
             self._report_status_parser = ReportStatusParser()
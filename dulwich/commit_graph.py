@@ -0,0 +1,350 @@
+# commit_graph.py -- Reading and writing git commit-graph files
+# Copyright (C) 2014 The Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) a later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing git commit-graph files.
+
+A commit-graph file stores the tree, parents, commit time and generation
+number of a set of commits, so that history can be walked without
+inflating and parsing the commits themselves. The generation number of a
+commit is one more than the largest generation number of its parents, so a
+commit can never reach a commit with a higher generation number.
+"""
+
+from collections import (
+    defaultdict,
+    namedtuple,
+    )
+from itertools import imap
+import struct
+from struct import unpack_from
+
+from dulwich.file import GitFile
+from dulwich.objects import (
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    SHA1Writer,
+    _check_chunk_size,
+    _load_file_contents,
+    _read_chunk_table,
+    bisect_find_sha,
+    )
+
+COMMIT_GRAPH_FILENAME = 'commit-graph'
+
+COMMIT_GRAPH_SIGNATURE = 'CGPH'
+COMMIT_GRAPH_CHUNK_OIDFANOUT = 'OIDF'
+COMMIT_GRAPH_CHUNK_OIDLOOKUP = 'OIDL'
+COMMIT_GRAPH_CHUNK_DATA = 'CDAT'
+COMMIT_GRAPH_CHUNK_EXTRAEDGES = 'EDGE'
+
+# Parent value for commits with fewer parents.
+GRAPH_PARENT_NONE = 0x70000000
+# Set on the second parent if it is an index into the extra edges, and on
+# the last entry of a list of extra edges.
+GRAPH_EXTRA_EDGES = 0x80000000
+GENERATION_NUMBER_MAX = 0x3FFFFFFF
+
+_COMMIT_DATA_SIZE = 36
+
+
+class CommitGraphEntry(namedtuple('CommitGraphEntry', [
+        'id', 'tree', 'parents', 'commit_time', 'generation'])):
+    """A commit in a commit graph.
+
+    Apart from the generation number, these attributes match those of
+    Commit, so a CommitGraphEntry can stand in for a Commit when walking
+    history.
+    """
+
+    __slots__ = ()
+
+
+def load_commit_graph(path):
+    """Load a commit-graph file by path.
+
+    :param path: Path to the commit-graph file
+    :return: A CommitGraph
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return CommitGraph(path, file=f)
+    except:
+        f.close()
+        raise
+
+
+class CommitGraph(object):
+    """A commit graph, read from git's commit-graph file.
+
+    The file format is that of git's commit-graph file (version 1, with
+    SHA-1 object names): a fan-out table and the sorted commit names,
+    followed by the tree, parents, generation number and commit time of
+    every commit. Parents are referred to by their position in the sorted
+    list of names, so all parents of a commit in the graph are in the graph
+    too.
+    """
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        """Create a commit graph object.
+
+        :param filename: Path to the commit-graph file
+        :param file: Optional file-like object to read from
+        :param contents: Optional contents of the file
+        :param size: Optional size of the file
+        """
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            if size is None:
+                size = len(contents)
+            self._contents, self._size = (contents, size)
+        if self._size < 8:
+            raise AssertionError('Commit-graph file is truncated')
+        (signature, version, hash_version, num_chunks,
+         num_base_graphs) = unpack_from('>4sBBBB', self._contents, 0)
+        if signature != COMMIT_GRAPH_SIGNATURE:
+            raise AssertionError('Not a commit-graph file')
+        if version != 1:
+            raise AssertionError('Version was %d' % version)
+        if hash_version != 1:
+            raise AssertionError('Unsupported hash version %d' % hash_version)
+        if num_base_graphs != 0:
+            raise AssertionError('Split commit-graphs are not supported')
+        chunks = _read_chunk_table(self._contents, self._size, 8, num_chunks)
+        self._fan_out_table = list(unpack_from(
+            '>256L', self._contents,
+            _check_chunk_size(chunks, COMMIT_GRAPH_CHUNK_OIDFANOUT, 256 * 4)))
+        num_commits = self._fan_out_table[-1]
+        self._name_table_offset = _check_chunk_size(
+            chunks, COMMIT_GRAPH_CHUNK_OIDLOOKUP, num_commits * 20)
+        self._data_offset = _check_chunk_size(
+            chunks, COMMIT_GRAPH_CHUNK_DATA, num_commits * _COMMIT_DATA_SIZE)
+        self._extra_edges_offset, self._extra_edges_end = chunks.get(
+            COMMIT_GRAPH_CHUNK_EXTRAEDGES, (0, 0))
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, "close", None) is not None:
+            self._contents.close()
+
+    def __len__(self):
+        """Return the number of commits in this commit graph."""
+        return self._fan_out_table[-1]
+
+    def __iter__(self):
+        """Iterate over the SHAs of the commits in this commit graph."""
+        return imap(sha_to_hex, self._itersha())
+
+    def __contains__(self, sha):
+        """Check whether a commit is in this commit graph."""
+        try:
+            self._position(sha)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, sha):
+        """Return the entry of a commit.
+
+        :param sha: Hex or binary SHA of the commit
+        :return: A CommitGraphEntry, with hex SHAs
+        :raise KeyError: if the commit is not in this commit graph
+        """
+        i = self._position(sha)
+        (tree, parents, commit_time, generation) = self._unpack_data(i)
+        return CommitGraphEntry(
+            sha_to_hex(self._unpack_name(i)), sha_to_hex(tree),
+            [sha_to_hex(self._unpack_name(p)) for p in parents],
+            commit_time, generation)
+
+    def _itersha(self):
+        for i in range(len(self)):
+            yield self._unpack_name(i)
+
+    def _unpack_name(self, i):
+        offset = self._name_table_offset + i * 20
+        return self._contents[offset:offset+20]
+
+    def _position(self, sha):
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        assert len(sha) == 20
+        idx = ord(sha[0])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        i = bisect_find_sha(start, end, sha, self._unpack_name)
+        if i is None:
+            raise KeyError(sha)
+        return i
+
+    def _unpack_parents(self, i):
+        offset = self._data_offset + i * _COMMIT_DATA_SIZE + 20
+        parent1, parent2 = unpack_from('>LL', self._contents, offset)
+        if parent1 == GRAPH_PARENT_NONE:
+            return []
+        if parent2 == GRAPH_PARENT_NONE:
+            return [parent1]
+        if not parent2 & GRAPH_EXTRA_EDGES:
+            return [parent1, parent2]
+        parents = [parent1]
+        offset = self._extra_edges_offset + (parent2 & ~GRAPH_EXTRA_EDGES) * 4
+        while True:
+            if offset + 4 > self._extra_edges_end:
+                raise AssertionError('%s chunk is truncated' %
+                                     COMMIT_GRAPH_CHUNK_EXTRAEDGES)
+            (parent, ) = unpack_from('>L', self._contents, offset)
+            parents.append(parent & ~GRAPH_EXTRA_EDGES)
+            if parent & GRAPH_EXTRA_EDGES:
+                return parents
+            offset += 4
+
+    def _unpack_data(self, i):
+        offset = self._data_offset + i * _COMMIT_DATA_SIZE
+        tree = self._contents[offset:offset+20]
+        (generation, commit_time) = unpack_from('>LL', self._contents,
+                                                offset + 28)
+        commit_time |= (generation & 0x3) << 32
+        return tree, self._unpack_parents(i), commit_time, generation >> 2
+
+    def get_parents(self, sha):
+        """Return the parents of a commit.
+
+        :param sha: Hex or binary SHA of the commit
+        :return: List of hex SHAs of the parents
+        :raise KeyError: if the commit is not in this commit graph
+        """
+        return [sha_to_hex(self._unpack_name(p))
+                for p in self._unpack_parents(self._position(sha))]
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        :param sha: Hex or binary SHA of the commit
+        :raise KeyError: if the commit is not in this commit graph
+        """
+        return self._unpack_data(self._position(sha))[2]
+
+    def get_generation(self, sha):
+        """Return the generation number of a commit.
+
+        :param sha: Hex or binary SHA of the commit
+        :raise KeyError: if the commit is not in this commit graph
+        """
+        return self._unpack_data(self._position(sha))[3]
+
+
+def write_commit_graph(f, commits):
+    """Write a commit-graph file.
+
+    :param f: File-like object to write to
+    :param commits: Iterable over commits, Commit objects or anything else
+        with id, tree, parents and commit_time attributes. The parents of
+        every commit have to be included.
+    :return: The SHA of the commit-graph file written
+    :raise KeyError: if the parent of a commit is missing
+    """
+    by_name = dict((hex_to_sha(commit.id), commit) for commit in commits)
+    names = sorted(by_name)
+    positions = dict((name, i) for (i, name) in enumerate(names))
+
+    parents = []
+    for name in names:
+        parents.append([positions[hex_to_sha(parent)]
+                        for parent in by_name[name].parents])
+
+    # Generation numbers, computed parents first.
+    generations = [0] * len(names)
+    for i in range(len(names)):
+        todo = [i]
+        while todo:
+            j = todo[-1]
+            if generations[j]:
+                todo.pop()
+                continue
+            pending = [p for p in parents[j] if not generations[p]]
+            if pending:
+                todo.extend(pending)
+                continue
+            todo.pop()
+            generations[j] = min(
+                GENERATION_NUMBER_MAX,
+                1 + max([generations[p] for p in parents[j]] or [0]))
+
+    fan_out_table = defaultdict(lambda: 0)
+    for name in names:
+        fan_out_table[ord(name[0])] += 1
+    for i in range(0x100):
+        fan_out_table[i+1] += fan_out_table[i]
+    data = []
+    extra_edges = []
+    for i, name in enumerate(names):
+        commit = by_name[name]
+        commit_parents = parents[i]
+        if not commit_parents:
+            parent1, parent2 = GRAPH_PARENT_NONE, GRAPH_PARENT_NONE
+        elif len(commit_parents) == 1:
+            parent1, parent2 = commit_parents[0], GRAPH_PARENT_NONE
+        elif len(commit_parents) == 2:
+            parent1, parent2 = commit_parents
+        else:
+            parent1 = commit_parents[0]
+            parent2 = GRAPH_EXTRA_EDGES | len(extra_edges)
+            extra_edges.extend(commit_parents[1:])
+            extra_edges[-1] |= GRAPH_EXTRA_EDGES
+        commit_time = commit.commit_time
+        data.append(hex_to_sha(commit.tree) + struct.pack(
+            '>LLLL', parent1, parent2,
+            (generations[i] << 2) | ((commit_time >> 32) & 0x3),
+            commit_time & 0xFFFFFFFF))
+
+    chunks = [
+        (COMMIT_GRAPH_CHUNK_OIDFANOUT, 0x100 * 4),
+        (COMMIT_GRAPH_CHUNK_OIDLOOKUP, len(names) * 20),
+        (COMMIT_GRAPH_CHUNK_DATA, len(names) * _COMMIT_DATA_SIZE),
+        ]
+    if extra_edges:
+        chunks.append((COMMIT_GRAPH_CHUNK_EXTRAEDGES, len(extra_edges) * 4))
+
+    f = SHA1Writer(f)
+    f.write(struct.pack('>4sBBBB', COMMIT_GRAPH_SIGNATURE, 1, 1, len(chunks),
+                        0))
+    # Chunk lookup table, terminated by an entry pointing past the last chunk
+    offset = 8 + (len(chunks) + 1) * 12
+    for chunk_id, size in chunks:
+        f.write(struct.pack('>4sQ', chunk_id, offset))
+        offset += size
+    f.write(struct.pack('>4sQ', '\0\0\0\0', offset))
+    for i in range(0x100):
+        f.write(struct.pack('>L', fan_out_table[i]))
+    for name in names:
+        f.write(name)
+    for entry in data:
+        f.write(entry)
+    for edge in extra_edges:
+        f.write(struct.pack('>L', edge))
+    return f.write_sha()
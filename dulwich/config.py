@@ -37,6 +37,9 @@ from collections import (
 from dulwich.file import GitFile
 
 
+_INT_SUFFIXES = {'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+
+
 class Config(object):
     """A Git configuration."""
 
@@ -69,6 +72,31 @@ class Config(object):
             return False
         raise ValueError("not a valid boolean string: %r" % value)
 
+    def get_int(self, section, name, default=None):
+        """Retrieve a configuration setting as integer.
+
+        As in git, the value may have a k, m or g suffix to scale it by 1024,
+        1024^2 or 1024^3.
+
+        :param section: Tuple with section name and optional subsection namee
+        :param name: Name of the setting, including section and possible
+            subsection.
+        :return: Contents of the setting
+        """
+        try:
+            value = self.get(section, name)
+        except KeyError:
+            return default
+        factor = _INT_SUFFIXES.get(value[-1:].lower())
+        if factor is not None:
+            digits = value[:-1]
+        else:
+            digits, factor = value, 1
+        try:
+            return int(digits) * factor
+        except ValueError:
+            raise ValueError("not a valid integer string: %r" % value)
+
     def set(self, section, name, value):
         """Set a configuration value.
 
@@ -173,5 +173,16 @@ class RefFormatError(Exception):
     """Indicates an invalid ref name."""
 
 
+class RefsTransactionError(Exception):
+    """A ref transaction failed after some of its refs were changed."""
+
+    def __init__(self, updated, error):
+        self.updated = updated
+        self.error = error
+        Exception.__init__(self,
+            "Ref transaction failed after updating %s: %s" % (
+                ', '.join(updated), error))
+
+
 class HookError(Exception):
     """An error occurred while executing a hook."""
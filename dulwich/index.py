@@ -411,37 +411,44 @@ def build_index_from_tree(prefix, index_path, object_store, tree_id,
 
     index = Index(index_path)
 
+    # Read the blobs in the order the object store holds them in, rather
+    # than in tree order.
+    entries = {}
     for entry in object_store.iter_tree_contents(tree_id):
-        full_path = os.path.join(prefix, entry.path)
+        entries.setdefault(entry.sha, []).append(entry)
 
-        if not os.path.exists(os.path.dirname(full_path)):
-            os.makedirs(os.path.dirname(full_path))
+    for obj in object_store.iterobjects_subset(entries):
+        for entry in entries[obj.id]:
+            full_path = os.path.join(prefix, entry.path)
 
-        # FIXME: Merge new index into working tree
-        if stat.S_ISLNK(entry.mode):
-            # FIXME: This will fail on Windows. What should we do instead?
-            src_path = object_store[entry.sha].as_raw_string()
-            try:
-                os.symlink(src_path, full_path)
-            except OSError as e:
-                if e.errno == errno.EEXIST:
-                    os.unlink(full_path)
-                    os.symlink(src_path, full_path)
-                else:
-                    raise
-        else:
-            f = open(full_path, 'wb')
-            try:
-                # Write out file
-                f.write(object_store[entry.sha].as_raw_string())
-            finally:
-                f.close()
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
 
-            if honor_filemode:
-                os.chmod(full_path, entry.mode)
-
-        # Add file to index
-        st = os.lstat(full_path)
-        index[entry.path] = index_entry_from_stat(st, entry.sha, 0)
+            # FIXME: Merge new index into working tree
+            if stat.S_ISLNK(entry.mode):
+                # FIXME: This will fail on Windows. What should we do instead?
+                src_path = obj.as_raw_string()
+                try:
+                    os.symlink(src_path, full_path)
+                except OSError as e:
+                    if e.errno == errno.EEXIST:
+                        os.unlink(full_path)
+                        os.symlink(src_path, full_path)
+                    else:
+                        raise
+            else:
+                f = open(full_path, 'wb')
+                try:
+                    # Write out file
+                    f.write(obj.as_raw_string())
+                finally:
+                    f.close()
+
+                if honor_filemode:
+                    os.chmod(full_path, entry.mode)
+
+            # Add file to index
+            st = os.lstat(full_path)
+            index[entry.path] = index_entry_from_stat(st, entry.sha, 0)
 
     index.write()
@@ -26,8 +26,15 @@ import errno
 import itertools
 import os
 import stat
+import struct
 import tempfile
+import time
 
+from dulwich.commit_graph import (
+    COMMIT_GRAPH_FILENAME,
+    load_commit_graph,
+    write_commit_graph,
+    )
 from dulwich.diff_tree import (
     tree_changes,
     walk_trees,
@@ -37,6 +44,7 @@ from dulwich.errors import (
     )
 from dulwich.file import GitFile
 from dulwich.objects import (
+    Blob,
     Commit,
     ShaFile,
     Tag,
@@ -49,10 +57,17 @@ from dulwich.objects import (
     object_class,
     )
 from dulwich.pack import (
+    DEFAULT_DELTA_BASE_CACHE_SIZE,
+    DELTA_TYPES,
+    DeltaBaseCache,
+    REF_DELTA,
     Pack,
     PackData,
     PackInflater,
+    deltify_pack_records,
+    has_fast_create_delta,
     iter_sha1,
+    write_pack_data,
     write_pack_header,
     write_pack_index_v2,
     write_pack_object,
@@ -60,6 +75,13 @@ from dulwich.pack import (
     compute_file_sha,
     PackIndexer,
     PackStreamCopier,
+    ParallelPackIndexer,
+    MULTI_PACK_INDEX_FILENAME,
+    load_multi_pack_index,
+    write_multi_pack_index,
+    bitmap_from_positions,
+    _bitmap_from_bytes,
+    _bitmap_to_bytes,
     )
 
 INFODIR = 'info'
@@ -70,8 +92,10 @@ class BaseObjectStore(object):
     """Object store interface."""
 
     def determine_wants_all(self, refs):
+        present = self.contains_many(
+            [sha for sha in refs.itervalues() if sha != ZERO_SHA])
         return [sha for (ref, sha) in refs.iteritems()
-                if not sha in self and not ref.endswith("^{}") and
+                if not sha in present and not ref.endswith("^{}") and
                    not sha == ZERO_SHA]
 
     def iter_shas(self, shas):
@@ -90,6 +114,17 @@ class BaseObjectStore(object):
         """Check if a particular object is present by SHA1 and is packed."""
         raise NotImplementedError(self.contains_packed)
 
+    def open_loose_object(self, sha):
+        """Open a loose object for reading its compressed contents.
+
+        :param sha: Hex SHA1 of the object
+        :return: File-like object with the object in the (zlib-compressed)
+            loose object format, or None if the object is not loose
+        """
+        if not self.contains_loose(sha):
+            return None
+        return BytesIO(self[sha].as_legacy_object())
+
     def __contains__(self, sha):
         """Check if a particular object is present by SHA1.
 
@@ -97,6 +132,14 @@ class BaseObjectStore(object):
         """
         return self.contains_packed(sha) or self.contains_loose(sha)
 
+    def contains_many(self, shas):
+        """Check which of a set of objects are present.
+
+        :param shas: Iterable over hex SHA1s
+        :return: Set of the SHA1s that are present in this store
+        """
+        return set(sha for sha in shas if sha in self)
+
     @property
     def packs(self):
         """Iterable of pack objects."""
@@ -110,6 +153,34 @@ class BaseObjectStore(object):
         """
         raise NotImplementedError(self.get_raw)
 
+    def get_raw_many(self, shas):
+        """Obtain the raw text for a set of objects.
+
+        Results are yielded in the order that is cheapest for the store to
+        read the objects in, which need not be the order of shas.
+
+        :param shas: Iterable over hex SHA1s
+        :return: Iterator over tuples with hex SHA1, numeric type and object
+            contents
+        :raise KeyError: if one of the objects is not present, once all
+            objects that are present have been yielded
+        """
+        for sha in shas:
+            type_num, uncomp = self.get_raw(sha)
+            yield sha, type_num, uncomp
+
+    def iterobjects_subset(self, shas):
+        """Iterate over a set of objects.
+
+        Objects are yielded in the order get_raw_many returns them in.
+
+        :param shas: Iterable over hex SHA1s
+        :return: Iterator over ShaFile objects
+        :raise KeyError: if one of the objects is not present
+        """
+        for sha, type_num, uncomp in self.get_raw_many(shas):
+            yield ShaFile.from_raw_string(type_num, uncomp, sha=sha)
+
     def __getitem__(self, sha):
         """Obtain an object by SHA1."""
         type_num, uncomp = self.get_raw(sha)
@@ -173,10 +244,41 @@ class BaseObjectStore(object):
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
         :param get_parents: Optional function for getting the parents of a commit.
-        :return: Iterator over (sha, path) pairs.
+        :return: A MissingObjects iterator over (sha, path) pairs.
+        """
+        finder = MissingObjectFinder(self, haves, wants, progress, get_tagged,
+                                     get_parents=get_parents)
+        return MissingObjects(iter(finder.next, None), finder.sha_done)
+
+    def lookup_commit(self, sha):
+        """Look up the tree, parents and commit time of a commit.
+
+        Stores with a commit graph answer from it where they can, without
+        inflating the commit.
+
+        :param sha: Hex SHA1 of the commit
+        :return: A CommitGraphEntry or Commit; other objects are returned as
+            they are
         """
-        finder = MissingObjectFinder(self, haves, wants, progress, get_tagged, get_parents=get_parents)
-        return iter(finder.next, None)
+        return self[sha]
+
+    def find_missing_objects_bitmap(self, haves, wants, progress=None,
+                                    get_tagged=None):
+        """Find the missing objects for a set of revisions using bitmaps.
+
+        Unlike find_missing_objects, this excludes all objects reachable
+        from haves, not just those in the trees of the common commits.
+
+        :param haves: Iterable over SHAs already in common.
+        :param wants: Iterable over SHAs of objects to fetch.
+        :param progress: Simple progress function that will be called with
+            updated progress strings.
+        :param get_tagged: Function that returns a dict of pointed-to sha -> tag
+            sha for including tags.
+        :return: Iterator over (sha, path) pairs, or None if this store has
+            no reachability bitmaps
+        """
+        return None
 
     def find_common_revisions(self, graphwalker):
         """Find which revisions this store has in common using graphwalker.
@@ -202,6 +304,29 @@ class BaseObjectStore(object):
         """
         return self.iter_shas(self.find_missing_objects(have, want, progress))
 
+    def sole_pack(self, wants):
+        """Return the pack holding exactly the objects reachable from wants.
+
+        :param wants: Iterable over hex SHA1s
+        :return: A Pack whose objects are all reachable from wants and that
+            holds all objects in this store, or None if there is no such pack
+        """
+        return None
+
+    def iter_pack_records(self, shas, remote_has=()):
+        """Generate records for writing a set of objects to a pack.
+
+        :param shas: Iterable over hex SHA1s of the objects to write
+        :param remote_has: Container of hex SHA1s of objects the receiver
+            already has, which may be used as delta bases without being sent
+            (thin pack)
+        :return: Iterator over type_num, object_id, delta_base, raw tuples,
+            suitable for write_pack_data
+        """
+        for sha in shas:
+            type_num, raw = self.get_raw(sha)
+            yield type_num, hex_to_sha(sha), None, raw
+
     def peel_sha(self, sha):
         """Peel all tags from a SHA.
 
@@ -239,7 +364,7 @@ class BaseObjectStore(object):
                 bases.add(e)
             elif e not in commits:
                 commits.add(e)
-                cmt = self[e]
+                cmt = self.lookup_commit(e)
                 queue.extend(get_parents(cmt))
         return (commits, bases)
 
@@ -248,10 +373,98 @@ class BaseObjectStore(object):
         # Default implementation is a NO-OP
 
 
+# Number of seconds unreachable objects are kept for by repack, like
+# gc.pruneExpire in C git.
+DEFAULT_PRUNE_GRACE_PERIOD = 2 * 7 * 24 * 60 * 60
+
+
+def _fsync_dir(path):
+    """Make sure the entries of a directory are on disk, where supported."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Directories can not be opened on Windows.
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Number of lookups that have to miss all packs before a bloom filter over the
+# packed objects is built.
+PACK_FILTER_MIN_MISSES = 32
+
+# Every how many commits a reachability bitmap is written, besides the tips.
+BITMAP_COMMIT_INTERVAL = 100
+
+
+class ShaBloomFilter(object):
+    """Bloom filter over binary SHA1s.
+
+    SHA1s are uniformly distributed, so rather than hashing them again the
+    first four 32-bit words of each SHA1 are used as the bit positions.
+    """
+
+    _words = struct.Struct('>4L')
+
+    def __init__(self, num_entries, bits_per_entry=16):
+        """Create a new, empty, bloom filter.
+
+        :param num_entries: Expected number of entries
+        :param bits_per_entry: Number of bits to reserve per entry; the
+            default gives a false positive rate of about 0.25%
+        """
+        size = 64
+        while size < num_entries * bits_per_entry and size < 1 << 32:
+            size <<= 1
+        self._mask = size - 1
+        self._bits = bytearray(size >> 3)
+
+    def add(self, sha):
+        """Add a binary SHA1 to the filter."""
+        self.update([sha])
+
+    def update(self, shas):
+        """Add binary SHA1s to the filter.
+
+        :param shas: Iterable over binary SHA1s
+        """
+        bits = self._bits
+        mask = self._mask
+        unpack = self._words.unpack_from
+        for sha in shas:
+            for word in unpack(sha):
+                pos = word & mask
+                bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, sha):
+        """Check whether a binary SHA1 may have been added.
+
+        False positives are possible, false negatives are not.
+        """
+        bits = self._bits
+        mask = self._mask
+        for word in self._words.unpack_from(sha):
+            pos = word & mask
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
 class PackBasedObjectStore(BaseObjectStore):
 
     def __init__(self):
         self._pack_cache = {}
+        self._pack_order = []
+        self._pack_order_stale = False
+        self._midx = None
+        self._midx_packs = []
+        self._midx_covered = set()
+        self._pack_filter = None
+        self._pack_filter_misses = 0
 
     @property
     def alternates(self):
@@ -262,9 +475,17 @@ class PackBasedObjectStore(BaseObjectStore):
 
         This does not check alternates.
         """
-        for pack in self.packs:
+        packs = self._unindexed_packs()
+        if not self._may_be_packed(sha):
+            return False
+        if self._midx is not None and sha in self._midx:
+            return True
+        for pack in packs:
             if sha in pack:
+                self._record_pack_hit(pack)
                 return True
+            pack.misses += 1
+        self._pack_filter_misses += 1
         return False
 
     def __contains__(self, sha):
@@ -279,6 +500,48 @@ class PackBasedObjectStore(BaseObjectStore):
                 return True
         return False
 
+    def contains_many(self, shas):
+        """Check which of a set of objects are present.
+
+        Pack indexes are searched for all SHA1s at once, rather than once per
+        SHA1, which makes this much faster than testing membership of each SHA1
+        for large sets.
+
+        :param shas: Iterable over hex SHA1s
+        :return: Set of the SHA1s that are present in this store
+        """
+        todo = set(shas)
+        present = set()
+        packs = self._unindexed_packs()
+        packed = set(sha for sha in todo if self._may_be_packed(sha))
+        unpacked = todo - packed
+        todo = packed
+        if self._midx is not None:
+            found = self._midx.object_pack_offset_many(todo)
+            present.update(found)
+            todo.difference_update(found)
+        for pack in packs:
+            if not todo:
+                break
+            found = pack.contains_many(todo)
+            pack.hits += len(found)
+            pack.misses += len(todo) - len(found)
+            present.update(found)
+            todo.difference_update(found)
+        self._pack_filter_misses += len(todo)
+        todo.update(unpacked)
+        for sha in list(todo):
+            if self.contains_loose(sha):
+                present.add(sha)
+                todo.remove(sha)
+        for alternate in self.alternates:
+            if not todo:
+                break
+            found = alternate.contains_many(todo)
+            present.update(found)
+            todo.difference_update(found)
+        return present
+
     def _pack_cache_stale(self):
         """Check whether the pack cache is stale."""
         raise NotImplementedError(self._pack_cache_stale)
@@ -288,21 +551,146 @@ class PackBasedObjectStore(BaseObjectStore):
 
         """
         self._pack_cache[base_name] = pack
+        self._pack_order_stale = True
+        self._pack_filter = None
+
+    def _order_packs(self):
+        """Bring the pack order in line with the pack cache.
+
+        Packs that are still present keep their place. Packs that have
+        appeared are added at the end, those with the most objects first.
+        """
+        packs = self._pack_cache.values()
+        present = set(id(pack) for pack in packs)
+        order = [pack for pack in self._pack_order if id(pack) in present]
+        known = set(id(pack) for pack in order)
+        new = [pack for pack in packs if id(pack) not in known]
+        new.sort(key=len, reverse=True)
+        self._pack_order = order + new
+        self._pack_order_stale = False
+
+    def _record_pack_hit(self, pack):
+        """Record that an object was found in a pack.
+
+        The pack is moved to the front of the pack order, so that it is the
+        first to be searched next time.
+        """
+        pack.hits += 1
+        order = self._pack_order
+        if order[0] is pack:
+            return
+        for i, other in enumerate(order):
+            if other is pack:
+                del order[i]
+                order.insert(0, pack)
+                break
+
+    def _may_be_packed(self, sha):
+        """Check whether an object may be in one of the packs.
+
+        Once enough lookups have missed all packs, a bloom filter over the
+        packed objects is built, so that most objects that are not packed
+        can be ruled out without searching the pack indexes. The filter is
+        dropped whenever the set of packs changes.
+
+        :param sha: Hex or binary SHA1
+        :return: False if the object is certainly not packed, True otherwise
+        """
+        pack_filter = self._pack_filter
+        if pack_filter is None:
+            if self._pack_filter_misses < PACK_FILTER_MIN_MISSES:
+                return True
+            pack_filter = self._build_pack_filter()
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return sha in pack_filter
+
+    def _build_pack_filter(self):
+        """Build a bloom filter over the objects in all packs."""
+        packs = self.packs
+        pack_filter = ShaBloomFilter(sum(len(pack) for pack in packs))
+        for pack in packs:
+            pack_filter.update(pack.index._itersha())
+        self._pack_filter = pack_filter
+        return pack_filter
+
+    def _set_multi_pack_index(self, midx):
+        """Set the multi-pack index to consult before the pack indexes.
+
+        The multi-pack index is only used if all the packs it covers are in
+        the pack cache.
+
+        :param midx: A MultiPackIndex, or None
+        """
+        if self._midx is not None:
+            self._midx.close()
+        packs = []
+        if midx is not None:
+            for name in midx.pack_names:
+                if name.endswith('.idx'):
+                    name = name[:-len('.idx')]
+                pack = self._pack_cache.get(name)
+                if pack is None:
+                    midx.close()
+                    midx = None
+                    packs = []
+                    break
+                packs.append(pack)
+        self._midx = midx
+        self._midx_packs = packs
+        self._midx_covered = set(id(pack) for pack in packs)
+
+    def _unindexed_packs(self):
+        """Return the packs that are not covered by the multi-pack index."""
+        packs = self.packs
+        if self._midx is None:
+            return packs
+        return [pack for pack in packs if id(pack) not in self._midx_covered]
+
+    def _get_raw_from_midx(self, sha):
+        """Obtain the raw text for an object, using the multi-pack index.
+
+        :param sha: Binary SHA1 of the object
+        :return: Tuple with numeric type and object contents, or None if the
+            object is not in the multi-pack index
+        """
+        if self._midx is None:
+            return None
+        try:
+            pack_id, offset = self._midx.object_pack_offset(sha)
+        except KeyError:
+            return None
+        pack = self._midx_packs[pack_id]
+        pack.hits += 1
+        return pack.get_raw_at(offset)
 
     def close(self):
+        self._set_multi_pack_index(None)
         pack_cache = self._pack_cache
         self._pack_cache = {}
+        self._pack_order = []
+        self._pack_order_stale = False
+        self._pack_filter = None
         while pack_cache:
             (name, pack) = pack_cache.popitem()
             pack.close()
 
     @property
     def packs(self):
-        """List with pack objects."""
+        """List with pack objects.
+
+        Packs are listed in the order they should be searched in: the pack
+        an object was last found in comes first, like in C git. Packs that
+        have not had a hit yet are ordered by number of objects, so a large
+        base pack is searched first.
+        """
         if self._pack_cache is None or self._pack_cache_stale():
             self._update_pack_cache()
-
-        return self._pack_cache.values()
+            self._pack_order_stale = True
+            self._pack_filter = None
+        if self._pack_order_stale:
+            self._order_packs()
+        return list(self._pack_order)
 
     def _iter_alternate_objects(self):
         """Iterate over the SHAs of all the objects in alternate stores."""
@@ -320,18 +708,64 @@ class PackBasedObjectStore(BaseObjectStore):
     def _remove_loose_object(self, sha):
         raise NotImplementedError(self._remove_loose_object)
 
-    def pack_loose_objects(self):
+    def _iter_loose_records(self, shas):
+        """Generate records for writing loose objects to a pack.
+
+        :param shas: Iterable over hex SHA1s of loose objects
+        :return: Iterator over type_num, object_id, delta_base, raw tuples,
+            suitable for write_pack_data
+        """
+        for sha in shas:
+            obj = self._get_loose_object(sha)
+            if obj is not None:
+                type_num, raw = obj.type_num, obj.as_raw_string()
+            else:
+                # Packed and removed by somebody else in the meantime.
+                type_num, raw = self.get_raw(sha)
+            yield type_num, hex_to_sha(sha), None, raw
+
+    def pack_loose_objects(self, max_pack_objects=None):
         """Pack loose objects.
 
+        Objects are written to the pack as they are read, so only their
+        SHA1s are kept in memory. Loose objects are only removed once the pack
+        they were written to has been committed. Loose objects that are
+        already packed, for example because an earlier run was interrupted
+        before removing them, are removed without being packed again.
+
+        :param max_pack_objects: Maximum number of objects to write to a
+            single pack, or None for no limit. Each pack is committed and its
+            loose objects removed before the next one is started.
         :return: Number of objects packed
         """
-        objects = set()
-        for sha in self._iter_loose_objects():
-            objects.add((self._get_loose_object(sha), None))
-        self.add_objects(list(objects))
-        for obj, path in objects:
-            self._remove_loose_object(obj.id)
-        return len(objects)
+        loose = self._iter_loose_objects()
+        count = 0
+        while True:
+            shas = list(itertools.islice(loose, max_pack_objects))
+            if not shas:
+                break
+            todo = []
+            for sha in shas:
+                if self.contains_packed(sha):
+                    self._remove_loose_object(sha)
+                else:
+                    todo.append(sha)
+            if todo:
+                f, commit, abort = self.add_pack()
+                try:
+                    write_pack_data(f, len(todo),
+                                    self._iter_loose_records(todo))
+                except:
+                    abort()
+                    raise
+                else:
+                    commit()
+                for sha in todo:
+                    self._remove_loose_object(sha)
+                count += len(todo)
+            if max_pack_objects is None:
+                break
+        return count
 
     def __iter__(self):
         """Iterate over the SHAs that are present in this store."""
@@ -359,11 +793,20 @@ class PackBasedObjectStore(BaseObjectStore):
             hexsha = None
         else:
             raise AssertionError("Invalid object name %r" % name)
-        for pack in self.packs:
-            try:
-                return pack.get_raw(sha)
-            except KeyError:
-                pass
+        packs = self._unindexed_packs()
+        if self._may_be_packed(sha):
+            ret = self._get_raw_from_midx(sha)
+            if ret is not None:
+                return ret
+            for pack in packs:
+                try:
+                    ret = pack.get_raw(sha)
+                except KeyError:
+                    pack.misses += 1
+                else:
+                    self._record_pack_hit(pack)
+                    return ret
+            self._pack_filter_misses += 1
         if hexsha is None:
             hexsha = sha_to_hex(name)
         ret = self._get_loose_object(hexsha)
@@ -376,6 +819,293 @@ class PackBasedObjectStore(BaseObjectStore):
                 pass
         raise KeyError(hexsha)
 
+    def get_raw_many(self, shas):
+        """Obtain the raw text for a set of objects.
+
+        Objects are grouped by the pack they are in and read in the order
+        they are stored in, so that each pack is read sequentially and delta
+        bases shared by several of the objects are resolved once and then
+        found in the delta base cache. Loose objects and objects from
+        alternates follow.
+
+        :param shas: Iterable over hex SHA1s
+        :return: Iterator over tuples with hex SHA1, numeric type and object
+            contents
+        :raise KeyError: if one of the objects is not present, once all
+            objects that are present have been yielded
+        """
+        todo = set(shas)
+        packs = self._unindexed_packs()
+        if self._midx is not None and todo:
+            found = self._midx.object_pack_offset_many(todo)
+            todo.difference_update(found)
+            for sha, (pack_id, offset) in sorted(found.iteritems(),
+                                                 key=lambda item: item[1]):
+                pack = self._midx_packs[pack_id]
+                pack.hits += 1
+                type_num, uncomp = pack.get_raw_at(offset)
+                yield sha, type_num, uncomp
+        for pack in packs:
+            if not todo:
+                break
+            found = pack.index.object_index_many(todo)
+            pack.hits += len(found)
+            pack.misses += len(todo) - len(found)
+            todo.difference_update(found)
+            for sha, offset in sorted(found.iteritems(),
+                                      key=lambda item: item[1]):
+                type_num, uncomp = pack.get_raw_at(offset)
+                yield sha, type_num, uncomp
+        for sha in sorted(todo):
+            obj = self._get_loose_object(sha)
+            if obj is not None:
+                todo.remove(sha)
+                yield sha, obj.type_num, obj.as_raw_string()
+        for alternate in self.alternates:
+            if not todo:
+                break
+            found = set()
+            try:
+                for sha, type_num, uncomp in alternate.get_raw_many(todo):
+                    found.add(sha)
+                    yield sha, type_num, uncomp
+            except KeyError:
+                pass
+            todo.difference_update(found)
+        if todo:
+            raise KeyError(sorted(todo)[0])
+
+    def sole_pack(self, wants):
+        """Return the pack holding exactly the objects reachable from wants.
+
+        The pack has to be the only place objects are stored in, and have a
+        reachability bitmap, as that is what tells cheaply whether it holds
+        no objects that are unreachable from wants.
+
+        :param wants: Iterable over hex SHA1s
+        :return: A Pack, or None if there are several packs, loose objects,
+            alternates, no bitmap or unreachable objects
+        """
+        if self.alternates:
+            return None
+        packs = self.packs
+        if len(packs) != 1:
+            return None
+        for sha in self._iter_loose_objects():
+            return None
+        pack = packs[0]
+        bitmap = pack.bitmap
+        if bitmap is None:
+            return None
+        num_objects = len(pack)
+        try:
+            bits = self._walk_bitmap(bitmap, num_objects, wants, 0, set())
+        except KeyError:
+            # History is missing, as in a shallow repository.
+            return None
+        if bits != (1 << num_objects) - 1:
+            return None
+        return pack
+
+    def iter_pack_records(self, shas, remote_has=()):
+        """Generate records for writing a set of objects to a pack.
+
+        Objects that are already stored in a pack have their compressed data
+        copied verbatim, rather than being resolved and recompressed. Stored
+        deltas are reused as long as their base is written before them or
+        is in remote_has.
+
+        :param shas: Iterable over hex SHA1s of the objects to write
+        :param remote_has: Container of hex SHA1s of objects the receiver
+            already has, which may be used as delta bases without being sent
+            (thin pack)
+        :return: Iterator over type_num, object_id, delta_base, raw tuples,
+            suitable for write_pack_data
+        """
+        shas = list(shas)
+        sending = set(shas)
+        todo = set(shas)
+        packs = self.packs
+        packed = []
+        # Offset -> SHA1 of the objects being sent, per pack
+        by_offset = []
+        for pack in packs:
+            offsets = {}
+            if todo:
+                found = pack.index.object_index_many(todo)
+                for sha, offset in found.iteritems():
+                    packed.append((len(by_offset), offset, sha))
+                    offsets[offset] = sha
+                todo.difference_update(offsets.itervalues())
+            by_offset.append(offsets)
+        # Write objects in pack order, so that ofs-delta bases come first.
+        packed.sort()
+        written = set()
+        for i, offset, sha in packed:
+            pack = packs[i]
+            unpacked = pack.data.get_unpacked_object_at(offset,
+                                                        include_comp=True)
+            if unpacked.pack_type_num not in DELTA_TYPES:
+                yield unpacked.pack_type_num, hex_to_sha(sha), None, unpacked
+                written.add(sha)
+                continue
+            if unpacked.pack_type_num == REF_DELTA:
+                base = sha_to_hex(unpacked.delta_base)
+            else:
+                base_offset = offset - unpacked.delta_base
+                base = by_offset[i].get(base_offset)
+                if base is None and remote_has:
+                    try:
+                        base = sha_to_hex(
+                            pack.reverse_index.name_at(base_offset))
+                    except KeyError:
+                        pass
+            if base in written or (base not in sending and base in remote_has):
+                yield (unpacked.pack_type_num, hex_to_sha(sha),
+                       hex_to_sha(base), unpacked)
+            else:
+                type_num, raw = pack.get_raw(sha)
+                yield type_num, hex_to_sha(sha), None, raw
+            written.add(sha)
+        for sha in shas:
+            if sha in todo:
+                type_num, raw = self.get_raw(sha)
+                yield type_num, hex_to_sha(sha), None, raw
+
+    def _bitmap_pack(self):
+        """Return the largest pack that has reachability bitmaps, if any."""
+        best = None
+        for pack in self.packs:
+            if pack.bitmap is not None and (best is None or
+                                            len(pack) > len(best)):
+                best = pack
+        return best
+
+    def _walk_bitmap(self, bitmap, num_objects, roots, bits, others):
+        """Find the objects reachable from a set of roots using bitmaps.
+
+        Objects already in bits or others are considered visited, so their
+        history is not walked again.
+
+        :param bitmap: PackBitmap to use
+        :param num_objects: Number of objects in the pack of the bitmap
+        :param roots: Iterable over hex SHA1s
+        :param bits: Bitmap of the visited objects in the pack
+        :param others: Set of hex SHA1s of visited objects outside the pack,
+            which is updated
+        :return: Bitmap of the visited objects in the pack
+        """
+        # First walk the commits and tags, stopping at commits that have a
+        # bitmap. Trees are only walked once all those bitmaps are in.
+        todo = list(roots)
+        trees = []
+        while todo:
+            sha = todo.pop()
+            try:
+                pos = bitmap.position(sha)
+            except KeyError:
+                if sha in others:
+                    continue
+                others.add(sha)
+            else:
+                if bits & (1 << pos):
+                    continue
+                if sha in bitmap:
+                    bits |= bitmap[sha]
+                    continue
+                bits |= 1 << pos
+            obj = self[sha]
+            if isinstance(obj, Commit):
+                todo.extend(obj.parents)
+                trees.append(obj.tree)
+            elif isinstance(obj, Tag):
+                todo.append(obj.object[1])
+            elif isinstance(obj, Tree):
+                trees.append(sha)
+
+        # Set bits in a byte array, to avoid copying the bitmap for every
+        # object.
+        data = bytearray(_bitmap_to_bytes(bits, (num_objects + 7) // 8))
+
+        def visit(sha):
+            try:
+                pos = bitmap.position(sha)
+            except KeyError:
+                if sha in others:
+                    return False
+                others.add(sha)
+                return True
+            if data[pos >> 3] & (1 << (pos & 7)):
+                return False
+            data[pos >> 3] |= 1 << (pos & 7)
+            return True
+
+        while trees:
+            sha = trees.pop()
+            if not visit(sha):
+                continue
+            for name, mode, entry_sha in self[sha].iteritems():
+                if S_ISGITLINK(mode):
+                    continue
+                if stat.S_ISDIR(mode):
+                    trees.append(entry_sha)
+                else:
+                    visit(entry_sha)
+        return _bitmap_from_bytes(str(data))
+
+    def find_missing_objects_bitmap(self, haves, wants, progress=None,
+                                    get_tagged=None):
+        """Find the missing objects for a set of revisions using bitmaps.
+
+        The objects reachable from haves and from wants are combined from
+        the reachability bitmaps of the largest pack that has them, only
+        walking the history that the bitmaps do not cover. The missing
+        objects are then found with bitwise operations.
+
+        :param haves: Iterable over SHAs already in common.
+        :param wants: Iterable over SHAs of objects to fetch.
+        :param progress: Simple progress function that will be called with
+            updated progress strings.
+        :param get_tagged: Function that returns a dict of pointed-to sha -> tag
+            sha for including tags.
+        :return: A MissingObjects iterator over (sha, path) pairs, or None
+            if this store has no reachability bitmaps
+        """
+        pack = self._bitmap_pack()
+        if pack is None:
+            return None
+        bitmap = pack.bitmap
+        num_objects = len(pack)
+        have_others = set()
+        have_bits = self._walk_bitmap(bitmap, num_objects,
+                                      self.contains_many(haves), 0,
+                                      have_others)
+        want_others = set(have_others)
+        want_bits = self._walk_bitmap(bitmap, num_objects, wants, have_bits,
+                                      want_others)
+        missing = list(bitmap.iter_shas(want_bits & ~have_bits))
+        missing.extend(want_others - have_others)
+        if get_tagged:
+            tagged = get_tagged()
+            for sha in list(missing):
+                tag = tagged.get(sha)
+                if tag is None:
+                    continue
+                try:
+                    pos = bitmap.position(tag)
+                except KeyError:
+                    if tag in want_others:
+                        continue
+                else:
+                    if want_bits & (1 << pos):
+                        continue
+                missing.append(tag)
+        if progress is not None:
+            progress("counting objects: %d, done.\n" % len(missing))
+        return MissingObjects(
+            ((sha, None) for sha in missing),
+            BitmapObjectSet(bitmap, have_bits, have_others))
+
     def add_objects(self, objects):
         """Add a set of objects to this object store.
 
@@ -398,10 +1128,13 @@ class PackBasedObjectStore(BaseObjectStore):
 class DiskObjectStore(PackBasedObjectStore):
     """Git-style object store that exists on disk."""
 
-    def __init__(self, path):
+    def __init__(self, path,
+                 delta_base_cache_size=DEFAULT_DELTA_BASE_CACHE_SIZE):
         """Open an object store.
 
         :param path: Path of the object store.
+        :param delta_base_cache_size: Number of bytes of resolved objects to
+            cache for resolving deltas, shared by all packs
         """
         super(DiskObjectStore, self).__init__()
         self.path = path
@@ -409,17 +1142,37 @@ class DiskObjectStore(PackBasedObjectStore):
         self._pack_cache_time = 0
         self._pack_cache = {}
         self._alternates = None
+        self._delta_base_cache_size = delta_base_cache_size
+        self._delta_base_cache = DeltaBaseCache(delta_base_cache_size)
+        self._commit_graph = None
 
     def __repr__(self):
         return "<%s(%r)>" % (self.__class__.__name__, self.path)
 
+    @classmethod
+    def from_config(cls, path, config):
+        """Open an object store, using the settings in a repository config.
+
+        ``core.deltaBaseCacheLimit`` sets the size of the delta base cache.
+
+        :param path: Path of the object store.
+        :param config: A Config object
+        """
+        delta_base_cache_size = config.get_int(
+            'core', 'deltaBaseCacheLimit', DEFAULT_DELTA_BASE_CACHE_SIZE)
+        return cls(path, delta_base_cache_size=delta_base_cache_size)
+
+    def _open_pack(self, basename):
+        return Pack(basename, delta_base_cache=self._delta_base_cache)
+
     @property
     def alternates(self):
         if self._alternates is not None:
             return self._alternates
         self._alternates = []
         for path in self._read_alternate_paths():
-            self._alternates.append(DiskObjectStore(path))
+            self._alternates.append(DiskObjectStore(path,
+                self._delta_base_cache_size))
         return self._alternates
 
     def _read_alternate_paths(self):
@@ -471,7 +1224,8 @@ class DiskObjectStore(PackBasedObjectStore):
 
         if not os.path.isabs(path):
             path = os.path.join(self.path, path)
-        self.alternates.append(DiskObjectStore(path))
+        self.alternates.append(DiskObjectStore(path,
+            self._delta_base_cache_size))
 
     def _update_pack_cache(self):
         try:
@@ -483,6 +1237,8 @@ class DiskObjectStore(PackBasedObjectStore):
                 return
             raise
         self._pack_cache_time = os.stat(self.pack_dir).st_mtime
+        # The multi-pack index refers to the packs in the cache.
+        self._set_multi_pack_index(None)
         pack_files = set()
         for name in pack_dir_contents:
             # TODO: verify that idx exists first
@@ -492,10 +1248,291 @@ class DiskObjectStore(PackBasedObjectStore):
         # Open newly appeared pack files
         for f in pack_files:
             if f not in self._pack_cache:
-                self._pack_cache[f] = Pack(os.path.join(self.pack_dir, f))
+                self._pack_cache[f] = self._open_pack(
+                    os.path.join(self.pack_dir, f))
         # Remove disappeared pack files
         for f in set(self._pack_cache) - pack_files:
             self._pack_cache.pop(f).close()
+        self._load_multi_pack_index()
+
+    def _load_multi_pack_index(self):
+        path = os.path.join(self.pack_dir, MULTI_PACK_INDEX_FILENAME)
+        try:
+            midx = load_multi_pack_index(path)
+        except (OSError, IOError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            midx = None
+        except AssertionError:
+            # Not a multi-pack index we understand; the pack indexes will do.
+            midx = None
+        self._set_multi_pack_index(midx)
+
+    def write_multi_pack_index(self):
+        """Write a multi-pack index covering all packs in this store.
+
+        Objects that are in several packs are mapped to the most recently
+        modified pack, like C git does.
+
+        :return: The SHA of the multi-pack index file written
+        """
+        self.packs  # Bring the pack cache up to date.
+        packs = []
+        for name, pack in self._pack_cache.iteritems():
+            mtime = os.stat(os.path.join(self.pack_dir,
+                                         name + '.pack')).st_mtime
+            packs.append((-mtime, name, pack))
+        packs.sort()
+        f = GitFile(os.path.join(self.pack_dir, MULTI_PACK_INDEX_FILENAME),
+                    'wb')
+        try:
+            sha = write_multi_pack_index(
+                f, [(name + '.idx', pack.index.iterentries())
+                    for (neg_mtime, name, pack) in packs])
+        finally:
+            f.close()
+        self._load_multi_pack_index()
+        return sha
+
+    def write_bitmap(self, pack, tips=None):
+        """Write reachability bitmaps for a pack.
+
+        Bitmaps are written for the commits in tips and for every
+        BITMAP_COMMIT_INTERVAL-th other commit, newest first. Commits that
+        reach objects outside the pack get no bitmap. Bitmaps are computed
+        parents first, so only the trees a commit adds are walked.
+
+        :param pack: Pack in this store to write bitmaps for
+        :param tips: Iterable over hex SHA1s of the commits that should get a
+            bitmap, such as the targets of all refs; tags are peeled. None
+            for the commits that are not the parent of another commit in the
+            pack
+        :return: The SHA of the bitmap file written
+        """
+        positions = {}
+        offsets = {}
+        type_positions = dict(
+            (cls.type_num, []) for cls in (Commit, Tree, Blob, Tag))
+        commit_shas = []
+        tag_shas = set()
+        for pos, (name, offset, type_num) in enumerate(
+                pack.iter_object_types()):
+            sha = sha_to_hex(name)
+            positions[sha] = pos
+            offsets[sha] = offset
+            type_positions[type_num].append(pos)
+            if type_num == Commit.type_num:
+                commit_shas.append(sha)
+            elif type_num == Tag.type_num:
+                tag_shas.add(sha)
+        size = (len(positions) + 7) // 8
+
+        def get_object(sha):
+            type_num, raw = pack.get_raw_at(offsets[sha])
+            return ShaFile.from_raw_string(type_num, raw, sha)
+
+        commits = {}
+        num_children = {}
+        for sha in commit_shas:
+            commit = get_object(sha)
+            commits[sha] = commit
+            for parent in commit.parents:
+                num_children[parent] = num_children.get(parent, 0) + 1
+        if tips is None:
+            tips = [sha for sha in commits if sha not in num_children]
+        selected = set()
+        for sha in tips:
+            while sha in tag_shas:
+                sha = get_object(sha).object[1]
+            if sha in commits:
+                selected.add(sha)
+        others = sorted((commit for commit in commits.itervalues()
+                         if commit.id not in selected),
+                        key=lambda commit: commit.commit_time, reverse=True)
+        selected.update(commit.id for commit
+                        in others[::BITMAP_COMMIT_INTERVAL])
+
+        # Order the commits parents first.
+        order = []
+        visited = set()
+        for sha in sorted(commits):
+            todo = [(sha, False)]
+            while todo:
+                sha, expanded = todo.pop()
+                if expanded:
+                    order.append(sha)
+                    continue
+                if sha in visited or sha not in commits:
+                    continue
+                visited.add(sha)
+                todo.append((sha, True))
+                todo.extend((parent, False)
+                            for parent in commits[sha].parents)
+
+        def set_bit(data, sha):
+            pos = positions.get(sha)
+            if pos is None:
+                raise KeyError(sha)
+            if data[pos >> 3] & (1 << (pos & 7)):
+                return False
+            data[pos >> 3] |= 1 << (pos & 7)
+            return True
+
+        # Bitmaps of the commits whose children have not all been done yet,
+        # as bytearrays; None for commits that reach objects outside the
+        # pack. The last child to be done takes over the bitmap of its first
+        # parent, so a linear history is walked with a single bytearray.
+        reachable = {}
+        bitmaps = {}
+        for sha in order:
+            commit = commits[sha]
+            data = bytearray(size)
+            for i, parent in enumerate(commit.parents):
+                parent_data = reachable.get(parent)
+                if parent_data is None:
+                    data = None
+                    break
+                if i > 0:
+                    data = bytearray(_bitmap_to_bytes(
+                        _bitmap_from_bytes(str(data)) |
+                        _bitmap_from_bytes(str(parent_data)), size))
+                elif num_children[parent] == 1:
+                    data = reachable.pop(parent)
+                else:
+                    data = bytearray(parent_data)
+            if data is not None:
+                trees = [commit.tree]
+                try:
+                    set_bit(data, sha)
+                    while trees:
+                        tree_sha = trees.pop()
+                        if not set_bit(data, tree_sha):
+                            continue
+                        for name, mode, entry_sha in get_object(
+                                tree_sha).iteritems():
+                            if S_ISGITLINK(mode):
+                                continue
+                            if stat.S_ISDIR(mode):
+                                trees.append(entry_sha)
+                            else:
+                                set_bit(data, entry_sha)
+                except KeyError:
+                    data = None
+            reachable[sha] = data
+            if sha in selected and data is not None:
+                bitmaps[hex_to_sha(sha)] = _bitmap_from_bytes(str(data))
+            for parent in commit.parents:
+                if parent not in num_children:
+                    continue
+                num_children[parent] -= 1
+                if not num_children[parent]:
+                    del num_children[parent]
+                    reachable.pop(parent, None)
+            if sha not in num_children:
+                del reachable[sha]
+
+        type_bitmaps = tuple(
+            bitmap_from_positions(type_positions[cls.type_num])
+            for cls in (Commit, Tree, Blob, Tag))
+        return pack.write_bitmap(type_bitmaps, bitmaps)
+
+    @property
+    def commit_graph(self):
+        """The commit graph of this store, or None if it has none."""
+        if self._commit_graph is None:
+            path = os.path.join(self.path, INFODIR, COMMIT_GRAPH_FILENAME)
+            try:
+                self._commit_graph = load_commit_graph(path)
+            except (OSError, IOError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._commit_graph = False
+            except AssertionError:
+                # Not a commit graph we understand; we can do without.
+                self._commit_graph = False
+        if self._commit_graph is False:
+            return None
+        return self._commit_graph
+
+    def _set_commit_graph(self, commit_graph):
+        if self._commit_graph:
+            self._commit_graph.close()
+        self._commit_graph = commit_graph
+
+    def lookup_commit(self, sha):
+        graph = self.commit_graph
+        if graph is not None:
+            try:
+                return graph[sha]
+            except KeyError:
+                pass
+        return self[sha]
+
+    def write_commit_graph(self, heads):
+        """Write a commit graph for the commits reachable from some heads.
+
+        Commits whose history is incomplete, such as those in a shallow
+        repository, are left out.
+
+        :param heads: Iterable over hex SHA1s of commits or tags, such as
+            the targets of all refs
+        :return: The SHA of the commit-graph file written
+        """
+        commits = {}
+        todo = []
+        for sha in heads:
+            try:
+                obj = self.peel_sha(sha)
+            except KeyError:
+                continue
+            if isinstance(obj, Commit):
+                todo.append(obj.id)
+        while todo:
+            sha = todo.pop()
+            if sha in commits:
+                continue
+            try:
+                commit = self.lookup_commit(sha)
+            except KeyError:
+                commits[sha] = None
+                continue
+            commits[sha] = commit
+            todo.extend(commit.parents)
+
+        # Leave out commits that reach a missing commit.
+        complete = {}
+        for sha in commits:
+            todo = [sha]
+            while todo:
+                sha = todo[-1]
+                if sha in complete:
+                    todo.pop()
+                    continue
+                commit = commits[sha]
+                if commit is None:
+                    complete[sha] = False
+                    todo.pop()
+                    continue
+                pending = [p for p in commit.parents if p not in complete]
+                if pending:
+                    todo.extend(pending)
+                    continue
+                complete[sha] = all(complete[p] for p in commit.parents)
+                todo.pop()
+
+        self._set_commit_graph(None)
+        path = os.path.join(self.path, INFODIR, COMMIT_GRAPH_FILENAME)
+        f = GitFile(path, 'wb')
+        try:
+            return write_commit_graph(
+                f, [commit for (sha, commit) in commits.iteritems()
+                    if complete[sha]])
+        finally:
+            f.close()
+
+    def close(self):
+        super(DiskObjectStore, self).close()
+        self._set_commit_graph(None)
 
     def _pack_cache_stale(self):
         try:
@@ -509,6 +1546,30 @@ class DiskObjectStore(PackBasedObjectStore):
         # Check from object dir
         return hex_to_filename(self.path, sha)
 
+    def contains_loose(self, sha):
+        """Check if a particular object is present by SHA1 and is loose.
+
+        Unlike the default implementation, this only checks whether the
+        file exists rather than reading and parsing the object.
+        """
+        return os.path.exists(self._get_shafile_path(sha))
+
+    def open_loose_object(self, sha):
+        """Open a loose object for reading its compressed contents.
+
+        The object file is returned as it is on disk, without parsing or
+        recompressing the object.
+
+        :param sha: Hex SHA1 of the object
+        :return: File object, or None if the object is not loose
+        """
+        try:
+            return open(self._get_shafile_path(sha), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
     def _iter_loose_objects(self):
         for base in os.listdir(self.path):
             if len(base) != 2:
@@ -580,12 +1641,12 @@ class DiskObjectStore(PackBasedObjectStore):
             index_file.abort()
 
         # Add the pack to the store and return it.
-        final_pack = Pack(pack_base_name)
+        final_pack = self._open_pack(pack_base_name)
         final_pack.check_length_and_checksum()
-        self._add_known_pack(pack_base_name, final_pack)
+        self._add_known_pack(os.path.basename(pack_base_name), final_pack)
         return final_pack
 
-    def add_thin_pack(self, read_all, read_some):
+    def add_thin_pack(self, read_all, read_some, threads=1):
         """Add a new thin pack to this object store.
 
         Thin packs are packs that contain deltas with parents that exist outside
@@ -596,6 +1657,8 @@ class DiskObjectStore(PackBasedObjectStore):
             bytes are read.
         :param read_some: Read function that returns at least one byte, but may
             not return the number of bytes requested.
+        :param threads: Number of threads to index the pack in; None to use
+            one per CPU.
         :return: A Pack object pointing at the now-completed thin pack in the
             objects/pack directory.
         """
@@ -603,7 +1666,11 @@ class DiskObjectStore(PackBasedObjectStore):
         f = os.fdopen(fd, 'w+b')
 
         try:
-            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw)
+            if threads == 1:
+                indexer = PackIndexer(f, resolve_ext_ref=self.get_raw)
+            else:
+                indexer = ParallelPackIndexer(
+                    f, resolve_ext_ref=self.get_raw, threads=threads)
             copier = PackStreamCopier(read_all, read_some, f,
                                       delta_iter=indexer)
             copier.verify()
@@ -611,29 +1678,34 @@ class DiskObjectStore(PackBasedObjectStore):
         finally:
             f.close()
 
-    def move_in_pack(self, path):
+    def move_in_pack(self, path, threads=1):
         """Move a specific file containing a pack into the pack directory.
 
         :note: The file should be on the same file system as the
             packs directory.
 
         :param path: Path to the pack file.
+        :param threads: Number of threads to index the pack in; None to use
+            one per CPU.
         """
         p = PackData(path)
         try:
-            entries = p.sorted_entries()
+            entries = p.sorted_entries(threads=threads)
             basename = os.path.join(self.pack_dir,
                 "pack-%s" % iter_sha1(entry[0] for entry in entries))
             f = GitFile(basename+".idx", "wb")
             try:
                 write_pack_index_v2(f, entries, p.get_stored_checksum())
+                f.flush()
+                os.fsync(f.fileno())
             finally:
                 f.close()
         finally:
             p.close()
         os.rename(path, basename + ".pack")
-        final_pack = Pack(basename)
-        self._add_known_pack(basename, final_pack)
+        _fsync_dir(self.pack_dir)
+        final_pack = self._open_pack(basename)
+        self._add_known_pack(os.path.basename(basename), final_pack)
         return final_pack
 
     def add_pack(self):
@@ -678,6 +1750,267 @@ class DiskObjectStore(PackBasedObjectStore):
         finally:
             f.close()
 
+    def _find_reachable(self, roots, paths=None):
+        """Find the objects reachable from a set of objects.
+
+        Objects that are missing from the store, such as the parents of
+        commits in a shallow repository, are skipped.
+
+        :param roots: Iterable over hex SHA1s
+        :param paths: Optional dict to which the names of the tree entries
+            the reachable trees and blobs were first found at are added
+        :return: Set of hex SHA1s of the objects reachable from roots,
+            including roots
+        """
+        reachable = set()
+        todo = list(roots)
+        while todo:
+            sha = todo.pop()
+            if sha in reachable:
+                continue
+            try:
+                obj = self[sha]
+            except KeyError:
+                continue
+            reachable.add(sha)
+            if isinstance(obj, Commit):
+                todo.append(obj.tree)
+                todo.extend(obj.parents)
+            elif isinstance(obj, Tag):
+                todo.append(obj.object[1])
+            elif isinstance(obj, Tree):
+                for name, mode, entry_sha in obj.iteritems():
+                    if S_ISGITLINK(mode):
+                        continue
+                    if paths is not None:
+                        paths.setdefault(entry_sha, name)
+                    if stat.S_ISDIR(mode):
+                        todo.append(entry_sha)
+                    elif entry_sha not in reachable and entry_sha in self:
+                        # No need to read blobs.
+                        reachable.add(entry_sha)
+        return reachable
+
+    def repack(self, roots=None, grace_period=DEFAULT_PRUNE_GRACE_PERIOD,
+               write_bitmap=False, deltify=None, processes=1):
+        """Repack the objects in this store into a single pack.
+
+        Loose objects and the objects in all packs without a .keep file are
+        written to one new pack, reusing the deltas already stored in the
+        packs. Objects that are not stored as deltas are searched for delta
+        bases among each other, in batches grouped by type and path. Only
+        once the new pack is in place are the
+        old packs and the loose objects removed, so concurrent readers can
+        find every object in either the old or the new pack at all times.
+
+        If roots is given, objects that are not reachable from it are left
+        out. Unreachable objects whose loose object file or pack was last
+        modified less than grace_period seconds ago are kept as loose
+        objects, so that objects that were just added but are not referenced
+        yet survive.
+
+        :param roots: Iterable over hex SHA1s that objects have to be
+            reachable from, such as the targets of all refs; None to keep
+            all objects
+        :param grace_period: Number of seconds to keep unreachable objects
+            for
+        :param write_bitmap: Whether to write reachability bitmaps for the
+            new pack, with bitmaps for the commits in roots
+        :param deltify: Whether to search for new deltas. Defaults to doing
+            so only if the C implementation of create_delta is available.
+        :param processes: Number of processes to search for deltas in; None
+            to use one per CPU
+        :return: The new Pack, or None if no pack was written
+        """
+        self.packs  # Bring the pack cache up to date.
+        kept_packs = []
+        old_packs = []
+        for name, pack in self._pack_cache.iteritems():
+            if os.path.exists(os.path.join(self.pack_dir, name + '.keep')):
+                kept_packs.append(pack)
+            else:
+                old_packs.append((name, pack))
+        paths = {}
+        if roots is None:
+            reachable = None
+        else:
+            reachable = self._find_reachable(roots, paths)
+        expire = time.time() - grace_period
+
+        def is_kept(sha):
+            for pack in kept_packs:
+                if sha in pack:
+                    return True
+            return False
+
+        pack_shas = set()
+        # Unreachable objects from old packs that have to be kept, along with
+        # the modification time of their pack.
+        unpack = {}
+        for name, pack in old_packs:
+            mtime = os.stat(os.path.join(self.pack_dir,
+                                         name + '.pack')).st_mtime
+            for sha in pack:
+                if sha in pack_shas or is_kept(sha):
+                    continue
+                if reachable is None or sha in reachable:
+                    pack_shas.add(sha)
+                elif mtime >= expire:
+                    unpack[sha] = max(mtime, unpack.get(sha, mtime))
+        remove_loose = []
+        for sha in self._iter_loose_objects():
+            if sha in pack_shas or is_kept(sha):
+                remove_loose.append(sha)
+            elif reachable is None or sha in reachable:
+                pack_shas.add(sha)
+                remove_loose.append(sha)
+            elif sha in unpack:
+                # Already loose, so no need to unpack it from a pack.
+                del unpack[sha]
+            elif os.stat(self._get_shafile_path(sha)).st_mtime < expire:
+                remove_loose.append(sha)
+
+        new_pack = self._write_repacked(pack_shas, deltify, paths,
+                                        processes)
+        if write_bitmap and new_pack is not None:
+            self.write_bitmap(new_pack, roots)
+        for sha, mtime in unpack.iteritems():
+            self.add_object(self[sha])
+            os.utime(self._get_shafile_path(sha), (mtime, mtime))
+        self._remove_packs(old_packs, new_pack)
+        for sha in remove_loose:
+            self._remove_loose_object(sha)
+        return new_pack
+
+    def _write_repacked(self, shas, deltify=None, paths=None, processes=1):
+        """Write a set of objects in this store to a new pack.
+
+        Deltas already stored in packs are reused.
+
+        :param shas: Set of hex SHA1s
+        :param deltify: Whether to search for deltas for the other objects;
+            None to do so if the C implementation of create_delta is
+            available
+        :param paths: Optional dict mapping hex SHA1s to paths, used to
+            group objects when searching for deltas
+        :param processes: Number of processes to search for deltas in; None
+            to use one per CPU
+        :return: The new Pack, or None if shas is empty
+        """
+        if not shas:
+            return None
+        if deltify is None:
+            deltify = has_fast_create_delta
+        records = self.iter_pack_records(sorted(shas))
+        if deltify:
+            records = deltify_pack_records(records, paths,
+                                           processes=processes)
+        f, commit, abort = self.add_pack()
+        try:
+            write_pack_data(f, len(shas), records)
+        except:
+            abort()
+            raise
+        else:
+            return commit()
+
+    def _remove_packs(self, packs, new_pack=None):
+        """Remove packs that have been repacked.
+
+        :param packs: List of (name, pack) tuples for the packs to remove,
+            with names as in the pack cache
+        :param new_pack: The pack their objects were written to, which is
+            kept if it has the same name as one of them
+        """
+        # The multi-pack index refers to the old packs.
+        try:
+            os.remove(os.path.join(self.pack_dir, MULTI_PACK_INDEX_FILENAME))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._set_multi_pack_index(None)
+        if new_pack is not None:
+            new_name = 'pack-' + new_pack.name()
+        else:
+            new_name = None
+        for name, pack in packs:
+            pack.close()
+            if name == new_name:
+                # The new pack has the same objects, and took its place.
+                continue
+            del self._pack_cache[name]
+            # Remove the pack file first, as packs are found by their pack
+            # file.
+            os.remove(os.path.join(self.pack_dir, name + '.pack'))
+            os.remove(os.path.join(self.pack_dir, name + '.idx'))
+            try:
+                os.remove(os.path.join(self.pack_dir, name + '.bitmap'))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self._pack_order_stale = True
+        self._pack_filter = None
+
+    def plan_geometric_repack(self, factor=2):
+        """Determine which packs a geometric repack would merge.
+
+        Packs without a .keep file are ordered by number of objects. The
+        largest packs that form a geometric progression, each having at least
+        factor times as many objects as the next smaller one, are left alone.
+        The smaller packs are to be merged, along with any larger packs that
+        would break the progression once they have been merged.
+
+        :param factor: Factor between the sizes of successive packs
+        :return: List of (name, pack) tuples for the packs to merge,
+            smallest first; empty if the packs already form a geometric
+            progression
+        """
+        self.packs  # Bring the pack cache up to date.
+        packs = []
+        for name, pack in self._pack_cache.iteritems():
+            if not os.path.exists(os.path.join(self.pack_dir,
+                                               name + '.keep')):
+                packs.append((len(pack), name, pack))
+        packs.sort()
+        split = 0
+        for i in range(len(packs) - 1, 0, -1):
+            if packs[i][0] < factor * packs[i - 1][0]:
+                # packs[i] is too small to follow packs[i - 1], so both have
+                # to go.
+                split = i + 1
+                break
+        total = sum(num_objects for (num_objects, name, pack)
+                    in packs[:split])
+        for num_objects, name, pack in packs[split:]:
+            if num_objects >= factor * total:
+                break
+            total += num_objects
+            split += 1
+        if split < 2:
+            return []
+        return [(name, pack) for (num_objects, name, pack) in packs[:split]]
+
+    def geometric_repack(self, factor=2):
+        """Merge the smallest packs so that pack sizes grow geometrically.
+
+        This keeps the number of packs logarithmic in the number of objects
+        while only rewriting the smaller packs. All objects in the merged
+        packs are kept; deltas already stored in them are reused. See
+        plan_geometric_repack for which packs are merged.
+
+        :param factor: Factor between the sizes of successive packs
+        :return: The new Pack, or None if no packs had to be merged
+        """
+        packs = self.plan_geometric_repack(factor)
+        if not packs:
+            return None
+        shas = set()
+        for name, pack in packs:
+            shas.update(pack)
+        new_pack = self._write_repacked(shas)
+        self._remove_packs(packs, new_pack)
+        return new_pack
+
     @classmethod
     def init(cls, path):
         try:
@@ -794,7 +2127,7 @@ class MemoryObjectStore(BaseObjectStore):
         pack_sha = new_sha.digest()
         f.write(pack_sha)
 
-    def add_thin_pack(self, read_all, read_some):
+    def add_thin_pack(self, read_all, read_some, threads=1):
         """Add a new thin pack to this object store.
 
         Thin packs are packs that contain deltas with parents that exist outside
@@ -805,10 +2138,16 @@ class MemoryObjectStore(BaseObjectStore):
             bytes are read.
         :param read_some: Read function that returns at least one byte, but may
             not return the number of bytes requested.
+        :param threads: Number of threads to index the pack in; None to use
+            one per CPU.
         """
         f, commit, abort = self.add_pack()
         try:
-            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw)
+            if threads == 1:
+                indexer = PackIndexer(f, resolve_ext_ref=self.get_raw)
+            else:
+                indexer = ParallelPackIndexer(
+                    f, resolve_ext_ref=self.get_raw, threads=threads)
             copier = PackStreamCopier(read_all, read_some, f, delta_iter=indexer)
             copier.verify()
             self._complete_thin_pack(f, indexer)
@@ -859,9 +2198,18 @@ class ObjectStoreIterator(ObjectIterator):
         self._shas = []
 
     def __iter__(self):
-        """Yield tuple with next object and path."""
+        """Yield tuple with next object and path.
+
+        The objects are retrieved with the store's iterobjects_subset, so
+        they are yielded in the order the store can read them in most
+        cheaply rather than in the order of sha_iter.
+        """
+        paths = {}
         for sha, path in self.itershas():
-            yield self.store[sha], path
+            paths.setdefault(sha, []).append(path)
+        for o in self.store.iterobjects_subset(paths):
+            for path in paths[o.id]:
+                yield o, path
 
     def iterobjects(self):
         """Iterate over just the objects."""
@@ -876,6 +2224,41 @@ class ObjectStoreIterator(ObjectIterator):
             self._shas.append(sha)
             yield sha
 
+    def iter_pack_records(self, thin=False, deltify=None, processes=1):
+        """Iterate over records for writing these objects with write_pack_data.
+
+        Data already stored in packs in the underlying store is reused where
+        possible. The objects for which no stored delta can be reused are
+        searched for deltas among each other, grouped by path.
+
+        :param thin: Whether deltas may be written against objects the
+            receiver is known to have, rather than only against objects that
+            are sent as well
+        :param deltify: Whether to search for deltas for the objects that
+            are not sent as stored deltas; None to do so if the C
+            implementation of create_delta is available
+        :param processes: Number of processes to search for deltas in; None
+            to use one per CPU
+        """
+        shas = []
+        paths = {}
+        for sha, path in self.itershas():
+            shas.append(sha)
+            if path is not None:
+                paths.setdefault(sha, path)
+        remote_has = ()
+        if thin:
+            # MissingObjects records the objects the receiver already has
+            # in sha_done, along with everything it has yielded.
+            remote_has = getattr(self.sha_iter, 'sha_done', ())
+        records = self.store.iter_pack_records(shas, remote_has)
+        if deltify is None:
+            deltify = has_fast_create_delta
+        if deltify:
+            records = deltify_pack_records(records, paths,
+                                           processes=processes)
+        return records
+
     def __contains__(self, needle):
         """Check if an object is present.
 
@@ -901,6 +2284,50 @@ class ObjectStoreIterator(ObjectIterator):
         return len(list(self.itershas()))
 
 
+class FullPackIterator(ObjectIterator):
+    """ObjectIterator over all objects in a single pack.
+
+    As the pack holds exactly the objects to send, it can be copied as it
+    is rather than object by object.
+    """
+
+    def __init__(self, pack):
+        """Create a new FullPackIterator.
+
+        :param pack: Pack to iterate over
+        """
+        self.pack = pack
+
+    def __iter__(self):
+        """Yield tuple with next object and path."""
+        for o in self.pack.iterobjects():
+            yield o, None
+
+    def iterobjects(self):
+        """Iterate over just the objects."""
+        return self.pack.iterobjects()
+
+    def itershas(self):
+        """Iterate over the SHAs."""
+        for sha in self.pack:
+            yield sha, None
+
+    def __contains__(self, needle):
+        """Check if an object is present.
+
+        :param needle: SHA1 of the object to check for
+        """
+        return needle in self.pack
+
+    def __getitem__(self, key):
+        """Find an object by SHA1."""
+        return self.pack[key]
+
+    def __len__(self):
+        """Return the number of objects."""
+        return len(self.pack)
+
+
 def tree_lookup_path(lookup_obj, root_sha, path):
     """Look up an object in a Git tree.
 
@@ -986,6 +2413,9 @@ class MissingObjectFinder(object):
         # and such SHAs would get filtered out by _split_commits_and_tags,
         # wants shall list only known SHAs, and otherwise
         # _split_commits_and_tags fails with KeyError
+        # Weed out unknown haves in bulk, rather than one failed lookup at a
+        # time.
+        haves = object_store.contains_many(haves)
         have_commits, have_tags = \
                 _split_commits_and_tags(object_store, haves, True)
         want_commits, want_tags = \
@@ -1009,7 +2439,7 @@ class MissingObjectFinder(object):
         # won't get selected for fetch
         for h in common_commits:
             self.sha_done.add(h)
-            cmt = object_store[h]
+            cmt = object_store.lookup_commit(h)
             _collect_filetree_revs(object_store, cmt.tree, self.sha_done)
         # record tags we have as visited, too
         for t in have_tags:
@@ -1055,6 +2485,62 @@ class MissingObjectFinder(object):
         self.progress("counting objects: %d\r" % len(self.sha_done))
         return (sha, name)
 
+    def __iter__(self):
+        return iter(self.next, None)
+
+
+class BitmapObjectSet(object):
+    """The objects reachable from a set of commits, according to bitmaps.
+
+    :param bitmap: PackBitmap of the pack the bitmap refers to
+    :param bits: Bitmap of the reachable objects in that pack
+    :param others: Set of hex SHA1s of the reachable objects outside it
+    """
+
+    def __init__(self, bitmap, bits, others):
+        self._bitmap = bitmap
+        self._bits = bits
+        self._others = others
+        self._data = None
+
+    def __nonzero__(self):
+        return bool(self._bits or self._others)
+
+    def __contains__(self, sha):
+        if sha in self._others:
+            return True
+        try:
+            pos = self._bitmap.position(sha)
+        except KeyError:
+            return False
+        if self._data is None:
+            self._data = _bitmap_to_bytes(self._bits)
+        if len(self._data) <= pos >> 3:
+            return False
+        return bool(ord(self._data[pos >> 3]) & (1 << (pos & 7)))
+
+
+class MissingObjects(object):
+    """Iterator over the objects missing from another object store.
+
+    Besides iterating over (sha, path) pairs, this has the objects the
+    receiver already has in sha_done, so that they can be used as delta
+    bases in thin packs.
+
+    :param missing: Iterator over (sha, path) pairs
+    :param sha_done: Container of hex SHA1s of the objects the receiver has
+    """
+
+    def __init__(self, missing, sha_done):
+        self._missing = missing
+        self.sha_done = sha_done
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._missing)
+
 
 class ObjectStoreGraphWalker(object):
     """Graph walker that finds what commits are missing from an object store.
@@ -33,11 +33,12 @@ a pointer in to the corresponding packfile.
 from collections import defaultdict
 
 import binascii
+from bisect import bisect_left
+import errno
 from io import BytesIO
 from collections import (
     deque,
     )
-import difflib
 from itertools import (
     chain,
     imap,
@@ -50,14 +51,15 @@ except ImportError:
 else:
     has_mmap = True
 from hashlib import sha1
+import heapq
 import os
 from os import (
-    SEEK_CUR,
     SEEK_END,
     )
 import struct
 from struct import unpack_from
 import sys
+import threading
 import warnings
 import zlib
 
@@ -66,9 +68,6 @@ from dulwich.errors import (
     ChecksumMismatch,
     )
 from dulwich.file import GitFile
-from dulwich.lru_cache import (
-    LRUSizeCache,
-    )
 from dulwich.objects import (
     ShaFile,
     hex_to_sha,
@@ -217,7 +216,9 @@ def read_zlib_chunks(read_some, unpacked, include_comp=False,
         add = read_some(buffer_size)
         if not add:
             raise zlib.error('EOF before end of zlib stream')
-        comp_chunks.append(add)
+        if include_comp:
+            # read_some may hand out buffers that reference a memory map.
+            comp_chunks.append(bytes(add))
         decomp = decomp_obj.decompress(add)
         decomp_len += len(decomp)
         decomp_chunks.append(decomp)
@@ -275,7 +276,8 @@ def _load_file_contents(f, size=None):
         fd = f.fileno()
         if size is None:
             size = os.fstat(fd).st_size
-        if has_mmap:
+        # Empty files can not be mapped.
+        if has_mmap and size > 0:
             try:
                 contents = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
             except mmap.error:
@@ -288,6 +290,53 @@ def _load_file_contents(f, size=None):
     return contents, size
 
 
+def _map_file(f):
+    """Map a file read-only into memory, if possible.
+
+    :param f: File-like object
+    :return: A mmap object, or None if the file can not be mapped (e.g. because
+        it is not backed by a file descriptor or mmap is not available).
+    """
+    if not has_mmap:
+        return None
+    try:
+        fd = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        # Not a real file, e.g. a BytesIO.
+        return None
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+        # Perhaps a socket or an empty file?
+        return None
+
+
+class MappedReader(object):
+    """Read callbacks over a memory-mapped (or in-memory) buffer.
+
+    read() returns a copy of the requested bytes and is meant for small reads
+    such as object headers. read_some() returns buffer objects that reference
+    the underlying memory, so zlib can inflate straight from the map.
+    """
+
+    def __init__(self, contents, offset=0):
+        self._contents = contents
+        self._size = len(contents)
+        self.offset = offset
+
+    def read(self, size):
+        """Read size bytes, returning a copy."""
+        start = self.offset
+        self.offset = min(start + size, self._size)
+        return self._contents[start:self.offset]
+
+    def read_some(self, size):
+        """Read up to size bytes, without copying them."""
+        start = self.offset
+        self.offset = min(start + size, self._size)
+        return buffer(self._contents, start, self.offset - start)
+
+
 def load_pack_index_file(path, f):
     """Load an index file from a file-like object.
 
@@ -330,6 +379,25 @@ def bisect_find_sha(start, end, sha, unpack_name):
     return None
 
 
+def _bisect_left_sha(start, end, sha, unpack_name):
+    """Find the position of the first SHA not less than sha.
+
+    :param start: Start index of range to search
+    :param end: End index of range to search (exclusive)
+    :param sha: Sha to find
+    :param unpack_name: Callback to retrieve SHA by index
+    :return: Index of the first entry in [start, end) that is not less than
+        sha, or end if there is no such entry
+    """
+    while start < end:
+        i = (start + end) // 2
+        if unpack_name(i) < sha:
+            start = i + 1
+        else:
+            end = i
+    return start
+
+
 class PackIndex(object):
     """An index in to a packfile.
 
@@ -391,6 +459,40 @@ class PackIndex(object):
         """
         raise NotImplementedError(self._object_index)
 
+    def object_index_many(self, shas):
+        """Return the offsets in the corresponding packfile for many objects.
+
+        This is considerably cheaper than calling object_index for each SHA
+        when looking up large sets of SHAs.
+
+        :param shas: Iterable over hex or binary SHAs
+        :return: Dictionary mapping the SHAs that are present in this index (as
+            they were passed in) to their offsets. Absent SHAs are left out.
+        """
+        by_bin_sha = {}
+        for sha in shas:
+            if len(sha) == 40:
+                by_bin_sha[hex_to_sha(sha)] = sha
+            else:
+                by_bin_sha[sha] = sha
+        ret = {}
+        for bin_sha, offset in self._object_index_many(sorted(by_bin_sha)):
+            ret[by_bin_sha[bin_sha]] = offset
+        return ret
+
+    def _object_index_many(self, shas):
+        """See object_index_many.
+
+        :param shas: Sorted list of *binary* SHAs
+        :return: Iterator over (sha, offset) tuples for the SHAs that are
+            present in this index
+        """
+        for sha in shas:
+            try:
+                yield sha, self._object_index(sha)
+            except KeyError:
+                pass
+
     def objects_sha1(self):
         """Return the hex SHA1 over all the shas of all objects in this pack.
 
@@ -425,7 +527,7 @@ class MemoryPackIndex(PackIndex):
         return len(self._entries)
 
     def _object_index(self, sha):
-        return self._by_sha[sha][0]
+        return self._by_sha[sha]
 
     def _itersha(self):
         return iter(self._by_sha)
@@ -514,11 +616,7 @@ class FilePackIndex(PackIndex):
             yield self._unpack_entry(i)
 
     def _read_fan_out_table(self, start_offset):
-        ret = []
-        for i in range(0x100):
-            fanout_entry = self._contents[start_offset+i*4:start_offset+(i+1)*4]
-            ret.append(struct.unpack('>L', fanout_entry)[0])
-        return ret
+        return list(unpack_from('>256L', self._contents, start_offset))
 
     def check(self):
         """Check that the stored checksum matches the actual checksum."""
@@ -565,6 +663,32 @@ class FilePackIndex(PackIndex):
             raise KeyError(sha)
         return self._unpack_offset(i)
 
+    def _object_index_many(self, shas):
+        """See object_index_many.
+
+        As the SHAs are sorted, each lookup only has to consider the part of
+        its fan-out bucket that follows the previous match.
+
+        :param shas: Sorted list of *binary* SHAs
+        """
+        fan_out_table = self._fan_out_table
+        unpack_name = self._unpack_name
+        bucket = None
+        for sha in shas:
+            assert len(sha) == 20
+            idx = ord(sha[0])
+            if idx != bucket:
+                bucket = idx
+                if idx == 0:
+                    start = 0
+                else:
+                    start = fan_out_table[idx-1]
+                end = fan_out_table[idx]
+            start = _bisect_left_sha(start, end, sha, unpack_name)
+            if start < end and unpack_name(start) == sha:
+                yield sha, self._unpack_offset(start)
+                start += 1
+
 
 class PackIndex1(FilePackIndex):
     """Version 1 Pack Index file."""
@@ -631,6 +755,267 @@ class PackIndex2(FilePackIndex):
                           self._crc32_table_offset + i * 4)[0]
 
 
+MULTI_PACK_INDEX_FILENAME = 'multi-pack-index'
+
+MIDX_SIGNATURE = 'MIDX'
+MIDX_CHUNK_PACKNAMES = 'PNAM'
+MIDX_CHUNK_OIDFANOUT = 'OIDF'
+MIDX_CHUNK_OIDLOOKUP = 'OIDL'
+MIDX_CHUNK_OBJECTOFFSETS = 'OOFF'
+MIDX_CHUNK_LARGEOFFSETS = 'LOFF'
+
+
+def _read_chunk_table(contents, size, offset, num_chunks):
+    """Read the chunk lookup table of a chunk-based file format.
+
+    The table has an entry with the id and offset of every chunk, followed
+    by one pointing past the last chunk.
+
+    :param contents: Contents of the file
+    :param size: Size of the file
+    :param offset: Offset of the chunk lookup table
+    :param num_chunks: Number of chunks
+    :return: Dictionary mapping chunk ids to (start, end) tuples
+    :raise AssertionError: if the table or a chunk is not within the file
+    """
+    table_end = offset + (num_chunks + 1) * 12
+    if table_end > size:
+        raise AssertionError('Chunk lookup table is truncated')
+    entries = [unpack_from('>4sQ', contents, offset + i * 12)
+               for i in range(num_chunks + 1)]
+    chunks = {}
+    for (chunk_id, start), (unused_id, end) in zip(entries, entries[1:]):
+        if not table_end <= start <= end <= size:
+            raise AssertionError('%s chunk is not within the file' % chunk_id)
+        chunks[chunk_id] = (start, end)
+    return chunks
+
+
+def _check_chunk_size(chunks, chunk_id, size):
+    """Check that a chunk is at least of a given size.
+
+    :param chunks: Dictionary as returned by _read_chunk_table
+    :param chunk_id: Id of the chunk
+    :param size: Minimum size of the chunk
+    :return: Offset of the chunk
+    :raise AssertionError: if the chunk is missing or too small
+    """
+    if chunk_id not in chunks:
+        raise AssertionError('Missing %s chunk' % chunk_id)
+    start, end = chunks[chunk_id]
+    if end - start < size:
+        raise AssertionError('%s chunk is truncated' % chunk_id)
+    return start
+
+
+def load_multi_pack_index(path):
+    """Load a multi-pack index file by path.
+
+    :param path: Path to the multi-pack-index file
+    :return: A MultiPackIndex
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return MultiPackIndex(path, file=f)
+    except:
+        f.close()
+        raise
+
+
+class MultiPackIndex(object):
+    """A multi-pack index, mapping objects to their pack and offset.
+
+    The file format is that of git's multi-pack-index file (version 1, with
+    SHA-1 object names): a list of pack index names, a fan-out table and
+    the sorted object names, followed by the pack and offset of every
+    object. Packs are referred to by their position in the list of pack
+    names.
+    """
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        """Create a multi-pack index object.
+
+        :param filename: Path to the multi-pack-index file
+        :param file: Optional file-like object to read from
+        :param contents: Optional contents of the file
+        :param size: Optional size of the file
+        """
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            if size is None:
+                size = len(contents)
+            self._contents, self._size = (contents, size)
+        if self._size < 12:
+            raise AssertionError('Multi-pack index file is truncated')
+        (signature, version, oid_version, num_chunks, num_base_files,
+         num_packs) = unpack_from('>4sBBBBL', self._contents, 0)
+        if signature != MIDX_SIGNATURE:
+            raise AssertionError('Not a multi-pack index file')
+        if version != 1:
+            raise AssertionError('Version was %d' % version)
+        if oid_version != 1:
+            raise AssertionError('Unsupported object id version %d' %
+                                 oid_version)
+        if num_base_files != 0:
+            raise AssertionError('Incremental multi-pack indexes are not '
+                                 'supported')
+        chunks = _read_chunk_table(self._contents, self._size, 12, num_chunks)
+        names_offset = _check_chunk_size(chunks, MIDX_CHUNK_PACKNAMES, 0)
+        names_end = chunks[MIDX_CHUNK_PACKNAMES][1]
+        self._pack_names = []
+        for i in range(num_packs):
+            end = self._contents.find('\0', names_offset, names_end)
+            if end == -1:
+                raise AssertionError('%s chunk is truncated' %
+                                     MIDX_CHUNK_PACKNAMES)
+            self._pack_names.append(self._contents[names_offset:end])
+            names_offset = end + 1
+        self._fan_out_table = list(unpack_from(
+            '>256L', self._contents,
+            _check_chunk_size(chunks, MIDX_CHUNK_OIDFANOUT, 256 * 4)))
+        num_objects = self._fan_out_table[-1]
+        self._name_table_offset = _check_chunk_size(
+            chunks, MIDX_CHUNK_OIDLOOKUP, num_objects * 20)
+        self._offset_table_offset = _check_chunk_size(
+            chunks, MIDX_CHUNK_OBJECTOFFSETS, num_objects * 8)
+        self._large_offset_table_offset = chunks.get(
+            MIDX_CHUNK_LARGEOFFSETS, (None, None))[0]
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, "close", None) is not None:
+            self._contents.close()
+
+    @property
+    def pack_names(self):
+        """Names of the pack indexes covered, e.g. "pack-<sha>.idx"."""
+        return list(self._pack_names)
+
+    def __len__(self):
+        """Return the number of objects in this multi-pack index."""
+        return self._fan_out_table[-1]
+
+    def __iter__(self):
+        """Iterate over the SHAs in this multi-pack index."""
+        return imap(sha_to_hex, self._itersha())
+
+    def __contains__(self, sha):
+        """Check whether an object is in this multi-pack index."""
+        try:
+            self.object_pack_offset(sha)
+        except KeyError:
+            return False
+        return True
+
+    def _itersha(self):
+        for i in range(len(self)):
+            yield self._unpack_name(i)
+
+    def _unpack_name(self, i):
+        offset = self._name_table_offset + i * 20
+        return self._contents[offset:offset+20]
+
+    def _unpack_pack_offset(self, i):
+        pack_id, offset = unpack_from('>LL', self._contents,
+                                      self._offset_table_offset + i * 8)
+        if offset & (2**31):
+            offset = unpack_from('>Q', self._contents,
+                                 self._large_offset_table_offset +
+                                 (offset & (2**31-1)) * 8)[0]
+        return pack_id, offset
+
+    def iterentries(self):
+        """Iterate over the entries in this multi-pack index.
+
+        :return: iterator over tuples with object name, index of the pack in
+            pack_names and offset in that pack.
+        """
+        for i in range(len(self)):
+            pack_id, offset = self._unpack_pack_offset(i)
+            yield self._unpack_name(i), pack_id, offset
+
+    def object_pack_offset(self, sha):
+        """Return the pack and offset of an object.
+
+        :param sha: Hex or binary SHA of the object
+        :return: Tuple with the index of the pack in pack_names and the offset
+            of the object in that pack
+        :raise KeyError: if the object is not in this multi-pack index
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        assert len(sha) == 20
+        idx = ord(sha[0])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        i = bisect_find_sha(start, end, sha, self._unpack_name)
+        if i is None:
+            raise KeyError(sha)
+        return self._unpack_pack_offset(i)
+
+    def object_pack_offset_many(self, shas):
+        """Return the packs and offsets of many objects.
+
+        :param shas: Iterable over hex or binary SHAs
+        :return: Dictionary mapping the SHAs that are present (as they were
+            passed in) to tuples with pack index and offset
+        """
+        by_bin_sha = {}
+        for sha in shas:
+            if len(sha) == 40:
+                by_bin_sha[hex_to_sha(sha)] = sha
+            else:
+                by_bin_sha[sha] = sha
+        fan_out_table = self._fan_out_table
+        unpack_name = self._unpack_name
+        ret = {}
+        bucket = None
+        for sha in sorted(by_bin_sha):
+            idx = ord(sha[0])
+            if idx != bucket:
+                bucket = idx
+                if idx == 0:
+                    start = 0
+                else:
+                    start = fan_out_table[idx-1]
+                end = fan_out_table[idx]
+            start = _bisect_left_sha(start, end, sha, unpack_name)
+            if start < end and unpack_name(start) == sha:
+                ret[by_bin_sha[sha]] = self._unpack_pack_offset(start)
+                start += 1
+        return ret
+
+    def check(self):
+        """Check that the stored checksum matches the actual checksum."""
+        actual = self.calculate_checksum()
+        stored = self.get_stored_checksum()
+        if actual != stored:
+            raise ChecksumMismatch(stored, actual)
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over this multi-pack index.
+
+        :return: This is a 20-byte binary digest
+        """
+        return sha1(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored for this multi-pack index.
+
+        :return: 20-byte binary digest
+        """
+        return str(self._contents[-20:])
+
+
 def read_pack_header(read):
     """Read the header of a pack file.
 
@@ -654,6 +1039,45 @@ def chunks_length(chunks):
     return sum(imap(len, chunks))
 
 
+def unpack_object_header(read_all, crc32=None):
+    """Read the header of a Git object in a pack.
+
+    :param read_all: Read function that blocks until the number of requested
+        bytes are read.
+    :param crc32: CRC32 to update with the header, or None
+    :return: Tuple with type num, delta base (the relative offset of the base
+        for OFS_DELTA, the binary SHA1 of the base for REF_DELTA, None
+        otherwise), uncompressed size and updated CRC32
+    """
+    return _unpack_object_header(read_all, crc32, take_msb_bytes)
+
+
+def _unpack_object_header(read_all, crc32, take_msb_bytes):
+    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+    type_num = (bytes[0] >> 4) & 0x07
+    size = bytes[0] & 0x0f
+    for i, byte in enumerate(bytes[1:]):
+        size += (byte & 0x7f) << ((i * 7) + 4)
+
+    if type_num == OFS_DELTA:
+        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+        if bytes[-1] & 0x80:
+            raise AssertionError
+        delta_base_offset = bytes[0] & 0x7f
+        for byte in bytes[1:]:
+            delta_base_offset += 1
+            delta_base_offset <<= 7
+            delta_base_offset += (byte & 0x7f)
+        delta_base = delta_base_offset
+    elif type_num == REF_DELTA:
+        delta_base = read_all(20)
+        if crc32 is not None:
+            crc32 = binascii.crc32(delta_base, crc32)
+    else:
+        delta_base = None
+    return type_num, delta_base, size, crc32
+
+
 def unpack_object(read_all, read_some=None, compute_crc32=False,
                   include_comp=False, zlib_bufsize=_ZLIB_BUFSIZE):
     """Unpack a Git object.
@@ -685,44 +1109,113 @@ def unpack_object(read_all, read_some=None, compute_crc32=False,
     else:
         crc32 = None
 
-    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-    type_num = (bytes[0] >> 4) & 0x07
-    size = bytes[0] & 0x0f
-    for i, byte in enumerate(bytes[1:]):
-        size += (byte & 0x7f) << ((i * 7) + 4)
-
-    raw_base = len(bytes)
-    if type_num == OFS_DELTA:
-        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-        raw_base += len(bytes)
-        if bytes[-1] & 0x80:
-            raise AssertionError
-        delta_base_offset = bytes[0] & 0x7f
-        for byte in bytes[1:]:
-            delta_base_offset += 1
-            delta_base_offset <<= 7
-            delta_base_offset += (byte & 0x7f)
-        delta_base = delta_base_offset
-    elif type_num == REF_DELTA:
-        delta_base = read_all(20)
-        if compute_crc32:
-            crc32 = binascii.crc32(delta_base, crc32)
-        raw_base += 20
-    else:
-        delta_base = None
-
+    # Use the Python helpers explicitly: take_msb_bytes and read_zlib_chunks
+    # are replaced by their C versions below, along with this function.
+    type_num, delta_base, size, crc32 = _unpack_object_header(
+        read_all, crc32, _take_msb_bytes_py)
     unpacked = UnpackedObject(type_num, delta_base, size, crc32)
-    unused = read_zlib_chunks(read_some, unpacked, buffer_size=zlib_bufsize,
-                              include_comp=include_comp)
+    unused = _read_zlib_chunks_py(read_some, unpacked,
+                                  buffer_size=zlib_bufsize,
+                                  include_comp=include_comp)
     return unpacked, unused
 
 
-def _compute_object_size(value):
-    """Compute the size of a unresolved object for use with LRUSizeCache."""
-    (num, obj) = value
-    if num in DELTA_TYPES:
-        return chunks_length(obj[1])
-    return chunks_length(obj)
+DEFAULT_DELTA_BASE_CACHE_SIZE = 20 * 1024 * 1024
+
+
+class DeltaBaseCache(object):
+    """Cache of resolved pack objects, keyed by pack and offset.
+
+    Each entry records the cost of recreating it: the number of bytes
+    inflated and produced by applying deltas along its delta chain. When the
+    cache is full, the entries that are cheapest to recreate per byte of
+    cache space are evicted first (the GreedyDual-Size policy), so the
+    intermediate results of long delta chains outlive plain bases of the same
+    size. Entries that are hit are renewed, and entries that are not hit
+    age, so an expensive entry does not stay around forever.
+    """
+
+    def __init__(self, max_size=DEFAULT_DELTA_BASE_CACHE_SIZE):
+        """Create a new DeltaBaseCache.
+
+        :param max_size: Maximum number of bytes of object data to store
+        """
+        self._max_size = max_size
+        self._size = 0
+        # Priority of the last evicted entry, added to the priority of new
+        # and renewed entries so that entries that are not hit age.
+        self._inflation = 0.0
+        self._entries = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _push(self, key, entry):
+        # entry is [priority, value, size, cost]
+        entry[0] = self._inflation + float(entry[3]) / max(entry[2], 1)
+        heapq.heappush(self._heap, (entry[0], key))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # Drop the stale heap items left behind by renewed entries.
+            self._heap = [(e[0], k) for (k, e) in self._entries.iteritems()]
+            heapq.heapify(self._heap)
+
+    def __getitem__(self, key):
+        """Look up a resolved object, renewing it.
+
+        :return: Tuple with type num and chunks
+        :raise KeyError: if the object is not cached
+        """
+        entry = self._entries[key]
+        self._push(key, entry)
+        return entry[1]
+
+    def get_cost(self, key, default=None):
+        """Return the cost of recreating a cached object."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        return entry[3]
+
+    def add(self, key, value, cost):
+        """Add a resolved object to the cache.
+
+        :param key: Key of the object, e.g. a (pack, offset) tuple
+        :param value: Tuple with type num and chunks
+        :param cost: Number of bytes processed to resolve the object
+        """
+        size = chunks_length(value[1])
+        if size > self._max_size:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old[2]
+        entry = [None, value, size, cost]
+        self._entries[key] = entry
+        self._size += size
+        self._push(key, entry)
+        while self._size > self._max_size:
+            self._evict()
+
+    def _evict(self):
+        while True:
+            (priority, key) = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == priority:
+                break
+        del self._entries[key]
+        self._size -= entry[2]
+        self._inflation = priority
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        self._size = 0
+        self._inflation = 0.0
+        self._entries = {}
+        self._heap = []
 
 
 class PackStreamReader(object):
@@ -949,23 +1442,30 @@ class PackData(object):
     For the complete objects the data is stored as zlib deflated data.
     The size in the header is the uncompressed object size, so to uncompress
     you need to just keep feeding data to zlib until you get an object back,
-    or it errors on bad data. This is done here by just giving the complete
-    buffer from the start of the deflated object on. This is bad, but until I
-    get mmap sorted out it will have to do.
+    or it errors on bad data. When the pack file can be memory-mapped, zlib is
+    fed directly from the map; otherwise the data is read through the file
+    object.
 
     Currently there are no integrity checks done. Also no attempt is made to
     try and detect the delta case, or a request for an object at the wrong
     position.  It will all just throw a zlib or KeyError.
     """
 
-    def __init__(self, filename, file=None, size=None):
+    def __init__(self, filename, file=None, size=None,
+                 delta_base_cache_size=DEFAULT_DELTA_BASE_CACHE_SIZE,
+                 delta_base_cache=None):
         """Create a PackData object representing the pack in the given filename.
 
         The file must exist and stay readable until the object is disposed of. It
-        must also stay the same size. It will be mapped whenever needed.
-
-        Currently there is a restriction on the size of the pack as the python
-        mmap implementation is flawed.
+        must also stay the same size. If possible, it is mapped into memory.
+
+        :param filename: Path to the pack file
+        :param file: Optional file-like object to read from
+        :param size: Optional size of the pack file
+        :param delta_base_cache_size: Number of bytes of resolved objects to
+            keep around for resolving deltas against them
+        :param delta_base_cache: Optional DeltaBaseCache to share with other
+            packs, in which case delta_base_cache_size is ignored
         """
         self._filename = filename
         self._size = size
@@ -975,8 +1475,13 @@ class PackData(object):
         else:
             self._file = file
         (version, self._num_objects) = read_pack_header(self._file.read)
-        self._offset_cache = LRUSizeCache(1024*1024*20,
-            compute_size=_compute_object_size)
+        self._contents = _map_file(self._file)
+        if delta_base_cache is None:
+            delta_base_cache = DeltaBaseCache(delta_base_cache_size)
+        self._delta_base_cache = delta_base_cache
+        # Identifies this pack in the delta base cache, without keeping it
+        # alive.
+        self._cache_key = object()
         self.pack = None
 
     @property
@@ -992,6 +1497,9 @@ class PackData(object):
         return cls(filename=path)
 
     def close(self):
+        if self._contents is not None:
+            self._contents.close()
+            self._contents = None
         self._file.close()
 
     def _get_size(self):
@@ -1013,6 +1521,9 @@ class PackData(object):
 
         :return: 20-byte binary SHA1 digest
         """
+        if self._contents is not None:
+            return sha1(
+                buffer(self._contents, 0, len(self._contents) - 20)).digest()
         return compute_file_sha(self._file, end_ofs=-20).digest()
 
     def get_ref(self, sha):
@@ -1035,6 +1546,11 @@ class PackData(object):
     def resolve_object(self, offset, type, obj, get_ref=None):
         """Resolve an object, possibly resolving deltas when necessary.
 
+        The delta chain is followed down to a cached or undeltified object,
+        and the deltas are then applied from the bottom up. The base and all
+        intermediate results are added to the delta base cache, so that
+        neighbouring objects in the same chain are cheap to resolve.
+
         :return: Tuple with object type and contents.
         """
         if type not in DELTA_TYPES:
@@ -1042,78 +1558,117 @@ class PackData(object):
 
         if get_ref is None:
             get_ref = self.get_ref
-        if type == OFS_DELTA:
-            (delta_offset, delta) = obj
-            # TODO: clean up asserts and replace with nicer error messages
-            assert isinstance(offset, int) or isinstance(offset, long)
-            assert isinstance(delta_offset, int) or isinstance(offset, long)
-            base_offset = offset-delta_offset
-            type, base_obj = self.get_object_at(base_offset)
-            assert isinstance(type, int)
-        elif type == REF_DELTA:
-            (basename, delta) = obj
-            assert isinstance(basename, str) and len(basename) == 20
-            base_offset, type, base_obj = get_ref(basename)
+        chain = []
+        while type in DELTA_TYPES:
+            if type == OFS_DELTA:
+                (delta_offset, delta) = obj
+                # TODO: clean up asserts and replace with nicer error messages
+                assert isinstance(offset, (int, long))
+                assert isinstance(delta_offset, (int, long))
+                base_offset = offset - delta_offset
+                type, obj = self.get_object_at(base_offset)
+            elif type == REF_DELTA:
+                (basename, delta) = obj
+                assert isinstance(basename, str) and len(basename) == 20
+                base_offset, type, obj = get_ref(basename)
             assert isinstance(type, int)
-        type, base_chunks = self.resolve_object(base_offset, type, base_obj)
-        chunks = apply_delta(base_chunks, delta)
-        # TODO(dborowitz): This can result in poor performance if large base
-        # objects are separated from deltas in the pack. We should reorganize
-        # so that we apply deltas to all objects in a chain one after the other
-        # to optimize cache performance.
-        if offset is not None:
-            self._offset_cache[offset] = type, chunks
+            chain.append((offset, delta))
+            offset = base_offset
+
+        chunks = obj
+        cache_key = self._cache_key
+        cost = self._delta_base_cache.get_cost((cache_key, offset))
+        if cost is None:
+            cost = chunks_length(chunks)
+            if offset is not None:
+                self._delta_base_cache.add(
+                    (cache_key, offset), (type, chunks), cost)
+        for offset, delta in reversed(chain):
+            chunks = apply_delta(chunks, delta)
+            cost += chunks_length(delta) + chunks_length(chunks)
+            if offset is not None:
+                self._delta_base_cache.add(
+                    (cache_key, offset), (type, chunks), cost)
         return type, chunks
 
+    def _unpack_object_at(self, offset, compute_crc32=False,
+                          include_comp=False):
+        """Unpack the raw object stored at a particular offset.
+
+        :param offset: Offset of the object in the pack
+        :param compute_crc32: If True, compute the CRC32 of the compressed data
+        :param include_comp: If True, include compressed data in the result
+        :return: Tuple with UnpackedObject (with offset set) and the offset of
+            the next object in the pack.
+        """
+        if self._contents is not None:
+            reader = MappedReader(self._contents, offset)
+            unpacked, unused = unpack_object(
+              reader.read, read_some=reader.read_some,
+              compute_crc32=compute_crc32, include_comp=include_comp)
+            end = reader.offset - len(unused)
+        else:
+            self._file.seek(offset)
+            unpacked, unused = unpack_object(
+              self._file.read, compute_crc32=compute_crc32,
+              include_comp=include_comp)
+            end = self._file.tell() - len(unused)
+        unpacked.offset = offset
+        return unpacked, end
+
     def iterobjects(self, progress=None, compute_crc32=True):
-        self._file.seek(self._header_size)
+        offset = self._header_size
         for i in xrange(1, self._num_objects + 1):
-            offset = self._file.tell()
-            unpacked, unused = unpack_object(
-              self._file.read, compute_crc32=compute_crc32)
+            unpacked, next_offset = self._unpack_object_at(
+              offset, compute_crc32=compute_crc32)
             if progress is not None:
                 progress(i, self._num_objects)
             yield (offset, unpacked.pack_type_num, unpacked._obj(),
                    unpacked.crc32)
-            self._file.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
+            offset = next_offset
 
     def _iter_unpacked(self):
         # TODO(dborowitz): Merge this with iterobjects, if we can change its
         # return type.
-        self._file.seek(self._header_size)
+        offset = self._header_size
         for _ in xrange(self._num_objects):
-            offset = self._file.tell()
-            unpacked, unused = unpack_object(
-              self._file.read, compute_crc32=False)
-            unpacked.offset = offset
+            unpacked, offset = self._unpack_object_at(offset)
             yield unpacked
-            self._file.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
 
-    def iterentries(self, progress=None):
+    def iterentries(self, progress=None, threads=1):
         """Yield entries summarizing the contents of this pack.
 
         :param progress: Progress function, called with current and total
             object count.
+        :param threads: Number of threads to resolve deltas in; None to use
+            one per CPU. With more than one thread, entries are yielded in
+            no particular order.
         :return: iterator of tuples with (sha, offset, crc32)
         """
         num_objects = self._num_objects
         resolve_ext_ref = (
             self.pack.resolve_ext_ref if self.pack is not None else None)
-        indexer = PackIndexer.for_pack_data(
-            self, resolve_ext_ref=resolve_ext_ref)
+        if threads == 1:
+            indexer = PackIndexer.for_pack_data(
+                self, resolve_ext_ref=resolve_ext_ref)
+        else:
+            indexer = ParallelPackIndexer.for_pack_data(
+                self, resolve_ext_ref=resolve_ext_ref, threads=threads)
         for i, result in enumerate(indexer):
             if progress is not None:
                 progress(i, num_objects)
             yield result
 
-    def sorted_entries(self, progress=None):
+    def sorted_entries(self, progress=None, threads=1):
         """Return entries in this pack, sorted by SHA.
 
         :param progress: Progress function, called with current and total
             object count
+        :param threads: Number of threads to resolve deltas in; None to use
+            one per CPU
         :return: List of tuples with (sha, offset, crc32)
         """
-        ret = list(self.iterentries(progress=progress))
+        ret = list(self.iterentries(progress=progress, threads=threads))
         ret.sort()
         return ret
 
@@ -1162,6 +1717,8 @@ class PackData(object):
 
     def get_stored_checksum(self):
         """Return the expected checksum stored in this pack."""
+        if self._contents is not None:
+            return self._contents[-20:]
         self._file.seek(-20, SEEK_END)
         return self._file.read(20)
 
@@ -1180,23 +1737,74 @@ class PackData(object):
         function.
         """
         try:
-            return self._offset_cache[offset]
+            return self._delta_base_cache[(self._cache_key, offset)]
         except KeyError:
             pass
         assert isinstance(offset, long) or isinstance(offset, int),\
                 'offset was %r' % offset
         assert offset >= self._header_size
-        self._file.seek(offset)
-        unpacked, _ = unpack_object(self._file.read)
+        unpacked, _ = self._unpack_object_at(offset)
         return (unpacked.pack_type_num, unpacked._obj())
 
+    def iter_chunks(self, chunk_size=65515):
+        """Iterate over the raw contents of the pack file.
+
+        :param chunk_size: Maximum size of the chunks to return
+        :return: Iterator over strings, including the header and the trailing
+            checksum
+        """
+        size = self._get_size()
+        if self._contents is not None:
+            for offset in xrange(0, size, chunk_size):
+                yield self._contents[offset:offset + chunk_size]
+            return
+        self._file.seek(0)
+        todo = size
+        while todo > 0:
+            data = self._file.read(min(todo, chunk_size))
+            if not data:
+                raise AssertionError('Pack file truncated')
+            todo -= len(data)
+            yield data
+
+    def get_object_header_at(self, offset):
+        """Read the header of the object stored at an offset.
+
+        Unlike get_unpacked_object_at, this does not inflate the object.
+
+        :param offset: Offset of the object in the pack
+        :return: Tuple with pack type num and delta base: the offset of the
+            base for OFS_DELTA, the binary SHA1 of the base for REF_DELTA and
+            None otherwise
+        """
+        if self._contents is not None:
+            read = MappedReader(self._contents, offset).read
+        else:
+            self._file.seek(offset)
+            read = self._file.read
+        type_num, delta_base, size, crc32 = unpack_object_header(read)
+        if type_num == OFS_DELTA:
+            delta_base = offset - delta_base
+        return type_num, delta_base
+
+    def get_unpacked_object_at(self, offset, include_comp=False):
+        """Return the object stored at an offset, without resolving deltas.
+
+        :param offset: Offset of the object in the pack
+        :param include_comp: If True, include compressed data in the result
+        :return: UnpackedObject with offset set
+        """
+        unpacked, _ = self._unpack_object_at(offset, include_comp=include_comp)
+        return unpacked
+
 
 class DeltaChainIterator(object):
     """Abstract iterator over pack data based on delta chains.
 
     Each object in the pack is guaranteed to be inflated exactly once,
-    regardless of how many objects reference it as a delta base. As a result,
-    memory usage is proportional to the length of the longest delta chain.
+    regardless of how many objects reference it as a delta base. A base is
+    only kept until the last delta against it has been resolved, so memory
+    usage is proportional to the length of the longest delta chain.
 
     Subclasses can override _result to define the result type of the iterator.
     By default, results are UnpackedObjects with the following members set:
@@ -1210,6 +1818,10 @@ class DeltaChainIterator(object):
     * decomp_chunks
     * decomp_len
     * crc32          (if _compute_crc32 is True)
+
+    While iterating, peak_base_size records the largest number of bytes of
+    delta bases held at once, and peak_stack_size the largest number of
+    objects waiting for their base to be resolved.
     """
 
     _compute_crc32 = False
@@ -1217,12 +1829,16 @@ class DeltaChainIterator(object):
 
     def __init__(self, file_obj, resolve_ext_ref=None):
         self._file = file_obj
+        self._pack_data = None
         self._resolve_ext_ref = resolve_ext_ref
         self._pending_ofs = defaultdict(list)
         self._pending_ref = defaultdict(list)
         self._full_ofs = []
         self._shas = {}
         self._ext_refs = []
+        self._base_size = 0
+        self.peak_base_size = 0
+        self.peak_stack_size = 0
 
     @classmethod
     def for_pack_data(cls, pack_data, resolve_ext_ref=None):
@@ -1245,6 +1861,7 @@ class DeltaChainIterator(object):
 
     def set_pack_data(self, pack_data):
         self._file = pack_data._file
+        self._pack_data = pack_data
 
     def _walk_all_chains(self):
         for offset, type_num in self._full_ofs:
@@ -1284,12 +1901,21 @@ class DeltaChainIterator(object):
     def _result(self, unpacked):
         return unpacked
 
+    def _unpack_at(self, offset):
+        if self._pack_data is not None:
+            unpacked, _ = self._pack_data._unpack_object_at(
+              offset, include_comp=self._include_comp,
+              compute_crc32=self._compute_crc32)
+        else:
+            self._file.seek(offset)
+            unpacked, _ = unpack_object(
+              self._file.read, include_comp=self._include_comp,
+              compute_crc32=self._compute_crc32)
+            unpacked.offset = offset
+        return unpacked
+
     def _resolve_object(self, offset, obj_type_num, base_chunks):
-        self._file.seek(offset)
-        unpacked, _ = unpack_object(
-          self._file.read, include_comp=self._include_comp,
-          compute_crc32=self._compute_crc32)
-        unpacked.offset = offset
+        unpacked = self._unpack_at(offset)
         if base_chunks is None:
             assert unpacked.pack_type_num == obj_type_num
         else:
@@ -1302,15 +1928,41 @@ class DeltaChainIterator(object):
     def _follow_chain(self, offset, obj_type_num, base_chunks):
         # Unlike PackData.get_object_at, there is no need to cache offsets as
         # this approach by design inflates each object exactly once.
-        unpacked = self._resolve_object(offset, obj_type_num, base_chunks)
-        yield self._result(unpacked)
-
-        pending = chain(self._pending_ofs.pop(unpacked.offset, []),
-                        self._pending_ref.pop(unpacked.sha(), []))
-        for new_offset in pending:
-            for new_result in self._follow_chain(
-              new_offset, unpacked.obj_type_num, unpacked.obj_chunks):
-                yield new_result
+        #
+        # The chain is walked depth first with an explicit stack rather than
+        # by recursion, so its depth is not limited by the interpreter. Each
+        # stack entry refers to the record of its base, [children left, size],
+        # and the base chunks are dropped as soon as the last delta against
+        # them has been resolved.
+        todo = [(offset, obj_type_num, base_chunks, None)]
+        while todo:
+            offset, obj_type_num, base_chunks, base = todo.pop()
+            if base is not None:
+                base[0] -= 1
+                if base[0] == 0:
+                    self._drop_base(base[1])
+            unpacked = self._resolve_object(offset, obj_type_num, base_chunks)
+            base_chunks = None
+            yield self._result(unpacked)
+
+            pending = (self._pending_ofs.pop(unpacked.offset, []) +
+                       self._pending_ref.pop(unpacked.sha(), []))
+            if pending:
+                size = chunks_length(unpacked.obj_chunks)
+                base = [len(pending), size]
+                for new_offset in reversed(pending):
+                    todo.append((new_offset, unpacked.obj_type_num,
+                                 unpacked.obj_chunks, base))
+                self._hold_base(size, len(todo))
+            del unpacked
+
+    def _hold_base(self, size, stack_size):
+        self._base_size += size
+        self.peak_base_size = max(self.peak_base_size, self._base_size)
+        self.peak_stack_size = max(self.peak_stack_size, stack_size)
+
+    def _drop_base(self, size):
+        self._base_size -= size
 
     def __iter__(self):
         return self._walk_all_chains()
@@ -1328,6 +1980,128 @@ class PackIndexer(DeltaChainIterator):
         return unpacked.sha(), unpacked.offset, unpacked.crc32
 
 
+class ParallelPackIndexer(PackIndexer):
+    """PackIndexer that resolves independent delta trees on a thread pool.
+
+    Every undeltified object, and every external base of a thin pack, roots
+    a tree of deltas that can be resolved without looking at any other
+    tree. The trees are handed out to a pool of threads, which spend most
+    of their time in zlib and hashlib and release the GIL while doing so.
+
+    Objects are read through a memory map of the pack, so that threads do
+    not share a file position. If the pack can not be mapped, the trees are
+    resolved one after the other like PackIndexer does. Entries are yielded
+    in no particular order.
+    """
+
+    def __init__(self, file_obj, resolve_ext_ref=None, threads=None):
+        """Create a new ParallelPackIndexer.
+
+        :param file_obj: File object to read the pack from
+        :param resolve_ext_ref: Function to look up external delta bases
+        :param threads: Number of threads to use; None to use one per CPU
+        """
+        super(ParallelPackIndexer, self).__init__(
+          file_obj, resolve_ext_ref=resolve_ext_ref)
+        self._threads = threads
+        self._contents = None
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def for_pack_data(cls, pack_data, resolve_ext_ref=None, threads=None):
+        walker = cls(None, resolve_ext_ref=resolve_ext_ref, threads=threads)
+        walker.set_pack_data(pack_data)
+        for unpacked in pack_data._iter_unpacked():
+            walker.record(unpacked)
+        return walker
+
+    def _unpack_at(self, offset):
+        if self._contents is None:
+            return super(ParallelPackIndexer, self)._unpack_at(offset)
+        reader = MappedReader(self._contents, offset)
+        unpacked, _ = unpack_object(
+          reader.read, read_some=reader.read_some,
+          include_comp=self._include_comp,
+          compute_crc32=self._compute_crc32)
+        unpacked.offset = offset
+        return unpacked
+
+    def _hold_base(self, size, stack_size):
+        with self._stats_lock:
+            super(ParallelPackIndexer, self)._hold_base(size, stack_size)
+
+    def _drop_base(self, size):
+        with self._stats_lock:
+            super(ParallelPackIndexer, self)._drop_base(size)
+
+    def _walk_tree(self, root):
+        return list(self._follow_chain(*root))
+
+    def _walk_trees(self, pool, roots):
+        # Use several chunks per thread to even out the load.
+        chunk_size = max(1, len(roots) // (self._threads * 4))
+        for results in pool.imap_unordered(self._walk_tree, roots,
+                                           chunk_size):
+            for result in results:
+                yield result
+
+    def _ext_ref_roots(self):
+        if not self._resolve_ext_ref:
+            return []
+        roots = []
+        for base_sha, pending in sorted(self._pending_ref.iteritems()):
+            try:
+                type_num, chunks = self._resolve_ext_ref(base_sha)
+            except KeyError:
+                # Not an external ref, but may depend on one.
+                continue
+            self._ext_refs.append(base_sha)
+            self._pending_ref.pop(base_sha)
+            for new_offset in pending:
+                roots.append((new_offset, type_num, chunks))
+        return roots
+
+    def _walk_all_chains(self):
+        if self._pack_data is not None:
+            self._contents = self._pack_data._contents
+            mapped = None
+        else:
+            self._file.flush()
+            mapped = self._contents = _map_file(self._file)
+        try:
+            if self._contents is None or self._threads == 1:
+                walk = super(ParallelPackIndexer, self)._walk_all_chains()
+            else:
+                walk = self._walk_all_chains_parallel()
+            for result in walk:
+                yield result
+        finally:
+            self._contents = None
+            if mapped is not None:
+                mapped.close()
+
+    def _walk_all_chains_parallel(self):
+        from multiprocessing.pool import ThreadPool
+        if self._threads is None:
+            import multiprocessing
+            self._threads = multiprocessing.cpu_count()
+        pool = ThreadPool(self._threads)
+        try:
+            for result in self._walk_trees(
+                    pool, [(offset, type_num, None)
+                           for offset, type_num in self._full_ofs]):
+                yield result
+            # Any REF_DELTA left now either has an external base or depends
+            # on one.
+            for result in self._walk_trees(pool, self._ext_ref_roots()):
+                yield result
+            self._ensure_no_pending()
+            assert not self._pending_ofs
+        finally:
+            pool.terminate()
+            pool.join()
+
+
 class PackInflater(DeltaChainIterator):
     """Delta chain iterator that yields ShaFile objects."""
 
@@ -1444,6 +2218,24 @@ def write_pack_object(f, type, object, sha=None):
     return crc32 & 0xffffffff
 
 
+def write_pack_compressed_object(f, type, delta_base, unpacked):
+    """Write a pack object whose data has already been compressed.
+
+    :param f: File to write to
+    :param type: Numeric type of the object
+    :param delta_base: Delta base offset or ref, or None for whole objects
+    :param unpacked: UnpackedObject with comp_chunks and decomp_len set; its
+        compressed data is copied verbatim
+    :return: crc32 of the written object
+    """
+    header = pack_object_header(type, delta_base, unpacked.decomp_len)
+    crc32 = 0
+    for data in chain([header], unpacked.comp_chunks):
+        f.write(data)
+        crc32 = binascii.crc32(data, crc32)
+    return crc32 & 0xffffffff
+
+
 def write_pack(filename, objects, num_objects=None):
     """Write a new pack data file.
 
@@ -1477,11 +2269,102 @@ def write_pack_header(f, num_objects):
     f.write(struct.pack('>L', num_objects))  # Number of objects in pack
 
 
-def deltify_pack_objects(objects, window=10):
+def _deltify_sorted(entries, window, depth):
+    """Search for delta bases in an already sorted list of objects.
+
+    :param entries: Iterable of (type_num, sha, raw) tuples, ordered by
+        the magic Linus heuristic
+    :param window: Number of preceding objects considered as delta bases
+    :param depth: Maximum length of delta chains
+    :return: Iterator over type_num, object id, delta_base, content
+    """
+    # Deque of (sha, type_num, raw, chain depth) tuples
+    possible_bases = deque()
+
+    for type_num, sha, raw in entries:
+        winner = raw
+        winner_base = None
+        winner_depth = 0
+        for base_sha, base_type_num, base_raw, base_depth in possible_bases:
+            if base_type_num != type_num or base_depth >= depth:
+                continue
+            if len(raw) - len(base_raw) >= len(winner):
+                # The delta would have to insert at least this much.
+                continue
+            delta = create_delta(base_raw, raw)
+            if len(delta) < len(winner):
+                winner_base = base_sha
+                winner = delta
+                winner_depth = base_depth + 1
+        yield type_num, sha, winner_base, winner
+        possible_bases.appendleft((sha, type_num, raw, winner_depth))
+        while len(possible_bases) > window:
+            possible_bases.pop()
+
+
+def _deltify_chunk(args):
+    """Deltify a chunk of objects; run in a worker process."""
+    entries, window, depth = args
+    return list(_deltify_sorted(entries, window, depth))
+
+
+def _split_deltify_chunks(magic, chunk_size):
+    """Split a sorted object list into chunks at type and path boundaries.
+
+    Objects with the same type and path are never split across chunks, so
+    that the versions of a file are still searched against each other.
+
+    :param magic: List of (type_num, path, neg_length, object) tuples, as
+        sorted by deltify_pack_objects
+    :param chunk_size: Preferred number of objects per chunk
+    :return: Iterator over lists of (type_num, sha, raw) tuples
+    """
+    chunk = []
+    last_key = None
+    for type_num, path, neg_length, o in magic:
+        key = (type_num, path)
+        if len(chunk) >= chunk_size and key != last_key:
+            yield chunk
+            chunk = []
+        chunk.append((type_num, o.sha().digest(), o.as_raw_string()))
+        last_key = key
+    if chunk:
+        yield chunk
+
+
+def _deltify_parallel(magic, window, depth, processes):
+    """Search for delta bases in a pool of worker processes.
+
+    Results are yielded in the order of the sorted object list.
+    """
+    import multiprocessing
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Use several chunks per worker to even out the load.
+        chunk_size = max(window, len(magic) // (processes * 4) + 1)
+        chunks = _split_deltify_chunks(magic, chunk_size)
+        for records in pool.imap(_deltify_chunk,
+                                 ((c, window, depth) for c in chunks)):
+            for record in records:
+                yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def deltify_pack_objects(objects, window=10, depth=50, processes=1):
     """Generate deltas for pack objects.
 
     :param objects: Objects to deltify
-    :param window: Window size
+    :param window: Window size; the number of preceding objects that are
+        considered as delta bases for each object
+    :param depth: Maximum length of delta chains
+    :param processes: Number of worker processes to search for deltas in;
+        None to use one per CPU. With more than one process, objects are
+        split into chunks at type and path boundaries and delta bases are
+        only searched for within a chunk.
     :return: Iterator over type_num, object id, delta_base, content
         delta_base is None for full text entries
     """
@@ -1492,42 +2375,132 @@ def deltify_pack_objects(objects, window=10):
         magic.append((obj.type_num, path, -obj.raw_length(), obj))
     magic.sort()
 
-    possible_bases = deque()
-
-    for type_num, path, neg_length, o in magic:
-        raw = o.as_raw_string()
-        winner = raw
-        winner_base = None
-        for base in possible_bases:
-            if base.type_num != type_num:
-                continue
-            delta = create_delta(base.as_raw_string(), raw)
-            if len(delta) < len(winner):
-                winner_base = base.sha().digest()
-                winner = delta
-        yield type_num, o.sha().digest(), winner_base, winner
-        possible_bases.appendleft(o)
-        while len(possible_bases) > window:
-            possible_bases.pop()
+    if processes != 1 and len(magic) > window:
+        return _deltify_parallel(magic, window, depth, processes)
+    return _deltify_sorted(
+        ((type_num, o.sha().digest(), o.as_raw_string())
+         for (type_num, path, neg_length, o) in magic), window, depth)
+
+
+# Limits on the number of objects and on the number of bytes of object data
+# that deltify_pack_records searches for deltas among at once.
+DELTIFY_BATCH_OBJECTS = 10000
+DELTIFY_BATCH_SIZE = 64 * 1024 * 1024
+
+
+def deltify_pack_records(records, paths=None, window=10, depth=50,
+                         processes=1, batch_objects=DELTIFY_BATCH_OBJECTS,
+                         batch_size=DELTIFY_BATCH_SIZE):
+    """Search for deltas for the pack records that are not deltas.
+
+    Records that are deltas already are passed through as soon as they are
+    read, preceded by their base if that is still waiting for a delta
+    search, so the base stays whole and no delta cycles are created. The
+    other records are collected in batches of at most batch_objects objects
+    and batch_size bytes, which are run through deltify_pack_objects. Objects
+    for which no delta is found are written as they were read.
+
+    :param records: Iterable over type_num, object_id, delta_base, raw
+        tuples, as taken by write_pack_data
+    :param paths: Optional dict mapping hex SHA1s to the paths objects were
+        found at, used to group objects when searching for deltas
+    :param window: Number of preceding objects considered as delta bases
+    :param depth: Maximum length of delta chains
+    :param processes: Number of processes to search for deltas in; None to
+        use one per CPU
+    :param batch_objects: Maximum number of objects to search at once
+    :param batch_size: Maximum number of bytes of object data to search at
+        once
+    :return: Iterator over type_num, object_id, delta_base, raw tuples
+    """
+    # Maps binary SHA1s to (type_num, raw) for the current batch.
+    pending = {}
+    pending_size = 0
+    for type_num, sha, delta_base, raw in records:
+        if delta_base is not None:
+            base = pending.pop(delta_base, None)
+            if base is not None:
+                base_type_num, base_raw = base
+                pending_size -= _raw_length(base_raw)
+                yield base_type_num, delta_base, None, base_raw
+            yield type_num, sha, delta_base, raw
+            continue
+        pending[sha] = (type_num, raw)
+        pending_size += _raw_length(raw)
+        if len(pending) >= batch_objects or pending_size >= batch_size:
+            for record in _deltify_batch(pending, paths, window, depth,
+                                         processes):
+                yield record
+            pending = {}
+            pending_size = 0
+    for record in _deltify_batch(pending, paths, window, depth, processes):
+        yield record
+
+
+def _raw_length(raw):
+    """Return the length of the object data in a pack record."""
+    if isinstance(raw, UnpackedObject):
+        return raw.decomp_len
+    return len(raw)
+
+
+def _deltify_batch(pending, paths, window, depth, processes):
+    """Search for deltas among a batch of whole pack records.
+
+    :param pending: Dict mapping binary SHA1s to (type_num, raw) tuples
+    :return: Iterator over type_num, object_id, delta_base, raw tuples
+    """
+    if not pending:
+        return
+    objects = []
+    for sha, (type_num, raw) in pending.iteritems():
+        if isinstance(raw, UnpackedObject):
+            chunks = raw.decomp_chunks
+        else:
+            chunks = [raw]
+        hexsha = sha_to_hex(sha)
+        if paths is None:
+            path = None
+        else:
+            path = paths.get(hexsha)
+        objects.append(
+            (ShaFile.from_raw_chunks(type_num, chunks, hexsha), path))
+    for type_num, sha, delta_base, delta in deltify_pack_objects(
+            objects, window, depth, processes):
+        if delta_base is None:
+            yield type_num, sha, None, pending[sha][1]
+        else:
+            yield type_num, sha, delta_base, delta
 
 
-def write_pack_objects(f, objects, window=10, num_objects=None):
+def write_pack_objects(f, objects, window=10, num_objects=None, depth=50,
+                       deltify=None, processes=1):
     """Write a new pack data file.
 
     :param f: File to write to
     :param objects: Iterable of (object, path) tuples to write.
         Should provide __len__
-    :param window: Sliding window size for searching for deltas; currently
-                   unimplemented
+    :param window: Sliding window size for searching for deltas
     :param num_objects: Number of objects (do not use, deprecated)
+    :param depth: Maximum length of delta chains
+    :param deltify: Whether to search for deltas. Defaults to doing so only if
+        the C implementation of create_delta is available, as the pure
+        Python one is slow.
+    :param processes: Number of processes to search for deltas in; None to
+        use one per CPU
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
     if num_objects is None:
         num_objects = len(objects)
-    # FIXME: pack_contents = deltify_pack_objects(objects, window)
-    pack_contents = (
-        (o.type_num, o.sha().digest(), None, o.as_raw_string())
-        for (o, path) in objects)
+    if deltify is None:
+        deltify = has_fast_create_delta
+    if deltify:
+        pack_contents = deltify_pack_objects(objects, window, depth,
+                                             processes)
+    else:
+        pack_contents = (
+            (o.type_num, o.sha().digest(), None, o.as_raw_string())
+            for (o, path) in objects)
     return write_pack_data(f, num_objects, pack_contents)
 
 
@@ -1536,7 +2509,10 @@ def write_pack_data(f, num_records, records):
 
     :param f: File to write to
     :param num_records: Number of records
-    :param records: Iterator over type_num, object_id, delta_base, raw
+    :param records: Iterator over type_num, object_id, delta_base, raw. raw
+        may also be an UnpackedObject read from another pack with
+        include_comp set, in which case its compressed data is copied
+        verbatim.
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
     # Write the pack
@@ -1544,17 +2520,21 @@ def write_pack_data(f, num_records, records):
     f = SHA1Writer(f)
     write_pack_header(f, num_records)
     for type_num, object_id, delta_base, raw in records:
+        offset = f.offset()
         if delta_base is not None:
             try:
                 base_offset, base_crc32 = entries[delta_base]
             except KeyError:
                 type_num = REF_DELTA
-                raw = (delta_base, raw)
             else:
                 type_num = OFS_DELTA
-                raw = (base_offset, raw)
-        offset = f.offset()
-        crc32 = write_pack_object(f, type_num, raw)
+                delta_base = offset - base_offset
+        if isinstance(raw, UnpackedObject):
+            crc32 = write_pack_compressed_object(f, type_num, delta_base, raw)
+        else:
+            if delta_base is not None:
+                raw = (delta_base, raw)
+            crc32 = write_pack_object(f, type_num, raw)
         entries[object_id] = (offset, crc32)
     return entries, f.write_sha()
 
@@ -1585,64 +2565,103 @@ def write_pack_index_v1(f, entries, pack_checksum):
     return f.write_sha()
 
 
+# Size of the blocks of the base buffer that are indexed by create_delta.
+DELTA_BLOCK_SIZE = 16
+
+# Largest copy and insert that fit in a single delta instruction.
+_MAX_COPY_SIZE = 0x10000
+_MAX_INSERT_SIZE = 0x7f
+
+
+def _delta_encode_size(size):
+    ret = ''
+    c = size & 0x7f
+    size >>= 7
+    while size:
+        ret += chr(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret += chr(c)
+    return ret
+
+
+def _encode_copy_operation(start, length):
+    scratch = ''
+    op = 0x80
+    for i in range(4):
+        if start & 0xff << i*8:
+            scratch += chr((start >> i*8) & 0xff)
+            op |= 1 << i
+    for i in range(3):
+        if length & 0xff << i*8:
+            scratch += chr((length >> i*8) & 0xff)
+            op |= 1 << (4+i)
+    return chr(op) + scratch
+
+
+def _match_length(a, a_start, b, b_start):
+    """Return the length of the common prefix of a[a_start:] and b[b_start:].
+    """
+    max_length = min(len(a) - a_start, len(b) - b_start)
+    length = 0
+    step = 4096
+    while step:
+        while (length + step <= max_length and
+               a[a_start+length:a_start+length+step] ==
+               b[b_start+length:b_start+length+step]):
+            length += step
+        step //= 16
+    return length
+
+
 def create_delta(base_buf, target_buf):
-    """Use python difflib to work out how to transform base_buf to target_buf.
+    """Work out how to transform base_buf to target_buf.
+
+    The aligned blocks of DELTA_BLOCK_SIZE bytes in the base buffer are
+    indexed, after which the target buffer is scanned for blocks that appear
+    in that index. Matches are extended in both directions and turned into
+    copy instructions; everything else is inserted literally.
 
     :param base_buf: Base buffer
     :param target_buf: Target buffer
+    :return: Delta instructions, as a string
     """
     assert isinstance(base_buf, str)
     assert isinstance(target_buf, str)
-    out_buf = ''
-    # write delta header
-    def encode_size(size):
-        ret = ''
-        c = size & 0x7f
-        size >>= 7
-        while size:
-            ret += chr(c | 0x80)
-            c = size & 0x7f
-            size >>= 7
-        ret += chr(c)
-        return ret
-    out_buf += encode_size(len(base_buf))
-    out_buf += encode_size(len(target_buf))
-    # write out delta opcodes
-    seq = difflib.SequenceMatcher(a=base_buf, b=target_buf)
-    for opcode, i1, i2, j1, j2 in seq.get_opcodes():
-        # Git patch opcodes don't care about deletes!
-        #if opcode == 'replace' or opcode == 'delete':
-        #    pass
-        if opcode == 'equal':
-            # If they are equal, unpacker will use data from base_buf
-            # Write out an opcode that says what range to use
-            scratch = ''
-            op = 0x80
-            o = i1
-            for i in range(4):
-                if o & 0xff << i*8:
-                    scratch += chr((o >> i*8) & 0xff)
-                    op |= 1 << i
-            s = i2 - i1
-            for i in range(2):
-                if s & 0xff << i*8:
-                    scratch += chr((s >> i*8) & 0xff)
-                    op |= 1 << (4+i)
-            out_buf += chr(op)
-            out_buf += scratch
-        if opcode == 'replace' or opcode == 'insert':
-            # If we are replacing a range or adding one, then we just
-            # output it to the stream (prefixed by its size)
-            s = j2 - j1
-            o = j1
-            while s > 127:
-                out_buf += chr(127)
-                out_buf += target_buf[o:o+127]
-                s -= 127
-                o += 127
-            out_buf += chr(s)
-            out_buf += target_buf[o:o+s]
-    return out_buf
+    out = [_delta_encode_size(len(base_buf)),
+           _delta_encode_size(len(target_buf))]
+    block_size = DELTA_BLOCK_SIZE
+    index = {}
+    # Index backwards, so the earliest occurrence of a block wins.
+    for i in xrange(len(base_buf) - block_size, -1, -block_size):
+        index[base_buf[i:i+block_size]] = i
+    target_len = len(target_buf)
+    insert_start = pos = 0
+    while pos + block_size <= target_len:
+        base_pos = index.get(target_buf[pos:pos+block_size])
+        if base_pos is None:
+            pos += 1
+            continue
+        # Grow the match backwards into data that would otherwise be inserted
+        while (pos > insert_start and base_pos > 0 and
+               target_buf[pos-1] == base_buf[base_pos-1]):
+            pos -= 1
+            base_pos -= 1
+        length = _match_length(base_buf, base_pos, target_buf, pos)
+        for o in xrange(insert_start, pos, _MAX_INSERT_SIZE):
+            s = min(pos - o, _MAX_INSERT_SIZE)
+            out.append(chr(s))
+            out.append(target_buf[o:o+s])
+        for o in xrange(0, length, _MAX_COPY_SIZE):
+            out.append(_encode_copy_operation(
+                base_pos + o, min(length - o, _MAX_COPY_SIZE)))
+        pos += length
+        insert_start = pos
+    for o in xrange(insert_start, target_len, _MAX_INSERT_SIZE):
+        s = min(target_len - o, _MAX_INSERT_SIZE)
+        out.append(chr(s))
+        out.append(target_buf[o:o+s])
+    return ''.join(out)
 
 
 def apply_delta(src_buf, delta):
@@ -1747,18 +2766,503 @@ def write_pack_index_v2(f, entries, pack_checksum):
     return f.write_sha()
 
 
+def write_multi_pack_index(f, packs):
+    """Write a multi-pack index file.
+
+    :param f: File-like object to write to
+    :param packs: List of tuples with the name of a pack index (e.g.
+        "pack-<sha>.idx") and an iterable over its entries, tuples starting
+        with object name (sha) and offset in the pack. An object that is in
+        several packs is mapped to the first pack it appears in.
+    :return: The SHA of the multi-pack index file written
+    """
+    pack_names = sorted(name for (name, entries) in packs)
+    pack_ids = dict((name, i) for (i, name) in enumerate(pack_names))
+    objects = {}
+    for name, entries in packs:
+        pack_id = pack_ids[name]
+        for entry in entries:
+            if entry[0] not in objects:
+                objects[entry[0]] = (pack_id, entry[1])
+    names = sorted(objects)
+
+    pack_names_chunk = ''.join(name + '\0' for name in pack_names)
+    pack_names_chunk += '\0' * (-len(pack_names_chunk) % 4)
+    fan_out_table = defaultdict(lambda: 0)
+    for name in names:
+        fan_out_table[ord(name[0])] += 1
+    for i in range(0x100):
+        fan_out_table[i+1] += fan_out_table[i]
+    offsets = []
+    largetable = []
+    for name in names:
+        pack_id, offset = objects[name]
+        if offset < 2**31:
+            offsets.append(struct.pack('>LL', pack_id, offset))
+        else:
+            offsets.append(struct.pack('>LL', pack_id,
+                                       2**31 + len(largetable)))
+            largetable.append(offset)
+
+    chunks = [
+        (MIDX_CHUNK_PACKNAMES, len(pack_names_chunk)),
+        (MIDX_CHUNK_OIDFANOUT, 0x100 * 4),
+        (MIDX_CHUNK_OIDLOOKUP, len(names) * 20),
+        (MIDX_CHUNK_OBJECTOFFSETS, len(names) * 8),
+        ]
+    if largetable:
+        chunks.append((MIDX_CHUNK_LARGEOFFSETS, len(largetable) * 8))
+
+    f = SHA1Writer(f)
+    f.write(struct.pack('>4sBBBBL', MIDX_SIGNATURE, 1, 1, len(chunks), 0,
+                        len(pack_names)))
+    # Chunk lookup table, terminated by an entry pointing past the last chunk
+    offset = 12 + (len(chunks) + 1) * 12
+    for chunk_id, size in chunks:
+        f.write(struct.pack('>4sQ', chunk_id, offset))
+        offset += size
+    f.write(struct.pack('>4sQ', '\0\0\0\0', offset))
+    f.write(pack_names_chunk)
+    for i in range(0x100):
+        f.write(struct.pack('>L', fan_out_table[i]))
+    for name in names:
+        f.write(name)
+    for entry in offsets:
+        f.write(entry)
+    for offset in largetable:
+        f.write(struct.pack('>Q', offset))
+    return f.write_sha()
+
+
+BITMAP_SIGNATURE = 'BITM'
+BITMAP_OPT_FULL_DAG = 0x1
+BITMAP_OPT_HASH_CACHE = 0x4
+
+_EWAH_ALL_ONES = (1 << 64) - 1
+_EWAH_MAX_RUN = (1 << 32) - 1
+_EWAH_MAX_LITERALS = (1 << 31) - 1
+
+
+def bitmap_from_positions(positions):
+    """Create a bitmap with a set of bits set.
+
+    Bitmaps are Python longs, in which bit i represents the i-th object.
+
+    :param positions: Iterable over bit positions
+    :return: Bitmap
+    """
+    data = bytearray()
+    for pos in positions:
+        i = pos >> 3
+        if i >= len(data):
+            data.extend('\0' * (i + 1 - len(data)))
+        data[i] |= 1 << (pos & 7)
+    return _bitmap_from_bytes(str(data))
+
+
+def bitmap_positions(bits):
+    """Iterate over the bits that are set in a bitmap, in ascending order."""
+    data = bytearray(_bitmap_to_bytes(bits))
+    for i, byte in enumerate(data):
+        if not byte:
+            continue
+        for j in range(8):
+            if byte & (1 << j):
+                yield (i << 3) + j
+
+
+def _bitmap_from_bytes(data):
+    """Convert little-endian bytes to a bitmap."""
+    if not data:
+        return 0L
+    return long(binascii.hexlify(data[::-1]), 16)
+
+
+def _bitmap_to_bytes(bits, size=0):
+    """Convert a bitmap to little-endian bytes.
+
+    :param size: Minimum number of bytes to return
+    """
+    hexbits = '%x' % bits
+    data = binascii.unhexlify('0' * (len(hexbits) & 1) + hexbits)[::-1]
+    if bits == 0:
+        data = ''
+    return data + '\0' * (size - len(data))
+
+
+def read_ewah(contents, offset=0):
+    """Read an EWAH-compressed bitmap, as stored in git's bitmap files.
+
+    :param contents: Buffer to read from
+    :param offset: Offset of the bitmap in contents
+    :return: Tuple with the bitmap and the offset just past it
+    """
+    (bit_size, num_words) = unpack_from('>LL', contents, offset)
+    offset += 8
+    words = struct.unpack_from('>%dQ' % num_words, contents, offset)
+    offset += num_words * 8 + 4  # Skip the position of the last marker.
+    chunks = []
+    i = 0
+    while i < num_words:
+        marker = words[i]
+        i += 1
+        run_length = (marker >> 1) & _EWAH_MAX_RUN
+        num_literals = marker >> 33
+        if run_length:
+            chunks.append(('\xff' if marker & 1 else '\0') * (run_length * 8))
+        if num_literals:
+            chunks.append(struct.pack('<%dQ' % num_literals,
+                                      *words[i:i + num_literals]))
+            i += num_literals
+    bits = _bitmap_from_bytes(''.join(chunks))
+    return bits & ((1 << bit_size) - 1), offset
+
+
+def write_ewah(f, bits):
+    """Write a bitmap in EWAH-compressed form, like git does.
+
+    :param f: File-like object to write to
+    :param bits: Bitmap to write
+    """
+    data = _bitmap_to_bytes(bits)
+    data += '\0' * (-len(data) % 8)
+    words = struct.unpack('<%dQ' % (len(data) // 8), data)
+    out = []
+    last_marker = 0
+    i = 0
+    while i < len(words) or not out:
+        run_bit = 0
+        run_length = 0
+        if i < len(words) and words[i] in (0, _EWAH_ALL_ONES):
+            clean = words[i]
+            run_bit = int(clean == _EWAH_ALL_ONES)
+            while (i < len(words) and words[i] == clean and
+                   run_length < _EWAH_MAX_RUN):
+                run_length += 1
+                i += 1
+        start = i
+        while (i < len(words) and words[i] not in (0, _EWAH_ALL_ONES) and
+               i - start < _EWAH_MAX_LITERALS):
+            i += 1
+        last_marker = len(out)
+        out.append(run_bit | (run_length << 1) | ((i - start) << 33))
+        out.extend(words[start:i])
+    f.write(struct.pack('>LL', len(words) * 64, len(out)))
+    f.write(struct.pack('>%dQ' % len(out), *out))
+    f.write(struct.pack('>L', last_marker))
+
+
+class PackReverseIndex(object):
+    """The objects of a pack in pack order, derived from its index.
+
+    Positions in pack order are the bit numbers used by bitmaps. The
+    offsets are sorted when the reverse index is first used; only they and
+    the index positions are kept, object names are read from the index.
+    """
+
+    def __init__(self, index):
+        """Create a reverse index.
+
+        :param index: PackIndex of the pack
+        """
+        self._index = index
+        self._offsets = None
+        self._idx_positions = None
+        self._unpack_name = None
+
+    def _load(self):
+        entries = sorted((offset, i) for (i, (name, offset, crc32))
+                         in enumerate(self._index.iterentries()))
+        self._idx_positions = [i for (offset, i) in entries]
+        self._unpack_name = _index_name_getter(self._index)
+        self._offsets = [offset for (offset, i) in entries]
+
+    def __len__(self):
+        return len(self._index)
+
+    def name(self, pos):
+        """Return the binary SHA1 of the object at a position in pack order.
+        """
+        if self._offsets is None:
+            self._load()
+        return self._unpack_name(self._idx_positions[pos])
+
+    def position(self, sha):
+        """Return the position of an object in pack order.
+
+        :param sha: Hex or binary SHA1 of the object
+        :raise KeyError: if the object is not in the pack
+        """
+        if self._offsets is None:
+            self._load()
+        return bisect_left(self._offsets, self._index.object_index(sha))
+
+    def name_at(self, offset):
+        """Return the binary SHA1 of the object at an offset.
+
+        :raise KeyError: if no object starts at offset
+        """
+        if self._offsets is None:
+            self._load()
+        pos = bisect_left(self._offsets, offset)
+        if pos == len(self._offsets) or self._offsets[pos] != offset:
+            raise KeyError(offset)
+        return self.name(pos)
+
+
+def _index_name_getter(index):
+    """Return a function that returns the name at a position in an index."""
+    unpack_name = getattr(index, '_unpack_name', None)
+    if unpack_name is None:
+        unpack_name = list(index._itersha()).__getitem__
+    return unpack_name
+
+
+def _skip_ewah(contents, size, offset):
+    """Return the offset just past an EWAH-compressed bitmap.
+
+    :raise AssertionError: if the bitmap does not fit in the file
+    """
+    if offset + 8 > size:
+        raise AssertionError('Bitmap file is truncated')
+    (bit_size, num_words) = unpack_from('>LL', contents, offset)
+    offset += 8 + num_words * 8 + 4
+    if offset > size:
+        raise AssertionError('Bitmap file is truncated')
+    return offset
+
+
+class PackBitmap(object):
+    """Reachability bitmaps for the objects in a pack.
+
+    The file format is that of git's .bitmap files (version 1): bitmaps of
+    the commits, trees, blobs and tags in the pack, followed by bitmaps of
+    all objects reachable from each of a selection of commits. All bitmaps
+    are EWAH-compressed. Bit i of a bitmap refers to the i-th object in the
+    pack, in pack order.
+
+    Bitmaps are returned as Python longs, so they can be combined with the
+    bitwise operators. Each bitmap is only decoded when it is first used.
+    """
+
+    def __init__(self, filename, index, contents=None, reverse_index=None):
+        """Create a pack bitmap object.
+
+        :param filename: Path to the bitmap file
+        :param index: PackIndex of the pack the bitmaps are for
+        :param contents: Optional contents of the file
+        :param reverse_index: Optional PackReverseIndex of the pack; one is
+            created when it is first needed if this is None
+        """
+        self._filename = filename
+        self._index = index
+        self._reverse_index = reverse_index
+        self._file = None
+        if contents is None:
+            self._file = GitFile(filename, 'rb')
+            try:
+                contents, size = _load_file_contents(self._file)
+            except:
+                self._file.close()
+                raise
+        else:
+            size = len(contents)
+        self._contents = contents
+        try:
+            self._read_header(index, size)
+        except:
+            self.close()
+            raise
+        self._decoded = {}
+
+    def _read_header(self, index, size):
+        contents = self._contents
+        if size < 32:
+            raise AssertionError('Bitmap file is truncated')
+        (signature, version, options, num_entries) = unpack_from(
+            '>4sHHL', contents, 0)
+        if signature != BITMAP_SIGNATURE:
+            raise AssertionError('Invalid bitmap signature %r' % signature)
+        if version != 1:
+            raise AssertionError('Unsupported bitmap version %d' % version)
+        if contents[12:32] != index.get_pack_checksum():
+            raise AssertionError('Bitmap is for a different pack')
+        # Entries are (offset of the EWAH bitmap, entry number of the bitmap
+        # it is XORed with or None); the four type bitmaps come first.
+        self._entries = []
+        offset = 32
+        for i in range(4):
+            self._entries.append((offset, None))
+            offset = _skip_ewah(contents, size, offset)
+        unpack_name = _index_name_getter(index)
+        num_objects = len(index)
+        self._bitmaps = {}
+        for i in range(num_entries):
+            if offset + 6 > size:
+                raise AssertionError('Bitmap file is truncated')
+            (idx_pos, xor_offset, flags) = unpack_from('>LBB', contents,
+                                                       offset)
+            if idx_pos >= num_objects or xor_offset > i:
+                raise AssertionError('Invalid bitmap entry %d' % i)
+            entry = len(self._entries)
+            if xor_offset:
+                self._entries.append((offset + 6, entry - xor_offset))
+            else:
+                self._entries.append((offset + 6, None))
+            self._bitmaps[unpack_name(idx_pos)] = entry
+            offset = _skip_ewah(contents, size, offset + 6)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            if getattr(self._contents, "close", None) is not None:
+                self._contents.close()
+            self._file = None
+
+    def _decode(self, entry):
+        """Decode a bitmap, and the bitmaps it is XORed with."""
+        chain = []
+        while entry is not None and entry not in self._decoded:
+            chain.append(entry)
+            entry = self._entries[entry][1]
+        if entry is None:
+            bits = 0
+        else:
+            bits = self._decoded[entry]
+        for entry in reversed(chain):
+            bits ^= read_ewah(self._contents, self._entries[entry][0])[0]
+            self._decoded[entry] = bits
+        return bits
+
+    @property
+    def commits(self):
+        """Bitmap of the commits in the pack."""
+        return self._decode(0)
+
+    @property
+    def trees(self):
+        """Bitmap of the trees in the pack."""
+        return self._decode(1)
+
+    @property
+    def blobs(self):
+        """Bitmap of the blobs in the pack."""
+        return self._decode(2)
+
+    @property
+    def tags(self):
+        """Bitmap of the tags in the pack."""
+        return self._decode(3)
+
+    @property
+    def reverse_index(self):
+        if self._reverse_index is None:
+            self._reverse_index = PackReverseIndex(self._index)
+        return self._reverse_index
+
+    def __len__(self):
+        """Return the number of commits that have a bitmap."""
+        return len(self._bitmaps)
+
+    def __contains__(self, sha):
+        """Check whether there is a bitmap for a commit."""
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return sha in self._bitmaps
+
+    def __getitem__(self, sha):
+        """Return the bitmap of the objects reachable from a commit.
+
+        :param sha: Hex or binary SHA1 of the commit
+        :raise KeyError: if there is no bitmap for the commit
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return self._decode(self._bitmaps[sha])
+
+    def position(self, sha):
+        """Return the position of an object in the pack.
+
+        :param sha: Hex or binary SHA1 of the object
+        :return: Bit number of the object in bitmaps
+        :raise KeyError: if the object is not in the pack
+        """
+        return self.reverse_index.position(sha)
+
+    def iter_shas(self, bits):
+        """Iterate over the objects in a bitmap.
+
+        :param bits: Bitmap
+        :return: Iterator over hex SHA1s
+        """
+        name = self.reverse_index.name
+        for pos in bitmap_positions(bits):
+            yield sha_to_hex(name(pos))
+
+
+def load_pack_bitmap(path, index, reverse_index=None):
+    """Load a pack bitmap file by path.
+
+    :param path: Path to the .bitmap file
+    :param index: PackIndex of the pack the bitmaps are for
+    :param reverse_index: Optional PackReverseIndex of the pack
+    :return: A PackBitmap
+    """
+    return PackBitmap(path, index, reverse_index=reverse_index)
+
+
+def write_pack_bitmap(f, index, type_bitmaps, bitmaps):
+    """Write a pack bitmap file.
+
+    :param f: File-like object to write to
+    :param index: PackIndex of the pack the bitmaps are for
+    :param type_bitmaps: Tuple with the bitmaps of the commits, trees, blobs
+        and tags in the pack
+    :param bitmaps: Dictionary mapping binary SHA1s of commits to bitmaps of
+        all objects reachable from them
+    :return: The SHA of the bitmap file written
+    """
+    entries = []
+    for idx_pos, name in enumerate(index._itersha()):
+        if name in bitmaps:
+            entries.append((idx_pos, bitmaps[name]))
+    if len(entries) != len(bitmaps):
+        raise KeyError('Commits with bitmaps are missing from the pack')
+    f = SHA1Writer(f)
+    f.write(struct.pack('>4sHHL', BITMAP_SIGNATURE, 1, BITMAP_OPT_FULL_DAG,
+                        len(entries)))
+    f.write(index.get_pack_checksum())
+    for bits in type_bitmaps:
+        write_ewah(f, bits)
+    for idx_pos, bits in entries:
+        f.write(struct.pack('>LBB', idx_pos, 0, 0))
+        write_ewah(f, bits)
+    return f.write_sha()
+
+
 class Pack(object):
     """A Git pack object."""
 
-    def __init__(self, basename, resolve_ext_ref=None):
+    def __init__(self, basename, resolve_ext_ref=None,
+                 delta_base_cache_size=DEFAULT_DELTA_BASE_CACHE_SIZE,
+                 delta_base_cache=None):
         self._basename = basename
         self._data = None
         self._idx = None
         self._idx_path = self._basename + '.idx'
         self._data_path = self._basename + '.pack'
-        self._data_load = lambda: PackData(self._data_path)
+        self._data_load = lambda: PackData(self._data_path,
+            delta_base_cache_size=delta_base_cache_size,
+            delta_base_cache=delta_base_cache)
         self._idx_load = lambda: load_pack_index(self._idx_path)
+        self._bitmap = None
+        self._bitmap_path = self._basename + '.bitmap'
+        self._reverse_index = None
         self.resolve_ext_ref = resolve_ext_ref
+        # Number of object lookups by an object store that found, and did
+        # not find, an object in this pack.
+        self.hits = 0
+        self.misses = 0
 
     @classmethod
     def from_lazy_objects(self, data_fn, idx_fn):
@@ -1800,11 +3304,40 @@ class Pack(object):
             self._idx = self._idx_load()
         return self._idx
 
+    @property
+    def reverse_index(self):
+        """The PackReverseIndex of this pack, built on first use."""
+        if self._reverse_index is None:
+            self._reverse_index = PackReverseIndex(self.index)
+        return self._reverse_index
+
+    @property
+    def bitmap(self):
+        """The reachability bitmaps of this pack, or None if it has none."""
+        if self._bitmap is None:
+            try:
+                self._bitmap = load_pack_bitmap(
+                    self._bitmap_path, self.index,
+                    reverse_index=self.reverse_index)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._bitmap = False
+            except (AssertionError, struct.error, IndexError, ValueError):
+                # Not a bitmap we can use; objects are found by walking
+                # the history instead.
+                self._bitmap = False
+        if self._bitmap is False:
+            return None
+        return self._bitmap
+
     def close(self):
         if self._data is not None:
             self._data.close()
         if self._idx is not None:
             self._idx.close()
+        if self._bitmap:
+            self._bitmap.close()
 
     def __eq__(self, other):
         return isinstance(self, type(other)) and self.index == other.index
@@ -1851,12 +3384,54 @@ class Pack(object):
         except KeyError:
             return False
 
+    def contains_many(self, shas):
+        """Check which of a set of SHA1s are in this pack.
+
+        :param shas: Iterable over hex or binary SHA1s
+        :return: Set of the SHA1s that are present in this pack
+        """
+        return set(self.index.object_index_many(shas))
+
     def get_raw(self, sha1):
-        offset = self.index.object_index(sha1)
+        return self.get_raw_at(self.index.object_index(sha1))
+
+    def get_raw_at(self, offset):
+        """Return the type and contents of the object at an offset."""
         obj_type, obj = self.data.get_object_at(offset)
         type_num, chunks = self.data.resolve_object(offset, obj_type, obj)
         return type_num, ''.join(chunks)
 
+    def iter_object_types(self):
+        """Iterate over the types of the objects in this pack.
+
+        Deltas are followed to their base to find their type, without
+        inflating any objects.
+
+        :return: Iterator over tuples with binary SHA1, offset and type num,
+            in pack order
+        """
+        entries = sorted((offset, name)
+                         for (name, offset, crc32) in self.index.iterentries())
+        types = {}
+        for offset, name in entries:
+            chain = []
+            base_offset = offset
+            while base_offset not in types:
+                type_num, delta_base = self.data.get_object_header_at(
+                    base_offset)
+                if type_num == OFS_DELTA:
+                    chain.append(base_offset)
+                    base_offset = delta_base
+                elif type_num == REF_DELTA:
+                    chain.append(base_offset)
+                    base_offset = self.index.object_index(delta_base)
+                else:
+                    types[base_offset] = type_num
+            type_num = types[base_offset]
+            for chain_offset in chain:
+                types[chain_offset] = type_num
+            yield name, offset, type_num
+
     def __getitem__(self, sha1):
         """Retrieve the specified SHA1."""
         type, uncomp = self.get_raw(sha1)
@@ -1903,8 +3478,43 @@ class Pack(object):
             keepfile.close()
         return keepfile_name
 
+    def write_bitmap(self, type_bitmaps, bitmaps):
+        """Write a .bitmap file for the pack.
+
+        :param type_bitmaps: Tuple with the bitmaps of the commits, trees,
+            blobs and tags in the pack
+        :param bitmaps: Dictionary mapping binary SHA1s of commits to bitmaps
+            of all objects reachable from them
+        :return: The SHA of the bitmap file written
+        """
+        f = GitFile(self._bitmap_path, 'wb')
+        try:
+            sha = write_pack_bitmap(f, self.index, type_bitmaps, bitmaps)
+        finally:
+            f.close()
+        self._bitmap = None
+        return sha
+
 
+_create_delta_py = create_delta
+_take_msb_bytes_py = take_msb_bytes
+_read_zlib_chunks_py = read_zlib_chunks
+_unpack_object_py = unpack_object
 try:
     from dulwich._pack import apply_delta, bisect_find_sha
 except ImportError:
     pass
+try:
+    from dulwich._pack import (
+        take_msb_bytes,
+        read_zlib_chunks,
+        unpack_object,
+        )
+except ImportError:
+    pass
+try:
+    from dulwich._pack import create_delta
+except ImportError:
+    has_fast_create_delta = False
+else:
+    has_fast_create_delta = True
@@ -25,8 +25,10 @@ Currently implemented:
  * commit
  * commit-tree
  * diff-tree
+ * gc
  * init
  * list-tags
+ * pack-refs
  * pull
  * push
  * rm
@@ -56,6 +58,7 @@ from dulwich.objects import (
     Tag,
     parse_timezone,
     )
+from dulwich.object_store import DEFAULT_PRUNE_GRACE_PERIOD
 from dulwich.objectspec import parse_object
 from dulwich.patch import write_tree_diff
 from dulwich.repo import (BaseRepo, Repo)
@@ -85,6 +88,40 @@ def archive(location, committish=None, outstream=sys.stdout,
     client.archive(path, committish, outstream.write, errstream.write)
 
 
+def gc(repo=".", grace_period=DEFAULT_PRUNE_GRACE_PERIOD):
+    """Repack all objects into a single pack, dropping unreachable objects.
+
+    Loose refs are packed first. In bare repositories, reachability bitmaps
+    are written for the new pack, as they speed up serving fetches. A commit
+    graph is written for the commits reachable from the refs.
+
+    :param repo: Path to the repository
+    :param grace_period: Number of seconds to keep unreachable objects for
+    :return: The new pack, or None if no pack was written
+    """
+    r = open_repo(repo)
+    r.refs.pack_refs(r.object_store, all=True)
+    refs = r.get_refs()
+    roots = set(refs.itervalues())
+    if r.has_index():
+        roots.update(sha for (path, sha, mode) in r.open_index().iterblobs())
+    pack = r.object_store.repack(roots, grace_period=grace_period,
+                                 write_bitmap=r.bare)
+    r.object_store.write_commit_graph(refs.itervalues())
+    return pack
+
+
+def pack_refs(repo=".", all=False):
+    """Move loose refs into the packed-refs file, with their peeled values.
+
+    :param repo: Path to the repository
+    :param all: Whether to pack all refs, rather than only tags
+    :return: List of names of the refs that were packed
+    """
+    r = open_repo(repo)
+    return r.refs.pack_refs(r.object_store, all=all)
+
+
 def update_server_info(repo="."):
     """Update server info files for a repository.
 
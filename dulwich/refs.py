@@ -27,6 +27,7 @@ import os
 from dulwich.errors import (
     PackedRefsException,
     RefFormatError,
+    RefsTransactionError,
     )
 from dulwich.objects import (
     hex_to_sha,
@@ -142,16 +143,34 @@ class RefsContainer(object):
 
         """
         ret = {}
-        keys = self.keys(base)
         if base is None:
-            base = ""
-        for key in keys:
+            base_len = 0
+        else:
+            base_len = len(base.rstrip("/")) + 1
+        for name, sha, peeled in self.iter_refs(base):
+            ret[name[base_len:]] = sha
+        return ret
+
+    def iter_refs(self, base=None):
+        """Iterate over the refs in this container, sorted by name.
+
+        :param base: An optional base to return refs under.
+        :return: Iterator over (name, sha, peeled) tuples, with the full name
+            of each ref, the SHA1 it refers to and its peeled value as
+            returned by get_peeled(). Refs that can not be resolved are
+            skipped.
+        """
+        if base is None:
+            names = self.allkeys()
+        else:
+            base = base.rstrip("/")
+            names = ["%s/%s" % (base, key) for key in self.subkeys(base)]
+        for name in sorted(names):
             try:
-                ret[key] = self[("%s/%s" % (base, key)).strip("/")]
+                sha = self[name]
             except KeyError:
                 continue  # Unable to resolve
-
-        return ret
+            yield name, sha, self.get_peeled(name)
 
     def _check_refname(self, name):
         """Ensure a refname is valid and lives in refs or is HEAD.
@@ -284,6 +303,104 @@ class RefsContainer(object):
         """
         self.remove_if_equals(name, None)
 
+    def transaction(self):
+        """Start a transaction, to change several refs at once.
+
+        :return: A RefsTransaction
+        """
+        return RefsTransaction(self)
+
+    def _commit_transaction(self, updates, expected):
+        """Apply the changes of a transaction.
+
+        :param updates: Dictionary mapping ref names to their new SHA1, or
+            None to remove them
+        :param expected: Dictionary mapping ref names to the value they
+            must have, or None if they must not exist
+        :return: True if the refs were changed, False if one of them did
+            not have the expected value
+        """
+        for name, value in expected.iteritems():
+            if self.read_ref(name) != value:
+                return False
+        for name, value in sorted(updates.iteritems()):
+            if value is not None:
+                self.set_if_equals(name, None, value)
+            elif self.read_ref(name) is not None:
+                self.remove_if_equals(name, None)
+        return True
+
+
+class RefsTransaction(object):
+    """A set of ref changes that are made together, or not at all.
+
+    Changes are queued with the same methods as on a RefsContainer, and
+    made by commit(), which first checks the current value of all refs.
+    """
+
+    def __init__(self, refs):
+        self._refs = refs
+        self._updates = {}
+        self._expected = {}
+
+    def _add(self, name, new_ref, check, old_ref):
+        self._refs._check_refname(name)
+        if name in self._updates:
+            raise ValueError('%s is changed twice in one transaction' % name)
+        self._updates[name] = new_ref
+        if check:
+            self._expected[name] = old_ref
+
+    def set_if_equals(self, name, old_ref, new_ref):
+        """Set a refname to new_ref if it equals old_ref on commit.
+
+        This method follows all symbolic references.
+
+        :param name: The refname to set.
+        :param old_ref: The old sha the refname must refer to, or None to set
+            unconditionally.
+        :param new_ref: The new sha the refname will refer to.
+        """
+        try:
+            realname, _ = self._refs._follow(name)
+        except KeyError:
+            realname = name
+        self._add(realname, new_ref, old_ref is not None, old_ref)
+
+    def add_if_new(self, name, ref):
+        """Add a new reference if it does not exist on commit.
+
+        :param name: The refname to set.
+        :param ref: The new sha the refname will refer to.
+        """
+        try:
+            realname, _ = self._refs._follow(name)
+        except KeyError:
+            realname = name
+        self._add(realname, ref, True, None)
+
+    def remove_if_equals(self, name, old_ref):
+        """Remove a refname if it equals old_ref on commit.
+
+        This method does not follow symbolic references.
+
+        :param name: The refname to delete.
+        :param old_ref: The old sha the refname must refer to, or None to
+            delete unconditionally.
+        """
+        self._add(name, None, old_ref is not None, old_ref)
+
+    def commit(self):
+        """Make all queued changes, if every ref has its expected value.
+
+        :return: True if the changes were made, False if a ref had changed,
+            in which case no ref is changed.
+        :raises RefsTransactionError: if changing the refs failed after some
+            of them were changed
+        """
+        return self._refs._commit_transaction(
+            self._updates, self._expected)
+
 
 class DictRefsContainer(RefsContainer):
     """RefsContainer backed by a simple dict.
@@ -383,6 +500,9 @@ class DiskRefsContainer(RefsContainer):
         self.path = path
         self._packed_refs = None
         self._peeled_refs = None
+        self._packed_refs_stat = None
+        # Whether the packed-refs file read has the peeled trait
+        self._packed_refs_peeled = False
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.path)
@@ -417,6 +537,105 @@ class DiskRefsContainer(RefsContainer):
         keys.update(self.get_packed_refs())
         return keys
 
+    def _read_loose_refs(self, dirname, refs):
+        """Read the loose refs in a directory and its subdirectories.
+
+        :param dirname: Name of the directory, relative to refpath
+        :param refs: List to append (refname, contents) tuples to
+        """
+        path = self.refpath(dirname)
+        try:
+            names = os.listdir(path)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise
+        for name in names:
+            refname = "%s/%s" % (dirname, name)
+            filename = os.path.join(path, name)
+            if not check_ref_format(refname):
+                if os.path.isdir(filename):
+                    self._read_loose_refs(refname, refs)
+                continue
+            # Try to read the entry first, so that only directories
+            # cost an extra stat.
+            try:
+                f = open(filename, 'rb')
+                try:
+                    contents = f.readline()
+                finally:
+                    f.close()
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                if os.path.isdir(filename):
+                    self._read_loose_refs(refname, refs)
+                    continue
+                raise
+            if contents.startswith(SYMREF):
+                contents = contents.rstrip("\r\n")
+            else:
+                contents = contents[:40]
+            refs.append((refname, contents))
+
+    def iter_refs(self, base=None):
+        """Iterate over the refs in this container, sorted by name.
+
+        Loose refs are read with a single directory scan, and merged with
+        the packed refs in one pass, rather than looking up every ref
+        separately.
+
+        :param base: An optional base to return refs under.
+        :return: Iterator over (name, sha, peeled) tuples, with the full name
+            of each ref, the SHA1 it refers to and its peeled value as
+            returned by get_peeled(). Refs that can not be resolved are
+            skipped.
+        """
+        loose = []
+        if base is None:
+            prefix = ""
+            contents = self.read_loose_ref("HEAD")
+            if contents is not None:
+                loose.append(("HEAD", contents))
+            self._read_loose_refs("refs", loose)
+        else:
+            base = base.rstrip("/")
+            prefix = base + "/"
+            self._read_loose_refs(base, loose)
+        loose.sort()
+        packed_refs = self.get_packed_refs()
+        peeled_refs = self._peeled_refs
+        packed = sorted(name for name in packed_refs
+                        if name.startswith(prefix))
+
+        def packed_entry(name):
+            sha = packed_refs[name]
+            return name, sha, peeled_refs.get(name, sha)
+
+        i = 0
+        for name, contents in loose:
+            while i < len(packed) and packed[i] < name:
+                yield packed_entry(packed[i])
+                i += 1
+            if i < len(packed) and packed[i] == name:
+                i += 1
+                if not contents:
+                    # An empty loose ref falls back to the packed one
+                    yield packed_entry(name)
+                    continue
+            if not contents:
+                continue
+            if contents.startswith(SYMREF):
+                try:
+                    sha = self[name]
+                except KeyError:
+                    continue  # Unable to resolve
+            else:
+                sha = contents
+            yield name, sha, None
+        for name in packed[i:]:
+            yield packed_entry(name)
+
     def refpath(self, name):
         """Return the disk path of a ref.
 
@@ -432,34 +651,49 @@ class DiskRefsContainer(RefsContainer):
 
         :note: Will return an empty dictionary when no packed-refs file is
             present.
+        :note: The result is cached until the modification time, size or
+            inode of the packed-refs file change.
         """
-        # TODO: invalidate the cache on repacking
-        if self._packed_refs is None:
-            # set both to empty because we want _peeled_refs to be
-            # None if and only if _packed_refs is also None.
-            self._packed_refs = {}
-            self._peeled_refs = {}
-            path = os.path.join(self.path, 'packed-refs')
-            try:
-                f = GitFile(path, 'rb')
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    return {}
+        path = os.path.join(self.path, 'packed-refs')
+        try:
+            stat = _stat_key(os.stat(path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
                 raise
-            try:
-                first_line = next(iter(f)).rstrip()
-                if (first_line.startswith("# pack-refs") and " peeled" in
-                        first_line):
-                    for sha, name, peeled in read_packed_refs_with_peeled(f):
-                        self._packed_refs[name] = sha
-                        if peeled:
-                            self._peeled_refs[name] = peeled
-                else:
-                    f.seek(0)
-                    for sha, name in read_packed_refs(f):
-                        self._packed_refs[name] = sha
-            finally:
-                f.close()
+            stat = None
+        if self._packed_refs is not None and stat == self._packed_refs_stat:
+            return self._packed_refs
+        # set both to empty because we want _peeled_refs to be
+        # None if and only if _packed_refs is also None.
+        self._packed_refs = {}
+        self._peeled_refs = {}
+        self._packed_refs_stat = None
+        self._packed_refs_peeled = False
+        try:
+            f = GitFile(path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return self._packed_refs
+            raise
+        try:
+            # Remember the file we actually read, in case it was replaced
+            # since we looked at it.
+            stat = _stat_key(os.fstat(f.fileno()))
+            first_line = next(iter(f), '').rstrip()
+            if (first_line.startswith("# pack-refs") and " peeled" in
+                    first_line):
+                self._packed_refs_peeled = True
+                for sha, name, peeled in read_packed_refs_with_peeled(f):
+                    self._packed_refs[name] = sha
+                    if peeled:
+                        self._peeled_refs[name] = peeled
+            else:
+                f.seek(0)
+                for sha, name in read_packed_refs(f):
+                    self._packed_refs[name] = sha
+        finally:
+            f.close()
+        self._packed_refs_stat = stat
         return self._packed_refs
 
     def get_peeled(self, name):
@@ -530,6 +764,90 @@ class DiskRefsContainer(RefsContainer):
         finally:
             f.abort()
 
+    def pack_refs(self, object_store, all=False):
+        """Move loose refs into the packed-refs file.
+
+        The peeled values of the newly packed refs are recorded too, so that
+        get_peeled() can answer without reading tag objects. If the old
+        packed-refs file did not record peeled values, those of the tags
+        already in it are added. Symbolic refs and refs to objects that are
+        not in the object store stay loose.
+
+        :param object_store: Object store to peel refs with
+        :param all: Whether to pack all refs, rather than only tags
+        :return: List of names of the refs that were packed
+        """
+        if all:
+            base = 'refs'
+        else:
+            base = 'refs/tags'
+        loose = []
+        filename = os.path.join(self.path, 'packed-refs')
+        f = GitFile(filename, 'wb')
+        try:
+            # Read the loose refs while holding the lock, so that a
+            # concurrent removal either finishes first or fails on the lock.
+            loose_refs = []
+            self._read_loose_refs(base, loose_refs)
+            # reread cached refs from disk, while holding the lock
+            self._packed_refs = None
+            packed_refs = dict(self.get_packed_refs())
+            peeled_refs = dict(self._peeled_refs)
+            for name, sha in loose_refs:
+                if not sha or sha.startswith(SYMREF):
+                    continue
+                try:
+                    peeled = object_store.peel_sha(sha).id
+                except KeyError:
+                    continue
+                packed_refs[name] = sha
+                peeled_refs.pop(name, None)
+                if peeled != sha:
+                    peeled_refs[name] = peeled
+                loose.append((name, sha))
+            newly_packed = set(name for (name, sha) in loose)
+            for name, sha in packed_refs.iteritems():
+                # With the peeled trait, a tag without a peeled value is
+                # known not to peel.
+                if (self._packed_refs_peeled or name in newly_packed or
+                        not name.startswith('refs/tags/')):
+                    continue
+                try:
+                    peeled = object_store.peel_sha(sha).id
+                except KeyError:
+                    continue
+                if peeled != sha:
+                    peeled_refs[name] = peeled
+            write_packed_refs(f, packed_refs, peeled_refs)
+            f.close()
+        finally:
+            f.abort()
+        self._packed_refs = None
+
+        # The refs are packed now; remove the loose ones that have not
+        # changed in the meantime.
+        for name, sha in loose:
+            filename = self.refpath(name)
+            f = GitFile(filename, 'wb')
+            try:
+                if self.read_loose_ref(name) == sha:
+                    os.remove(filename)
+            finally:
+                # never write, we just wanted the lock
+                f.abort()
+            self._remove_empty_dirs(name)
+        return [name for (name, sha) in loose]
+
+    def _remove_empty_dirs(self, name):
+        # Keep the top-level directories like refs/heads and refs/tags.
+        dirname = name.rsplit('/', 1)[0]
+        while dirname.count('/') >= 2:
+            try:
+                os.rmdir(self.refpath(dirname))
+            except OSError:
+                return
+            dirname = dirname.rsplit('/', 1)[0]
+
     def set_symbolic_ref(self, name, other):
         """Make a ref point at another ref.
 
@@ -658,6 +976,88 @@ class DiskRefsContainer(RefsContainer):
             f.abort()
         return True
 
+    def _commit_transaction(self, updates, expected):
+        """Apply the changes of a transaction.
+
+        All refs that are changed are locked, and their current values
+        checked while holding the locks, before any of them is changed. The
+        new values are written to all lock files before the first one is
+        renamed into place.
+        """
+        locks = {}
+        packed_lock = None
+        try:
+            for name in sorted(updates):
+                filename = self.refpath(name)
+                ensure_dir_exists(os.path.dirname(filename))
+                locks[name] = GitFile(filename, 'wb')
+            removed = [name for name, value in updates.iteritems()
+                       if value is None]
+            if removed:
+                packed_lock = GitFile(
+                    os.path.join(self.path, 'packed-refs'), 'wb')
+                # reread cached refs from disk, while holding the lock
+                self._packed_refs = None
+            for name, value in expected.iteritems():
+                current = self.read_loose_ref(name)
+                if current is None:
+                    current = self.get_packed_refs().get(name, None)
+                if current != value:
+                    return False
+            if removed:
+                packed_refs = dict(self.get_packed_refs())
+                peeled_refs = dict(self._peeled_refs)
+                if any(name in packed_refs for name in removed):
+                    for name in removed:
+                        packed_refs.pop(name, None)
+                        peeled_refs.pop(name, None)
+                    write_packed_refs(packed_lock, packed_refs, peeled_refs)
+                    packed_lock.flush()
+                else:
+                    packed_lock.abort()
+            for name, value in updates.iteritems():
+                if value is not None:
+                    locks[name].write(value + "\n")
+                    locks[name].flush()
+            # Nothing has changed yet; from here on, keep track of the refs
+            # that were updated in case one of them fails.
+            updated = []
+            try:
+                if removed:
+                    packed_lock.close()
+                    # The removed refs that were only packed are gone now.
+                    updated.extend(
+                        name for name in sorted(removed)
+                        if not os.path.lexists(self.refpath(name)))
+                for name, value in sorted(updates.iteritems()):
+                    if name in updated:
+                        continue
+                    if value is None:
+                        try:
+                            os.remove(self.refpath(name))
+                        except OSError as e:
+                            if e.errno != errno.ENOENT:
+                                raise
+                    else:
+                        locks[name].close()
+                    updated.append(name)
+            except (IOError, OSError) as e:
+                if not updated:
+                    raise
+                raise RefsTransactionError(updated, e)
+            return True
+        finally:
+            for f in locks.itervalues():
+                f.abort()
+            if packed_lock is not None:
+                packed_lock.abort()
+
+
+def _stat_key(st):
+    """Return the parts of a stat result that change when a file is replaced.
+    """
+    return (st.st_mtime, st.st_size, st.st_ino)
+
 
 def _split_ref_line(line):
     """Split a single ref line into a tuple of SHA1 and name."""
@@ -0,0 +1,891 @@
+# reftable.py -- Reading and writing git reftables
+# Copyright (C) 2014 The Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) a later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing git reftables.
+
+A reftable stores refs sorted by name in blocks of a fixed size. Within a
+block, names share a prefix with the name before them, and every sixteenth
+name is stored in full so that the block can be binary searched. An index
+of the last name in each block allows finding the block of a ref without
+reading the others.
+
+Tables are never modified. A repository keeps a stack of them, listed
+oldest first in the tables.list file, and every update adds a table with
+the changed refs on top of the stack, including records for deleted refs.
+Small tables are merged from time to time so that the stack stays short.
+"""
+
+from collections import namedtuple
+import errno
+import heapq
+import os
+import random
+import struct
+from struct import unpack_from
+import zlib
+
+from dulwich.file import (
+    GitFile,
+    ensure_dir_exists,
+    )
+from dulwich.objects import (
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.refs import (
+    SYMREF,
+    RefsContainer,
+    _stat_key,
+    )
+
+REFTABLE_SIGNATURE = 'REFT'
+REFTABLE_VERSION = 1
+REFTABLE_HEADER_SIZE = 24
+REFTABLE_FOOTER_SIZE = 68
+DEFAULT_BLOCK_SIZE = 4096
+# Number of records between records that are stored with their full name
+RESTART_INTERVAL = 16
+# Number of ref blocks from which an index is written
+INDEX_THRESHOLD = 4
+
+BLOCK_TYPE_REF = 'r'
+BLOCK_TYPE_INDEX = 'i'
+
+REF_VALUE_DELETION = 0
+REF_VALUE_SHA = 1
+REF_VALUE_PEELED = 2
+REF_VALUE_SYMREF = 3
+
+TABLES_LIST_FILENAME = 'tables.list'
+
+
+class RefRecord(namedtuple('RefRecord', [
+        'name', 'update_index', 'value', 'peeled'])):
+    """A ref in a reftable.
+
+    ``value`` is the hex SHA of the ref, ``'ref: '`` followed by the target
+    for a symbolic ref, or None if the ref was deleted. ``peeled`` is the
+    peeled value of a ref that points to a tag, if known.
+    """
+
+    __slots__ = ()
+
+
+def _read_varint(data, offset):
+    c = ord(data[offset])
+    offset += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = ord(data[offset])
+        offset += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, offset
+
+
+def _encode_varint(value):
+    ret = [chr(value & 0x7f)]
+    value >>= 7
+    while value:
+        value -= 1
+        ret.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    return ''.join(reversed(ret))
+
+
+def _read_uint24(data, offset):
+    high, low = unpack_from('>BH', data, offset)
+    return (high << 16) | low
+
+
+def _encode_uint24(value):
+    return struct.pack('>BH', value >> 16, value & 0xffff)
+
+
+def _common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _encode_ref_value(record, min_update_index):
+    ret = [_encode_varint(record.update_index - min_update_index)]
+    if record.value is None:
+        value_type = REF_VALUE_DELETION
+    elif record.value.startswith(SYMREF):
+        value_type = REF_VALUE_SYMREF
+        target = record.value[len(SYMREF):]
+        ret.append(_encode_varint(len(target)))
+        ret.append(target)
+    elif record.peeled is not None:
+        value_type = REF_VALUE_PEELED
+        ret.append(hex_to_sha(record.value))
+        ret.append(hex_to_sha(record.peeled))
+    else:
+        value_type = REF_VALUE_SHA
+        ret.append(hex_to_sha(record.value))
+    return value_type, ''.join(ret)
+
+
+def _encode_record(key, last_key, value_type, value):
+    prefix_length = _common_prefix_length(key, last_key)
+    suffix = key[prefix_length:]
+    return ''.join([
+        _encode_varint(prefix_length),
+        _encode_varint((len(suffix) << 3) | value_type),
+        suffix, value])
+
+
+class _BlockWriter(object):
+    """Write blocks of prefix-compressed records to a file."""
+
+    def __init__(self, f, block_size, offset, first=False):
+        self._f = f
+        self._block_size = block_size
+        self.offset = offset
+        self._header_size = 4
+        if first:
+            self._header_size += REFTABLE_HEADER_SIZE
+        self._reset()
+
+    def _reset(self):
+        self._records = []
+        self._size = 0
+        self._restarts = []
+        self._last_key = ''
+
+    def add(self, block_type, key, value_type, value):
+        """Add a record, starting a new block if it does not fit.
+
+        :return: Tuple with the offset and the last key of the block that
+            was finished to make room, or None
+        """
+        finished = None
+        record = self._encode(key, value_type, value)
+        if (self._records and
+                self._space_used(record) > self._block_size):
+            finished = self.flush(block_type)
+            record = self._encode(key, value_type, value)
+        if self._space_used(record) > self._block_size:
+            raise ValueError('record for %r does not fit in a block' % key)
+        if not len(self._records) % RESTART_INTERVAL:
+            self._restarts.append(self._header_size + self._size)
+        self._records.append(record)
+        self._size += len(record)
+        self._last_key = key
+        return finished
+
+    def _encode(self, key, value_type, value):
+        if len(self._records) % RESTART_INTERVAL:
+            last_key = self._last_key
+        else:
+            last_key = ''
+        return _encode_record(key, last_key, value_type, value)
+
+    def _space_used(self, record):
+        restarts = len(self._restarts)
+        if not len(self._records) % RESTART_INTERVAL:
+            restarts += 1
+        return (self._header_size + self._size + len(record) + restarts * 3
+                + 2)
+
+    def flush(self, block_type):
+        """Write out the current block.
+
+        :return: Tuple with the offset and the last key of the block, or
+            None if it was empty
+        """
+        if not self._records:
+            return None
+        chunks = [block_type,
+                  _encode_uint24(self._header_size + self._size +
+                                 len(self._restarts) * 3 + 2)]
+        chunks.extend(self._records)
+        chunks.extend(_encode_uint24(r) for r in self._restarts)
+        chunks.append(struct.pack('>H', len(self._restarts)))
+        data = ''.join(chunks)
+        size = self._header_size - 4 + len(data)
+        if size < self._block_size:
+            data += '\0' * (self._block_size - size)
+            size = self._block_size
+        self._f.write(data)
+        ret = (self.offset, self._last_key)
+        self.offset += size
+        self._header_size = 4
+        self._reset()
+        return ret
+
+
+def write_reftable(f, records, min_update_index, max_update_index,
+                   block_size=DEFAULT_BLOCK_SIZE):
+    """Write a reftable.
+
+    Only refs are written; the table has no object or log sections.
+
+    :param f: File-like object to write to
+    :param records: Iterable over RefRecord objects, sorted by name
+    :param min_update_index: Lowest update index of the records
+    :param max_update_index: Highest update index of the records
+    :param block_size: Size of the blocks in the table
+    """
+    header = struct.pack('>4sB', REFTABLE_SIGNATURE, REFTABLE_VERSION)
+    header += _encode_uint24(block_size)
+    header += struct.pack('>QQ', min_update_index, max_update_index)
+    f.write(header)
+
+    writer = _BlockWriter(f, block_size, 0, first=True)
+    blocks = []
+    for record in records:
+        value_type, value = _encode_ref_value(record, min_update_index)
+        finished = writer.add(BLOCK_TYPE_REF, record.name, value_type, value)
+        if finished is not None:
+            blocks.append(finished)
+    finished = writer.flush(BLOCK_TYPE_REF)
+    if finished is not None:
+        blocks.append(finished)
+
+    # Write index blocks for the blocks of the level below, until the top
+    # level fits in a single block.
+    ref_index_position = 0
+    if len(blocks) >= INDEX_THRESHOLD:
+        while len(blocks) > 1:
+            level = []
+            for offset, last_key in blocks:
+                finished = writer.add(BLOCK_TYPE_INDEX, last_key, 0,
+                                      _encode_varint(offset))
+                if finished is not None:
+                    level.append(finished)
+            level.append(writer.flush(BLOCK_TYPE_INDEX))
+            blocks = level
+        ref_index_position = blocks[0][0]
+
+    footer = header + struct.pack('>QQQQQ', ref_index_position, 0, 0, 0, 0)
+    f.write(footer)
+    f.write(struct.pack('>L', zlib.crc32(footer) & 0xffffffff))
+
+
+def load_reftable(path):
+    """Load a reftable by path.
+
+    :param path: Path to the reftable
+    :return: A Reftable
+    """
+    f = GitFile(path, 'rb')
+    try:
+        return Reftable(path, f.read())
+    finally:
+        f.close()
+
+
+class Reftable(object):
+    """A reftable, read from a file."""
+
+    def __init__(self, filename, contents):
+        """Create a reftable object.
+
+        :param filename: Path to the reftable
+        :param contents: Contents of the reftable
+        """
+        self._filename = filename
+        self._contents = contents
+        if len(contents) < REFTABLE_HEADER_SIZE + REFTABLE_FOOTER_SIZE:
+            raise AssertionError('Reftable is too short')
+        signature, version = unpack_from('>4sB', contents, 0)
+        if signature != REFTABLE_SIGNATURE:
+            raise AssertionError('Not a reftable')
+        if version != REFTABLE_VERSION:
+            raise AssertionError('Version was %d' % version)
+        self.block_size = _read_uint24(contents, 5)
+        (self.min_update_index,
+         self.max_update_index) = unpack_from('>QQ', contents, 8)
+        footer_offset = len(contents) - REFTABLE_FOOTER_SIZE
+        if (contents[footer_offset:footer_offset+REFTABLE_HEADER_SIZE] !=
+                contents[:REFTABLE_HEADER_SIZE]):
+            raise AssertionError('Reftable footer does not match header')
+        (crc32, ) = unpack_from('>L', contents, len(contents) - 4)
+        if zlib.crc32(contents[footer_offset:-4]) & 0xffffffff != crc32:
+            raise AssertionError('Invalid reftable footer checksum')
+        (self._ref_index_position, obj_position, obj_index_position,
+         log_position, log_index_position) = unpack_from(
+            '>QQQQQ', contents, footer_offset + REFTABLE_HEADER_SIZE)
+        # The ref blocks end where the next section starts.
+        self._ref_end = footer_offset
+        for position in (self._ref_index_position, obj_position >> 5,
+                         log_position):
+            if position:
+                self._ref_end = min(self._ref_end, position)
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def __len__(self):
+        """Return the size of this table in bytes."""
+        return len(self._contents)
+
+    def __iter__(self):
+        """Iterate over the records in this table, sorted by name."""
+        return self.iter_records()
+
+    def get(self, name):
+        """Return the record of a ref.
+
+        :param name: Name of the ref
+        :return: A RefRecord, or None if the ref is not in this table
+        """
+        for record in self.iter_records(name):
+            if record.name == name:
+                return record
+            break
+        return None
+
+    def _block_type(self, offset):
+        if offset == 0:
+            offset += REFTABLE_HEADER_SIZE
+        return self._contents[offset]
+
+    def _block(self, offset):
+        """Return the type, records start and end, and restarts of a block.
+        """
+        header_offset = offset
+        if offset == 0:
+            header_offset += REFTABLE_HEADER_SIZE
+        block_type = self._contents[header_offset]
+        block_len = _read_uint24(self._contents, header_offset + 1)
+        end = offset + block_len
+        (restart_count, ) = unpack_from('>H', self._contents, end - 2)
+        restarts_offset = end - 2 - restart_count * 3
+        return (block_type, header_offset + 4, restarts_offset,
+                restart_count, end)
+
+    def _next_block(self, offset, end):
+        # Blocks are padded with zeros to the block size, unless the
+        # table is unaligned.
+        if not self.block_size:
+            return end
+        next_offset = offset + self.block_size
+        if end < next_offset and end < len(self._contents) and (
+                self._contents[end] != '\0'):
+            return end
+        return next_offset
+
+    def _iter_block(self, offset, start=''):
+        """Iterate over the keys and values of the records in a block.
+
+        :param offset: Offset of the block
+        :param start: Name to skip records before
+        :return: Iterator over (key, value_type, value_offset) tuples
+        """
+        data = self._contents
+        (block_type, records_offset, restarts_offset, restart_count,
+         end) = self._block(offset)
+
+        # Find the last restart point at or before start.
+        pos = records_offset
+        lo, hi = 0, restart_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            restart = offset + _read_uint24(data, restarts_offset + mid * 3)
+            key, _, _ = self._read_key(restart, '')
+            if key <= start:
+                pos = restart
+                lo = mid + 1
+            else:
+                hi = mid
+
+        key = ''
+        while pos < restarts_offset:
+            key, value_type, pos = self._read_key(pos, key)
+            if key >= start:
+                yield key, value_type, pos
+            if block_type == BLOCK_TYPE_INDEX:
+                _, pos = _read_varint(data, pos)
+            else:
+                pos = self._skip_ref_value(value_type, pos)
+
+    def _read_key(self, pos, last_key):
+        prefix_length, pos = _read_varint(self._contents, pos)
+        suffix_and_type, pos = _read_varint(self._contents, pos)
+        suffix_length = suffix_and_type >> 3
+        key = last_key[:prefix_length] + self._contents[
+            pos:pos+suffix_length]
+        return key, suffix_and_type & 0x7, pos + suffix_length
+
+    def _skip_ref_value(self, value_type, pos):
+        _, pos = _read_varint(self._contents, pos)
+        if value_type == REF_VALUE_SHA:
+            pos += 20
+        elif value_type == REF_VALUE_PEELED:
+            pos += 40
+        elif value_type == REF_VALUE_SYMREF:
+            length, pos = _read_varint(self._contents, pos)
+            pos += length
+        return pos
+
+    def _read_ref_value(self, name, value_type, pos):
+        data = self._contents
+        update_index_delta, pos = _read_varint(data, pos)
+        update_index = self.min_update_index + update_index_delta
+        value = peeled = None
+        if value_type in (REF_VALUE_SHA, REF_VALUE_PEELED):
+            value = sha_to_hex(data[pos:pos+20])
+            if value_type == REF_VALUE_PEELED:
+                peeled = sha_to_hex(data[pos+20:pos+40])
+        elif value_type == REF_VALUE_SYMREF:
+            length, pos = _read_varint(data, pos)
+            value = SYMREF + data[pos:pos+length]
+        elif value_type != REF_VALUE_DELETION:
+            raise AssertionError('Unknown ref value type %d' % value_type)
+        return RefRecord(name, update_index, value, peeled)
+
+    def _find_ref_block(self, start):
+        """Find the offset of the ref block that could contain a name."""
+        if not self._ref_index_position or not start:
+            return 0
+        offset = self._ref_index_position
+        while True:
+            if self._block_type(offset) == BLOCK_TYPE_REF:
+                return offset
+            for key, value_type, pos in self._iter_block(offset, start):
+                offset, _ = _read_varint(self._contents, pos)
+                break
+            else:
+                return None
+
+    def iter_records(self, start=''):
+        """Iterate over the records in this table, sorted by name.
+
+        :param start: Name to start at; records for names before it are
+            skipped.
+        :return: Iterator over RefRecord objects
+        """
+        offset = self._find_ref_block(start)
+        if offset is None:
+            return
+        while offset < self._ref_end:
+            if self._block_type(offset) != BLOCK_TYPE_REF:
+                return
+            end = self._block(offset)[-1]
+            for key, value_type, pos in self._iter_block(offset, start):
+                yield self._read_ref_value(key, value_type, pos)
+            offset = self._next_block(offset, end)
+
+
+def merge_records(tables, start=''):
+    """Merge the records of a stack of tables.
+
+    :param tables: List of tables, oldest first
+    :param start: Name to start at
+    :return: Iterator over the newest RefRecord for each name, sorted by
+        name, including deletions
+    """
+    def keyed(i, table):
+        # Newer tables sort first for the same name.
+        for record in table.iter_records(start):
+            yield record.name, -i, record
+    iters = [keyed(i, table) for (i, table) in enumerate(tables)]
+    last = None
+    for name, _, record in heapq.merge(*iters):
+        if name != last:
+            last = name
+            yield record
+
+
+def _table_filename(min_update_index, max_update_index):
+    # The random suffix keeps the names of tables written by different
+    # processes with the same update indexes apart.
+    return '%012x-%012x-%08x.ref' % (
+        min_update_index, max_update_index, random.randint(0, 0xffffffff))
+
+
+class ReftableRefsContainer(RefsContainer):
+    """Refs container that stores refs in a stack of reftables.
+
+    Updates are written as a new table with the changed refs, so changing
+    a few refs does not rewrite the others, and a set of refs can be
+    changed atomically.
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        """Open a reftable stack.
+
+        :param path: Path of the reftable directory
+        :param block_size: Size of the blocks of the tables written
+        """
+        self.path = path
+        self.block_size = block_size
+        self._tables = []
+        self._tables_stat = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.path)
+
+    def _read_tables_list(self):
+        path = os.path.join(self.path, TABLES_LIST_FILENAME)
+        try:
+            f = GitFile(path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None, []
+            raise
+        try:
+            stat = _stat_key(os.fstat(f.fileno()))
+            return stat, [l.rstrip('\r\n') for l in f if l.strip()]
+        finally:
+            f.close()
+
+    def _get_tables(self):
+        """Return the tables of the stack, oldest first.
+
+        The tables are read again only when tables.list changed.
+        """
+        path = os.path.join(self.path, TABLES_LIST_FILENAME)
+        try:
+            stat = _stat_key(os.stat(path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            stat = None
+        if stat is not None and stat == self._tables_stat:
+            return self._tables
+        # Tables may be removed by a compaction after tables.list was
+        # read, in which case tables.list has changed too.
+        for attempt in range(5):
+            stat, names = self._read_tables_list()
+            current = dict((t.filename, t) for t in self._tables)
+            try:
+                tables = []
+                for name in names:
+                    filename = os.path.join(self.path, name)
+                    table = current.get(filename)
+                    if table is None:
+                        table = load_reftable(filename)
+                    tables.append(table)
+            except IOError as e:
+                if e.errno != errno.ENOENT or attempt == 4:
+                    raise
+                continue
+            self._tables = tables
+            self._tables_stat = stat
+            return tables
+
+    def _lookup(self, name, tables=None):
+        if tables is None:
+            tables = self._get_tables()
+        for table in reversed(tables):
+            record = table.get(name)
+            if record is not None:
+                return record
+        return None
+
+    def allkeys(self):
+        return set(record.name
+                   for record in merge_records(self._get_tables())
+                   if record.value is not None)
+
+    def get_packed_refs(self):
+        """Get contents of the packed-refs file.
+
+        Reftables have no packed refs, so this is always empty.
+        """
+        return {}
+
+    def get_peeled(self, name):
+        """Return the cached peeled value of a ref, if available.
+
+        :param name: Name of the ref to peel
+        :return: The peeled value of the ref if it points to a tag and the
+            table records it, otherwise None.
+        """
+        record = self._lookup(name)
+        if record is None:
+            return None
+        return record.peeled
+
+    def read_loose_ref(self, name):
+        """Read a ref from the tables.
+
+        :param name: the refname to read
+        :return: The SHA1 the ref refers to, or "ref: " followed by its
+            target for a symbolic ref, or None if it does not exist
+        """
+        record = self._lookup(name)
+        if record is None:
+            return None
+        return record.value
+
+    def iter_refs(self, base=None):
+        if base is None:
+            start = ''
+        else:
+            start = base.rstrip("/") + "/"
+        for record in merge_records(self._get_tables(), start):
+            if not record.name.startswith(start):
+                break
+            if record.value is None:
+                continue
+            if record.value.startswith(SYMREF):
+                try:
+                    sha = self[record.name]
+                except KeyError:
+                    continue  # Unable to resolve
+                yield record.name, sha, None
+            else:
+                yield record.name, record.value, record.peeled
+
+    def _write_table(self, records, min_update_index, max_update_index):
+        """Write a new table to the reftable directory.
+
+        :return: The new table
+        """
+        filename = os.path.join(self.path, _table_filename(
+            min_update_index, max_update_index))
+        f = GitFile(filename, 'wb')
+        try:
+            write_reftable(f, records, min_update_index, max_update_index,
+                           self.block_size)
+        except:
+            f.abort()
+            raise
+        f.close()
+        return load_reftable(filename)
+
+    def _write_tables_list(self, f, tables):
+        for table in tables:
+            f.write(os.path.basename(table.filename) + '\n')
+        f.close()
+
+    def update_refs(self, updates, expected=None):
+        """Update a set of refs atomically.
+
+        All refs are changed in a single new table, or not at all.
+
+        :param updates: Dictionary mapping ref names to their new value: a
+            SHA1, "ref: " followed by the target of a symbolic ref, or None
+            to remove the ref
+        :param expected: Optional dictionary mapping ref names to the value
+            they must have now, or None if they must not exist
+        :return: True if the refs were updated, False if one of them did
+            not have the expected value
+        """
+        if expected is None:
+            expected = {}
+        ensure_dir_exists(self.path)
+        f = GitFile(os.path.join(self.path, TABLES_LIST_FILENAME), 'wb')
+        try:
+            # read the stack again while holding the lock
+            self._tables_stat = None
+            tables = list(self._get_tables())
+            for name, value in expected.iteritems():
+                record = self._lookup(name, tables)
+                if record is None:
+                    current = None
+                else:
+                    current = record.value
+                if current != value:
+                    return False
+            if tables:
+                update_index = tables[-1].max_update_index + 1
+            else:
+                update_index = 1
+            records = [RefRecord(name, update_index, value, None)
+                       for (name, value) in sorted(updates.iteritems())]
+            tables.append(
+                self._write_table(records, update_index, update_index))
+            obsolete = self._compact(tables)
+            self._write_tables_list(f, tables)
+        finally:
+            f.abort()
+        self._remove_tables(obsolete)
+        return True
+
+    def _commit_transaction(self, updates, expected):
+        return self.update_refs(updates, expected)
+
+    def _compact(self, tables, start=None):
+        """Merge the newest tables of a stack.
+
+        Unless told where to start, tables are merged from the top of the
+        stack down until the next table is at least twice as large as the
+        merged ones together, so that table sizes grow geometrically.
+
+        :param tables: List of tables, oldest first; changed in place
+        :param start: Index of the first table to merge
+        :return: List of the tables that were merged
+        """
+        if start is None:
+            start = len(tables) - 1
+            size = len(tables[start])
+            while start > 0 and len(tables[start - 1]) < 2 * size:
+                start -= 1
+                size += len(tables[start])
+        if len(tables) - start < 2:
+            return []
+        records = merge_records(tables[start:])
+        if start == 0:
+            # Nothing older left to hide, so deletions can go.
+            records = [r for r in records if r.value is not None]
+        else:
+            records = list(records)
+        merged = tables[start:]
+        if records:
+            tables[start:] = [self._write_table(
+                records, merged[0].min_update_index,
+                merged[-1].max_update_index)]
+        else:
+            del tables[start:]
+        return merged
+
+    def _remove_tables(self, tables):
+        for table in tables:
+            try:
+                os.remove(table.filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def compact(self):
+        """Merge all tables of the stack into one."""
+        ensure_dir_exists(self.path)
+        f = GitFile(os.path.join(self.path, TABLES_LIST_FILENAME), 'wb')
+        try:
+            self._tables_stat = None
+            tables = list(self._get_tables())
+            obsolete = self._compact(tables, 0)
+            self._write_tables_list(f, tables)
+        finally:
+            f.abort()
+        self._remove_tables(obsolete)
+
+    def pack_refs(self, object_store, all=False):
+        """Merge all tables of the stack into one, with peeled values.
+
+        Reftables have no loose refs, so this is the counterpart of packing
+        refs: the stack is merged, and the peeled value of tags that have
+        none yet is recorded. A table cannot record that a ref does not
+        peel, so other refs are not peeled even if all is set.
+
+        :param object_store: Object store to peel refs with
+        :param all: Ignored; all refs are in the tables already
+        :return: List of names of the refs whose peeled value was recorded
+        """
+        ensure_dir_exists(self.path)
+        f = GitFile(os.path.join(self.path, TABLES_LIST_FILENAME), 'wb')
+        try:
+            self._tables_stat = None
+            tables = list(self._get_tables())
+            records = []
+            peeled_names = []
+            for record in merge_records(tables):
+                if record.value is None:
+                    continue
+                if (record.peeled is None and
+                        record.name.startswith('refs/tags/') and
+                        not record.value.startswith(SYMREF)):
+                    try:
+                        peeled = object_store.peel_sha(record.value).id
+                    except KeyError:
+                        peeled = record.value
+                    if peeled != record.value:
+                        record = record._replace(peeled=peeled)
+                        peeled_names.append(record.name)
+                records.append(record)
+            if len(tables) < 2 and not peeled_names:
+                return []
+            obsolete = tables
+            if records:
+                tables = [self._write_table(
+                    records, tables[0].min_update_index,
+                    tables[-1].max_update_index)]
+            else:
+                tables = []
+            self._write_tables_list(f, tables)
+        finally:
+            f.abort()
+        self._remove_tables(obsolete)
+        return peeled_names
+
+    def set_symbolic_ref(self, name, other):
+        """Make a ref point at another ref.
+
+        :param name: Name of the ref to set
+        :param other: Name of the ref to point at
+        """
+        self._check_refname(name)
+        self.update_refs({name: SYMREF + other})
+
+    def set_if_equals(self, name, old_ref, new_ref):
+        """Set a refname to new_ref only if it currently equals old_ref.
+
+        This method follows all symbolic references, and can be used to
+        perform an atomic compare-and-swap operation.
+
+        :param name: The refname to set.
+        :param old_ref: The old sha the refname must refer to, or None to set
+            unconditionally.
+        :param new_ref: The new sha the refname will refer to.
+        :return: True if the set was successful, False otherwise.
+        """
+        self._check_refname(name)
+        try:
+            realname, _ = self._follow(name)
+        except KeyError:
+            realname = name
+        if old_ref is None:
+            expected = {}
+        else:
+            expected = {realname: old_ref}
+        return self.update_refs({realname: new_ref}, expected)
+
+    def add_if_new(self, name, ref):
+        """Add a new reference only if it does not already exist.
+
+        This method follows symrefs, and only ensures that the last ref in
+        the chain does not exist.
+
+        :param name: The refname to set.
+        :param ref: The new sha the refname will refer to.
+        :return: True if the add was successful, False otherwise.
+        """
+        try:
+            realname, contents = self._follow(name)
+            if contents is not None:
+                return False
+        except KeyError:
+            realname = name
+        self._check_refname(realname)
+        return self.update_refs({realname: ref}, {realname: None})
+
+    def remove_if_equals(self, name, old_ref):
+        """Remove a refname only if it currently equals old_ref.
+
+        This method does not follow symbolic references. It can be used to
+        perform an atomic compare-and-delete operation.
+
+        :param name: The refname to delete.
+        :param old_ref: The old sha the refname must refer to, or None to
+            delete unconditionally.
+        :return: True if the delete was successful, False otherwise.
+        """
+        self._check_refname(name)
+        if old_ref is None:
+            expected = {}
+        else:
+            expected = {name: old_ref}
+        return self.update_refs({name: None}, expected)
@@ -48,6 +48,7 @@ from dulwich.file import (
     )
 from dulwich.object_store import (
     DiskObjectStore,
+    FullPackIterator,
     MemoryObjectStore,
     ObjectStoreGraphWalker,
     )
@@ -77,6 +78,9 @@ from dulwich.refs import (
     write_packed_refs,
     SYMREF,
     )
+from dulwich.reftable import (
+    ReftableRefsContainer,
+    )
 
 
 import warnings
@@ -87,6 +91,7 @@ REFSDIR = 'refs'
 REFSDIR_TAGS = 'tags'
 REFSDIR_HEADS = 'heads'
 INDEX_FILENAME = "index"
+REFTABLEDIR = 'reftable'
 
 BASE_DIRECTORIES = [
     ["branches"],
@@ -244,9 +249,12 @@ class BaseRepo(object):
             updated progress strings.
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
-        :return: iterator over objects, with __len__ implemented
+        :return: iterator over objects, with __len__ implemented. This is a
+            FullPackIterator if everything is wanted and all objects are in a
+            single pack whose bitmap shows they are all reachable.
         """
-        wants = determine_wants(self.get_refs())
+        refs = self.get_refs()
+        wants = determine_wants(refs)
         if not isinstance(wants, list):
             raise TypeError("determine_wants() did not return a list")
 
@@ -271,6 +279,24 @@ class BaseRepo(object):
             haves = []  # TODO: filter the haves commits from iter_shas.
                         # the specific commits aren't missing.
 
+        if (not haves and not shallows and not unshallows and
+                not self._graftpoints and
+                set(wants).issuperset(refs.itervalues())):
+            # The client has nothing and wants everything; if all objects
+            # are in a single pack and all of them are reachable, that pack
+            # can be sent as it is.
+            pack = self.object_store.sole_pack(wants)
+            if pack is not None:
+                return FullPackIterator(pack)
+
+        if not shallows and not unshallows and not self._graftpoints:
+            # Without shallow commits or grafts, history is what the
+            # reachability bitmaps say it is.
+            missing = self.object_store.find_missing_objects_bitmap(
+                haves, wants, progress, get_tagged)
+            if missing is not None:
+                return self.object_store.iter_shas(missing)
+
         def get_parents(commit):
             if commit.id in shallows:
                 return []
@@ -347,7 +373,7 @@ class BaseRepo(object):
             return self._graftpoints[sha]
         except KeyError:
             if commit is None:
-                commit = self[sha]
+                commit = self.object_store.lookup_commit(sha)
             return commit.parents
 
     def get_config(self):
@@ -660,9 +686,21 @@ class Repo(BaseRepo):
                 "No git repository was found at %(path)s" % dict(path=root)
             )
         self.path = root
-        object_store = DiskObjectStore(os.path.join(self.controldir(),
-                                                    OBJECTDIR))
-        refs = DiskRefsContainer(self.controldir())
+        config = self.get_config()
+        object_store = DiskObjectStore.from_config(
+            os.path.join(self.controldir(), OBJECTDIR), config)
+        try:
+            ref_storage = config.get('extensions', 'refstorage')
+        except KeyError:
+            ref_storage = 'files'
+        if ref_storage == 'reftable':
+            refs = ReftableRefsContainer(
+                os.path.join(self.controldir(), REFTABLEDIR))
+        elif ref_storage == 'files':
+            refs = DiskRefsContainer(self.controldir())
+        else:
+            raise ValueError(
+                "Unknown ref storage format %r" % (ref_storage, ))
         BaseRepo.__init__(self, object_store, refs)
 
         self._graftpoints = {}
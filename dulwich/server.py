@@ -55,14 +55,22 @@ from dulwich.errors import (
     NotGitRepository,
     UnexpectedCommandError,
     ObjectFormatException,
+    RefFormatError,
+    RefsTransactionError,
     )
 from dulwich import log_utils
 from dulwich.objects import (
     hex_to_sha,
     Commit,
     )
+from dulwich.commit_graph import (
+    CommitGraphEntry,
+    )
+from dulwich.object_store import (
+    FullPackIterator,
+    )
 from dulwich.pack import (
-    write_pack_objects,
+    write_pack_data,
     )
 from dulwich.protocol import (
     BufferedPktLineWriter,
@@ -217,6 +225,10 @@ class Handler(object):
 class UploadPackHandler(Handler):
     """Protocol handler for uploading a pack to the server."""
 
+    # Number of processes to search for deltas in for the objects whose
+    # stored deltas cannot be sent; None to use one per CPU.
+    deltify_processes = 1
+
     def __init__(self, backend, args, proto, http_req=None,
                  advertise_refs=False):
         Handler.__init__(self, backend, proto, http_req=http_req)
@@ -283,7 +295,15 @@ class UploadPackHandler(Handler):
 
         self.progress("dul-daemon says what\n")
         self.progress("counting objects: %d, done.\n" % len(objects_iter))
-        write_pack_objects(ProtocolFile(None, write), objects_iter)
+        if isinstance(objects_iter, FullPackIterator):
+            # Send the pack file as it is.
+            for chunk in objects_iter.pack.data.iter_chunks():
+                write(chunk)
+        else:
+            write_pack_data(ProtocolFile(None, write), len(objects_iter),
+                objects_iter.iter_pack_records(
+                    thin=self.has_capability("thin-pack"),
+                    processes=self.deltify_processes))
         self.progress("how was that, then?\n")
         # we are done
         self.proto.write("0000")
@@ -341,7 +361,7 @@ def _find_shallow(store, heads, depth):
     def get_parents(sha):
         result = parents.get(sha, None)
         if not result:
-            result = store[sha].parents
+            result = store.lookup_commit(sha).parents
             parents[sha] = result
         return result
 
@@ -524,7 +544,7 @@ class ProtocolGraphWalker(object):
     def set_wants(self, wants):
         self._wants = wants
 
-    def _is_satisfied(self, haves, want, earliest):
+    def _is_satisfied(self, haves, want, earliest, min_generation=None):
         """Check whether a want is satisfied by a set of haves.
 
         A want, typically a branch tip, is "satisfied" only if there exists a
@@ -535,18 +555,25 @@ class ProtocolGraphWalker(object):
         :param earliest: A timestamp beyond which the search for haves will be
             terminated, presumably because we're searching too far down the
             wrong branch.
+        :param min_generation: Optional lowest generation number of the
+            haves in the commit graph; commits with a lower generation
+            number can not reach any of them.
         """
-        o = self.store[want]
+        o = self.store.lookup_commit(want)
         pending = collections.deque([o])
         while pending:
             commit = pending.popleft()
             if commit.id in haves:
                 return True
-            if commit.type_name != "commit":
+            if not isinstance(commit, (Commit, CommitGraphEntry)):
                 # non-commit wants are assumed to be satisfied
                 continue
             for parent in commit.parents:
-                parent_obj = self.store[parent]
+                parent_obj = self.store.lookup_commit(parent)
+                if (min_generation is not None and
+                    isinstance(parent_obj, CommitGraphEntry) and
+                    parent_obj.generation < min_generation):
+                    continue
                 # TODO: handle parents with later commit times than children
                 if parent_obj.commit_time >= earliest:
                     pending.append(parent_obj)
@@ -560,9 +587,14 @@ class ProtocolGraphWalker(object):
             in the current interface they are determined outside this class.
         """
         haves = set(haves)
-        earliest = min([self.store[h].commit_time for h in haves])
+        have_commits = [self.store.lookup_commit(h) for h in haves]
+        earliest = min([c.commit_time for c in have_commits])
+        if all(isinstance(c, CommitGraphEntry) for c in have_commits):
+            min_generation = min([c.generation for c in have_commits])
+        else:
+            min_generation = None
         for want in self._wants:
-            if not self._is_satisfied(haves, want, earliest):
+            if not self._is_satisfied(haves, want, earliest, min_generation):
                 return False
         return True
 
@@ -683,6 +715,10 @@ class MultiAckDetailedGraphWalkerImpl(object):
 class ReceivePackHandler(Handler):
     """Protocol handler for downloading a pack from the client."""
 
+    # Number of threads to index received packs in; None to use one per CPU.
+    # Object stores are only passed this if it is not 1.
+    index_threads = 1
+
     def __init__(self, backend, args, proto, http_req=None,
                  advertise_refs=False):
         Handler.__init__(self, backend, proto, http_req=http_req)
@@ -691,7 +727,7 @@ class ReceivePackHandler(Handler):
 
     @classmethod
     def capabilities(cls):
-        return ("report-status", "delete-refs", "side-band-64k")
+        return ("report-status", "delete-refs", "side-band-64k", "atomic")
 
     def _apply_pack(self, refs):
         all_exceptions = (IOError, OSError, ChecksumMismatch, ApplyDeltaError,
@@ -708,7 +744,12 @@ class ReceivePackHandler(Handler):
             # TODO: more informative error messages than just the exception string
             try:
                 recv = getattr(self.proto, "recv", None)
-                p = self.repo.object_store.add_thin_pack(self.proto.read, recv)
+                if self.index_threads == 1:
+                    p = self.repo.object_store.add_thin_pack(
+                        self.proto.read, recv)
+                else:
+                    p = self.repo.object_store.add_thin_pack(
+                        self.proto.read, recv, threads=self.index_threads)
                 status.append(('unpack', 'ok'))
             except all_exceptions as e:
                 status.append(('unpack', str(e).replace('\n', '')))
@@ -719,6 +760,14 @@ class ReceivePackHandler(Handler):
             # even if no pack data has been sent.
             status.append(('unpack', 'ok'))
 
+        if self.has_capability('atomic'):
+            if status[0][1] == 'ok':
+                status.extend(self._update_refs_atomic(refs, all_exceptions))
+            else:
+                status.extend((ref, 'n/a (unpacker error)')
+                              for (oldsha, sha, ref) in refs)
+            return status
+
         for oldsha, sha, ref in refs:
             ref_status = 'ok'
             try:
@@ -742,6 +791,41 @@ class ReceivePackHandler(Handler):
 
         return status
 
+    def _update_refs_atomic(self, refs, all_exceptions):
+        """Update refs in a single transaction, checking their old values.
+
+        :return: List of (ref, status) tuples
+        """
+        transaction = self.repo.refs.transaction()
+        failed = {}
+        for oldsha, sha, ref in refs:
+            try:
+                if sha == ZERO_SHA:
+                    if not 'delete-refs' in self.capabilities():
+                        raise GitProtocolError(
+                          'Attempted to delete refs without delete-refs '
+                          'capability.')
+                    transaction.remove_if_equals(ref, oldsha)
+                elif oldsha == ZERO_SHA:
+                    transaction.add_if_new(ref, sha)
+                else:
+                    transaction.set_if_equals(ref, oldsha, sha)
+            except (KeyError, ValueError, RefFormatError):
+                failed[ref] = 'bad ref'
+        if not failed:
+            try:
+                if transaction.commit():
+                    return [(ref, 'ok') for (oldsha, sha, ref) in refs]
+            except RefsTransactionError as e:
+                # Some refs were changed before the failure; report them.
+                updated = set(e.updated)
+                return [(ref, 'ok' if ref in updated else 'failed to update ref')
+                        for (oldsha, sha, ref) in refs]
+            except all_exceptions:
+                pass
+        return [(ref, failed.get(ref, 'atomic push failure'))
+                for (oldsha, sha, ref) in refs]
+
     def _report_status(self, status):
         if self.has_capability('side-band-64k'):
             writer = BufferedPktLineWriter(
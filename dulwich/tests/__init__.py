@@ -113,6 +113,7 @@ def self_test_suite():
     names = [
         'blackbox',
         'client',
+        'commit_graph',
         'config',
         'diff_tree',
         'fastexport',
@@ -130,6 +131,7 @@ def self_test_suite():
         'porcelain',
         'protocol',
         'refs',
+        'reftable',
         'repository',
         'server',
         'walk',
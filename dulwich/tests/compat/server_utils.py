@@ -96,6 +96,15 @@ class ServerTests(object):
                         cwd=self._new_repo.path)
         self.assertReposEqual(self._old_repo, self._new_repo)
 
+    def test_push_to_dulwich_atomic(self):
+        self.import_repos()
+        self.assertReposNotEqual(self._old_repo, self._new_repo)
+        port = self._start_server(self._old_repo)
+
+        run_git_or_fail(['push', '--atomic', self.url(port)] +
+                        self.branch_args(), cwd=self._new_repo.path)
+        self.assertReposEqual(self._old_repo, self._new_repo)
+
     def test_push_to_dulwich_no_op(self):
         self._old_repo = import_repo('server_old.export')
         self.addCleanup(tear_down_repo, self._old_repo)
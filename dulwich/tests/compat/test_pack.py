@@ -25,13 +25,26 @@ import os
 import shutil
 import tempfile
 
+from dulwich.objects import (
+    Blob,
+    )
 from dulwich.pack import (
     write_pack,
     )
+from dulwich.repo import (
+    Repo,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
 from dulwich.tests.test_pack import (
     pack1_sha,
     PackTests,
     )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
 from dulwich.tests.compat.utils import (
     require_git_version,
     run_git_or_fail,
@@ -64,3 +77,110 @@ class TestPack(PackTests):
             pack_shas.add(sha)
         orig_shas = set(o.id for o in origpack.iterobjects())
         self.assertEqual(orig_shas, pack_shas)
+
+
+class TestMultiPackIndex(PackTests):
+    """Compatibility tests for multi-pack index files."""
+
+    def setUp(self):
+        require_git_version((2, 21, 0))
+        super(TestMultiPackIndex, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self.store = Repo.init(self._tempdir).object_store
+        self.addCleanup(self.store.close)
+        origpack = self.get_pack(pack1_sha)
+        objects = list(origpack.iterobjects())
+        self.store.add_objects([(objects[0], None)])
+        self.store.add_objects([(o, None) for o in objects])
+        self.shas = set(o.id for o in objects)
+
+    def test_git_reads_dulwich_midx(self):
+        self.store.write_multi_pack_index()
+        run_git_or_fail(['multi-pack-index', 'verify'], cwd=self._tempdir)
+
+    def test_dulwich_reads_git_midx(self):
+        run_git_or_fail(['multi-pack-index', 'write'], cwd=self._tempdir)
+        store = Repo(self._tempdir).object_store
+        self.addCleanup(store.close)
+        for sha in self.shas:
+            self.assertEqual(self.store.get_raw(sha), store.get_raw(sha))
+        self.assertEqual(2, len(store._midx.pack_names))
+        self.assertEqual(self.shas, set(store._midx))
+
+
+class TestPackBitmap(TestCase):
+    """Compatibility tests for pack bitmap files."""
+
+    def setUp(self):
+        require_git_version((1, 8, 5))
+        super(TestPackBitmap, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self.repo = Repo.init_bare(self._tempdir)
+        self.addCleanup(self.repo.object_store.close)
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(3)]
+        trees = {1: [('a', blobs[0])],
+                 2: [('a', blobs[1]), ('d/b', blobs[0])],
+                 3: [('a', blobs[2])],
+                 4: [('a', blobs[1]), ('d/b', blobs[2])]}
+        self.commits = [c.id for c in build_commit_graph(
+            self.repo.object_store, [[1], [2, 1], [3, 1], [4, 2, 3]], trees)]
+        self.repo.refs['refs/heads/master'] = self.commits[3]
+        self.repo.refs['refs/heads/other'] = self.commits[1]
+
+    def test_git_reads_dulwich_bitmap(self):
+        store = self.repo.object_store
+        pack = store.repack(self.repo.get_refs().values(), write_bitmap=True)
+        # Both tips and the newest other commit have a bitmap.
+        self.assertEqual(3, len(pack.bitmap))
+        output = run_git_or_fail(
+            ['rev-list', '--test-bitmap', 'refs/heads/master'],
+            cwd=self._tempdir)
+        self.assertIn('OK!', output)
+
+    def test_dulwich_reads_git_bitmap(self):
+        self.repo.object_store.pack_loose_objects()
+        run_git_or_fail(['repack', '-a', '-d', '-b'], cwd=self._tempdir)
+        store = Repo(self._tempdir).object_store
+        self.addCleanup(store.close)
+        self.assertNotEqual(None, store.packs[0].bitmap)
+        c1, c2, c3, c4 = self.commits
+        missing = store.find_missing_objects_bitmap([c2], [c4])
+        output = run_git_or_fail(['rev-list', '--objects', c4, '^' + c2],
+                                 cwd=self._tempdir)
+        self.assertEqual(
+            sorted(line[:40] for line in output.splitlines()),
+            sorted(sha for (sha, path) in missing))
+
+
+class TestCommitGraph(TestCase):
+    """Compatibility tests for commit-graph files."""
+
+    def setUp(self):
+        require_git_version((2, 19, 0))
+        super(TestCommitGraph, self).setUp()
+        self._tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tempdir)
+        self.repo = Repo.init_bare(self._tempdir)
+        self.addCleanup(self.repo.object_store.close)
+        self.commits = build_commit_graph(
+            self.repo.object_store,
+            [[1], [2, 1], [3, 1], [4, 2, 3], [5], [6, 4, 5, 1]])
+        self.repo.refs['refs/heads/master'] = self.commits[5].id
+
+    def test_git_reads_dulwich_commit_graph(self):
+        self.repo.object_store.write_commit_graph([self.commits[5].id])
+        run_git_or_fail(['commit-graph', 'verify'], cwd=self._tempdir)
+
+    def test_dulwich_reads_git_commit_graph(self):
+        run_git_or_fail(['commit-graph', 'write', '--reachable'],
+                        cwd=self._tempdir)
+        store = Repo(self._tempdir).object_store
+        self.addCleanup(store.close)
+        graph = store.commit_graph
+        self.assertEqual(sorted(c.id for c in self.commits), list(graph))
+        for commit in self.commits:
+            self.assertEqual(commit.parents, graph.get_parents(commit.id))
+            self.assertEqual(commit.commit_time,
+                             graph.get_commit_time(commit.id))
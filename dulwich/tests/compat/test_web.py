@@ -126,6 +126,10 @@ class DumbWebTestCase(WebTests, CompatTestCase):
         # Note: remove this if dumb pushing is supported
         raise SkipTest('Dumb web pushing not supported.')
 
+    def test_push_to_dulwich_atomic(self):
+        # Note: remove this if dumb pushing is supported
+        raise SkipTest('Dumb web pushing not supported.')
+
     def test_new_shallow_clone_from_dulwich(self):
         # Note: remove this if C git and dulwich implement dumb web shallow
         # clones.
@@ -283,6 +283,55 @@ class GitClientTests(TestCase):
         self.assertEqual(self.rout.getvalue(), '0000')
 
 
+    def test_send_pack_atomic(self):
+        self.rin.write(
+            '006a310ca9477129b8586fa2afc779c1f57cf64bba6c '
+            'refs/heads/master\x00report-status delete-refs atomic '
+            'ofs-delta\n'
+            '0000000eunpack ok\n'
+            '0019ok refs/heads/master\n'
+            '0000')
+        self.rin.seek(0)
+
+        def determine_wants(refs):
+            return {'refs/heads/master': '0' * 40}
+
+        def generate_pack_contents(have, want):
+            return {}
+
+        self.client.send_pack('/', determine_wants, generate_pack_contents,
+                              atomic=True)
+        out = self.rout.getvalue()
+        self.assertTrue(out.endswith('0000'))
+        line = out[4:-4]
+        self.assertEqual(int(out[:4], 16), len(line) + 4)
+        update, caps = line.split('\x00')
+        self.assertEqual(
+            '310ca9477129b8586fa2afc779c1f57cf64bba6c '
+            '0000000000000000000000000000000000000000 refs/heads/master',
+            update)
+        self.assertEqual(set(['report-status', 'ofs-delta', 'atomic']),
+                         set(caps.split()))
+
+    def test_send_pack_atomic_unsupported(self):
+        self.rin.write(
+            '0063310ca9477129b8586fa2afc779c1f57cf64bba6c '
+            'refs/heads/master\x00report-status delete-refs ofs-delta\n'
+            '0000')
+        self.rin.seek(0)
+
+        def determine_wants(refs):
+            return {'refs/heads/master': '0' * 40}
+
+        def generate_pack_contents(have, want):
+            return {}
+
+        self.assertRaises(SendPackError,
+                          self.client.send_pack, '/', determine_wants,
+                          generate_pack_contents, atomic=True)
+        self.assertEqual(self.rout.getvalue(), '0000')
+
+
 class TestGetTransportAndPath(TestCase):
 
     def test_tcp(self):
@@ -0,0 +1,127 @@
+# test_commit_graph.py -- Tests for reading and writing commit-graph files
+# Copyright (C) 2014 The Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) a later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for reading and writing commit-graph files."""
+
+import os
+import shutil
+import tempfile
+
+from dulwich.commit_graph import (
+    CommitGraphEntry,
+    load_commit_graph,
+    write_commit_graph,
+    )
+from dulwich.file import GitFile
+from dulwich.object_store import (
+    MemoryObjectStore,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
+
+
+class CommitGraphTests(TestCase):
+
+    def setUp(self):
+        super(CommitGraphTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.store = MemoryObjectStore()
+
+    def write_graph(self, commits):
+        path = os.path.join(self.tempdir, 'commit-graph')
+        f = GitFile(path, 'wb')
+        try:
+            write_commit_graph(f, commits)
+        finally:
+            f.close()
+        graph = load_commit_graph(path)
+        self.addCleanup(graph.close)
+        return graph
+
+    def test_empty(self):
+        graph = self.write_graph([])
+        self.assertEqual(0, len(graph))
+        self.assertEqual([], list(graph))
+
+    def test_roundtrip(self):
+        commits = build_commit_graph(
+            self.store, [[1], [2, 1], [3, 1], [4, 2, 3], [5], [6, 4, 5, 1]])
+        graph = self.write_graph(commits)
+        self.assertEqual(6, len(graph))
+        self.assertEqual(sorted(c.id for c in commits), list(graph))
+        for commit in commits:
+            self.assertIn(commit.id, graph)
+            entry = graph[commit.id]
+            self.assertIsInstance(entry, CommitGraphEntry)
+            self.assertEqual(
+                (commit.id, commit.tree, commit.parents, commit.commit_time),
+                (entry.id, entry.tree, entry.parents, entry.commit_time))
+            self.assertEqual(commit.parents, graph.get_parents(commit.id))
+            self.assertEqual(commit.commit_time,
+                             graph.get_commit_time(commit.id))
+        self.assertEqual([1, 2, 2, 3, 1, 4],
+                         [graph.get_generation(c.id) for c in commits])
+
+    def test_large_commit_time(self):
+        c1, = build_commit_graph(self.store, [[1]],
+                                 attrs={1: {'commit_time': 2**33 + 5}})
+        graph = self.write_graph([c1])
+        self.assertEqual(2**33 + 5, graph.get_commit_time(c1.id))
+        self.assertEqual(1, graph.get_generation(c1.id))
+
+    def test_missing(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        graph = self.write_graph([c1])
+        self.assertNotIn(c2.id, graph)
+        self.assertRaises(KeyError, graph.__getitem__, c2.id)
+        self.assertRaises(KeyError, graph.get_parents, c2.id)
+
+    def test_missing_parent(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        self.assertRaises(KeyError, self.write_graph, [c2])
+
+    def test_bad_signature(self):
+        path = os.path.join(self.tempdir, 'commit-graph')
+        f = open(path, 'wb')
+        try:
+            f.write('PACK' + '\0' * 100)
+        finally:
+            f.close()
+        self.assertRaises(AssertionError, load_commit_graph, path)
+
+    def test_truncated(self):
+        commits = build_commit_graph(self.store, [[1], [2, 1]])
+        self.write_graph(commits)
+        path = os.path.join(self.tempdir, 'commit-graph')
+        f = open(path, 'rb')
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        for size in (0, 6, 30, 100, len(contents) - 40):
+            f = open(path, 'wb')
+            try:
+                f.write(contents[:size])
+            finally:
+                f.close()
+            self.assertRaises(AssertionError, load_commit_graph, path)
@@ -171,6 +171,20 @@ class ConfigDictTests(TestCase):
         cd.set(("core", ), "foo", "invalid")
         self.assertRaises(ValueError, cd.get_boolean, ("core", ), "foo")
 
+    def test_get_int(self):
+        cd = ConfigDict()
+        self.assertEqual(3, cd.get_int(("core", ), "foo", 3))
+        cd.set(("core", ), "foo", "42")
+        self.assertEqual(42, cd.get_int(("core", ), "foo"))
+        cd.set(("core", ), "foo", "2k")
+        self.assertEqual(2048, cd.get_int(("core", ), "foo"))
+        cd.set(("core", ), "foo", "96M")
+        self.assertEqual(96 * 1024 * 1024, cd.get_int(("core", ), "foo"))
+        cd.set(("core", ), "foo", "1g")
+        self.assertEqual(1024 * 1024 * 1024, cd.get_int(("core", ), "foo"))
+        cd.set(("core", ), "foo", "invalid")
+        self.assertRaises(ValueError, cd.get_int, ("core", ), "foo")
+
     def test_dict(self):
         cd = ConfigDict()
         cd.set(("core", ), "foo", "bla")
@@ -88,6 +88,15 @@ class MOFLinearRepoTest(MissingObjectFinderTest):
         self.assertMissingMatch([self.cmt(1).id], [self.cmt(3).id],
             self.missing_1_3)
 
+    def test_iterator(self):
+        missing = self.store.find_missing_objects([self.cmt(2).id],
+                                                  [self.cmt(3).id])
+        self.assertTrue(iter(missing) is missing)
+        shas = [missing.next()[0] for i in range(len(self.missing_2_3))]
+        self.assertEqual(sorted(self.missing_2_3), sorted(shas))
+        self.assertRaises(StopIteration, missing.next)
+        self.assertIn(self.cmt(2).id, missing.sha_done)
+
     def test_bogus_haves_failure(self):
         """Ensure non-existent SHA in haves are not tolerated"""
         bogus_sha = self.cmt(2).id[::-1]
@@ -24,6 +24,12 @@ import os
 import shutil
 import tempfile
 
+from dulwich.commit_graph import (
+    CommitGraphEntry,
+    )
+from dulwich.config import (
+    ConfigDict,
+    )
 from dulwich.index import (
     commit_tree,
     )
@@ -42,10 +48,18 @@ from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
     ObjectStoreGraphWalker,
+    PACK_FILTER_MIN_MISSES,
+    ShaBloomFilter,
     tree_lookup_path,
     )
 from dulwich.pack import (
+    DEFAULT_DELTA_BASE_CACHE_SIZE,
+    OFS_DELTA,
     REF_DELTA,
+    PackData,
+    PackInflater,
+    UnpackedObject,
+    write_pack_data,
     write_pack_objects,
     )
 from dulwich.tests import (
@@ -53,6 +67,7 @@ from dulwich.tests import (
     )
 from dulwich.tests.utils import (
     make_object,
+    build_commit_graph,
     build_pack,
     )
 
@@ -79,6 +94,42 @@ class ObjectStoreTests(object):
     def test_contains_nonexistant(self):
         self.assertFalse(("a" * 40) in self.store)
 
+    def test_contains_many(self):
+        self.store.add_objects([(testobject, None)])
+        self.assertEqual(set([testobject.id]),
+            self.store.contains_many([testobject.id, "a" * 40]))
+        self.assertEqual(set(), self.store.contains_many([]))
+
+    def test_get_raw_many(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(3)]
+        self.store.add_objects([(b, None) for b in blobs[:2]])
+        self.store.add_object(blobs[2])
+        self.assertEqual(
+            sorted((b.id, b.type_num, b.as_raw_string()) for b in blobs),
+            sorted(self.store.get_raw_many([b.id for b in blobs])))
+        self.assertEqual([], list(self.store.get_raw_many([])))
+
+    def test_get_raw_many_missing(self):
+        self.store.add_object(testobject)
+        it = self.store.get_raw_many([testobject.id, "a" * 40])
+        self.assertRaises(KeyError, list, it)
+
+    def test_iterobjects_subset(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(3)]
+        self.store.add_objects([(b, None) for b in blobs])
+        objs = list(self.store.iterobjects_subset([b.id for b in blobs[1:]]))
+        self.assertEqual(sorted((b.id, b.data) for b in blobs[1:]),
+                         sorted((o.id, o.data) for o in objs))
+
+    def test_open_loose_object(self):
+        self.assertEqual(None, self.store.open_loose_object(testobject.id))
+        self.store.add_object(testobject)
+        f = self.store.open_loose_object(testobject.id)
+        try:
+            self.assertEqual(testobject.as_legacy_object(), f.read())
+        finally:
+            f.close()
+
     def test_add_objects_empty(self):
         self.store.add_objects([])
 
@@ -188,6 +239,14 @@ class ObjectStoreTests(object):
         self.assertEqual((Blob.type_num, 'yummy data'),
                          self.store.get_raw(testobject.id))
 
+    def test_iter_pack_records(self):
+        self.store.add_object(testobject)
+        f = BytesIO()
+        write_pack_data(f, 1, self.store.iter_pack_records([testobject.id]))
+        f.seek(0)
+        data = PackData.from_file(f, len(f.getvalue()))
+        self.assertEqual([testobject], list(PackInflater.for_pack_data(data)))
+
     def test_close(self):
         # For now, just check that close doesn't barf.
         self.store.add_object(testobject)
@@ -246,6 +305,32 @@ class PackBasedObjectStoreTests(ObjectStoreTests):
         self.assertNotEquals([], self.store.packs)
         self.assertEqual(0, self.store.pack_loose_objects())
 
+    def test_pack_loose_objects_max_pack_objects(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(5)]
+        for blob in blobs:
+            self.store.add_object(blob)
+        self.assertEqual(5, self.store.pack_loose_objects(max_pack_objects=2))
+        self.assertEqual([2, 2, 1],
+                         sorted([len(p) for p in self.store.packs],
+                                reverse=True))
+        for blob in blobs:
+            self.assertFalse(self.store.contains_loose(blob.id))
+            self.assertEqual(blob, self.store[blob.id])
+
+    def test_pack_loose_objects_already_packed(self):
+        # As left behind by a run that was interrupted after committing the
+        # pack, but before removing the loose objects.
+        b1 = make_object(Blob, data="yummy data")
+        b2 = make_object(Blob, data="more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.store.add_object(b1)
+        self.store.add_object(b2)
+        self.assertEqual(1, self.store.pack_loose_objects())
+        self.assertEqual(2, len(self.store.packs))
+        self.assertFalse(self.store.contains_loose(b1.id))
+        self.assertEqual(b1, self.store[b1.id])
+        self.assertEqual(b2, self.store[b2.id])
+
 
 class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
 
@@ -271,6 +356,31 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         self.assertIn(b2.id, store)
         self.assertEqual(b2, store[b2.id])
 
+    def test_from_config(self):
+        config = ConfigDict()
+        store = DiskObjectStore.from_config(self.store_dir, config)
+        self.assertEqual(DEFAULT_DELTA_BASE_CACHE_SIZE,
+                         store._delta_base_cache_size)
+        config.set(('core', ), 'deltaBaseCacheLimit', '96m')
+        store = DiskObjectStore.from_config(self.store_dir, config)
+        self.assertEqual(96 * 1024 * 1024, store._delta_base_cache_size)
+
+    def test_shared_delta_base_cache(self):
+        b1 = make_object(Blob, data='yummy data ' * 100)
+        b2 = make_object(Blob, data='yummy data ' * 100 + 'more')
+        b3 = make_object(Blob, data='other data ' * 100)
+        b4 = make_object(Blob, data='other data ' * 100 + 'more')
+        self.store.add_objects([(b1, None), (b2, None)])
+        self.store.add_objects([(b3, None), (b4, None)])
+        caches = [pack.data._delta_base_cache for pack in self.store.packs]
+        self.assertEqual(2, len(caches))
+        self.assertTrue(caches[0] is caches[1])
+        for blob in (b1, b2, b3, b4):
+            self.assertEqual(blob, self.store[blob.id])
+        # Objects at the same offset in both packs are kept apart.
+        for blob in (b1, b2, b3, b4):
+            self.assertEqual(blob, self.store[blob.id])
+
     def test_add_alternate_path(self):
         store = DiskObjectStore(self.store_dir)
         self.assertEqual([], store._read_alternate_paths())
@@ -294,6 +404,66 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         self.assertIn(b2.id, store)
         self.assertEqual(b2, store[b2.id])
 
+    def test_contains_many_mixed(self):
+        alternate_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, alternate_dir)
+        alternate_store = DiskObjectStore(alternate_dir)
+        b1 = make_object(Blob, data="packed")
+        b2 = make_object(Blob, data="loose")
+        b3 = make_object(Blob, data="alternate")
+        self.store.add_objects([(b1, None)])
+        self.store.add_object(b2)
+        alternate_store.add_object(b3)
+        self.store.add_alternate_path(alternate_dir)
+        self.assertEqual(set([b1.id, b2.id, b3.id]),
+            self.store.contains_many([b1.id, b2.id, b3.id, "a" * 40]))
+
+    def _add_delta_pack(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'yummy data'),
+          (OFS_DELTA, (0, 'more yummy data')),
+          ])
+        pack_f, commit, abort = self.store.add_pack()
+        pack_f.write(f.getvalue())
+        commit()
+        return [sha_to_hex(e[3]) for e in entries]
+
+    def test_iter_pack_records_reuse(self):
+        base, delta = self._add_delta_pack()
+        records = list(self.store.iter_pack_records([delta, base]))
+        self.assertEqual([base, delta], [sha_to_hex(r[1]) for r in records])
+        self.assertEqual(None, records[0][2])
+        self.assertEqual(base, sha_to_hex(records[1][2]))
+        for r in records:
+            self.assertTrue(isinstance(r[3], UnpackedObject))
+        f = BytesIO()
+        write_pack_data(f, len(records), records)
+        f.seek(0)
+        data = PackData.from_file(f, len(f.getvalue()))
+        self.assertEqual([Blob.type_num, OFS_DELTA],
+                         [u.pack_type_num for u in data._iter_unpacked()])
+        self.assertEqual(set([base, delta]),
+                         set(o.id for o in PackInflater.for_pack_data(data)))
+
+    def test_iter_pack_records_base_not_sent(self):
+        base, delta = self._add_delta_pack()
+        records = list(self.store.iter_pack_records([delta]))
+        self.assertEqual(None, records[0][2])
+        self.assertEqual('more yummy data', records[0][3])
+
+    def test_iter_pack_records_thin(self):
+        base, delta = self._add_delta_pack()
+        records = list(self.store.iter_pack_records([delta],
+                                                    remote_has=set([base])))
+        self.assertEqual(base, sha_to_hex(records[0][2]))
+        f = BytesIO()
+        write_pack_data(f, len(records), records)
+        f.seek(0)
+        data = PackData.from_file(f, len(f.getvalue()))
+        self.assertEqual([REF_DELTA],
+                         [u.pack_type_num for u in data._iter_unpacked()])
+
     def test_pack_dir(self):
         o = DiskObjectStore(self.store_dir)
         self.assertEqual(os.path.join(self.store_dir, "pack"), o.pack_dir)
@@ -332,6 +502,461 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
             o.close()
             pack.close()
 
+    def test_add_thin_pack_threads(self):
+        o = DiskObjectStore(self.store_dir)
+        blob = make_object(Blob, data='yummy data')
+        o.add_object(blob)
+
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'other data'),
+          (OFS_DELTA, (0, 'other data 2')),
+          (REF_DELTA, (blob.id, 'more yummy data')),
+          ], store=o)
+        pack = o.add_thin_pack(f.read, None, threads=2)
+        try:
+            pack.check_length_and_checksum()
+            pack.check()
+            self.assertEqual(
+              sorted([blob.id] + [sha_to_hex(e[3]) for e in entries]),
+              list(pack))
+            self.assertEqual((Blob.type_num, 'more yummy data'),
+                             o.get_raw(sha_to_hex(entries[2][3])))
+        finally:
+            o.close()
+            pack.close()
+
+    def test_pack_order(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(4)]
+        small = self.store.add_objects([(blobs[0], None)])
+        large = self.store.add_objects([(b, None) for b in blobs[1:]])
+        small_name, large_name = small.name(), large.name()
+        store = DiskObjectStore(self.store_dir)
+        self.addCleanup(store.close)
+        # Largest first, until there are hits.
+        self.assertEqual([large_name, small_name],
+                         [p.name() for p in store.packs])
+        self.assertEqual(blobs[1], store[blobs[1].id])
+        self.assertEqual(blobs[0], store[blobs[0].id])
+        self.assertEqual([small_name, large_name],
+                         [p.name() for p in store.packs])
+        self.assertTrue(store.contains_packed(blobs[2].id))
+        self.assertEqual([large_name, small_name],
+                         [p.name() for p in store.packs])
+        small_pack, large_pack = store.packs[1], store.packs[0]
+        self.assertEqual((1, 1), (small_pack.hits, small_pack.misses))
+        self.assertEqual((2, 1), (large_pack.hits, large_pack.misses))
+
+    def test_pack_order_new_pack(self):
+        b1 = make_object(Blob, data='yummy data')
+        b2 = make_object(Blob, data='more yummy data')
+        self.store.add_objects([(b1, None)])
+        self.assertEqual(b1, self.store[b1.id])
+        pack = self.store.add_objects([(b2, None)])
+        self.assertEqual(2, len(self.store.packs))
+        self.assertTrue(pack is self.store.packs[-1])
+        self.assertEqual(b2, self.store[b2.id])
+        self.assertTrue(pack is self.store.packs[0])
+
+    def test_repack(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(4)]
+        self.store.add_objects([(blobs[0], None), (blobs[1], None)])
+        self.store.add_objects([(blobs[1], None), (blobs[2], None)])
+        self.store.add_object(blobs[3])
+        self.assertEqual(2, len(self.store.packs))
+        pack = self.store.repack()
+        self.assertEqual([pack], self.store.packs)
+        self.assertEqual(4, len(pack))
+        self.assertEqual([], list(self.store._iter_loose_objects()))
+        self.assertEqual(
+            ['%s.%s' % (pack._basename, ext) for ext in ('idx', 'pack')],
+            sorted(os.path.join(self.store.pack_dir, name)
+                   for name in os.listdir(self.store.pack_dir)))
+        for blob in blobs:
+            self.assertEqual(blob, self.store[blob.id])
+        # Nothing changes when repacking again.
+        self.assertEqual(pack.name(), self.store.repack().name())
+        self.assertEqual(1, len(self.store.packs))
+        self.assertEqual(blobs[0], self.store[blobs[0].id])
+
+    def test_repack_deltify(self):
+        b1 = make_object(Blob, data='yummy data ' * 100)
+        b2 = make_object(Blob, data='yummy data ' * 100 + 'and more')
+        self.store.add_object(b1)
+        self.store.add_object(b2)
+        pack = self.store.repack(deltify=True)
+        self.assertEqual([3, OFS_DELTA],
+                         sorted(unpacked.pack_type_num
+                                for unpacked in pack.data._iter_unpacked()))
+        self.assertEqual(b1, self.store[b1.id])
+        self.assertEqual(b2, self.store[b2.id])
+
+    def test_repack_no_deltify(self):
+        b1 = make_object(Blob, data='yummy data ' * 100)
+        b2 = make_object(Blob, data='yummy data ' * 100 + 'and more')
+        self.store.add_object(b1)
+        self.store.add_object(b2)
+        pack = self.store.repack(deltify=False)
+        self.assertEqual([3, 3],
+                         sorted(unpacked.pack_type_num
+                                for unpacked in pack.data._iter_unpacked()))
+
+    def test_repack_deltify_processes(self):
+        tree = Tree()
+        blobs = []
+        for i in range(12):
+            blob = make_object(Blob, data='yummy data\n' * (100 + i))
+            self.store.add_object(blob)
+            tree.add('blob%d' % i, 0o100644, blob.id)
+            blobs.append(blob)
+        self.store.add_object(tree)
+        pack = self.store.repack([tree.id], deltify=True, processes=2)
+        self.assertEqual(13, len(pack))
+        self.assertIn(OFS_DELTA, [unpacked.pack_type_num
+                                  for unpacked in pack.data._iter_unpacked()])
+        for blob in blobs:
+            self.assertEqual(blob, self.store[blob.id])
+
+    def test_find_reachable_paths(self):
+        blob = make_object(Blob, data='yummy data')
+        subtree = Tree()
+        subtree.add('blob', 0o100644, blob.id)
+        tree = Tree()
+        tree.add('dir', 0o40000, subtree.id)
+        self.store.add_object(blob)
+        self.store.add_object(subtree)
+        self.store.add_object(tree)
+        paths = {}
+        self.assertEqual(set([tree.id, subtree.id, blob.id]),
+                         self.store._find_reachable([tree.id], paths))
+        self.assertEqual({subtree.id: 'dir', blob.id: 'blob'}, paths)
+
+    def test_repack_keep(self):
+        b1 = make_object(Blob, data='yummy data')
+        b2 = make_object(Blob, data='more yummy data')
+        b3 = make_object(Blob, data='even more yummy data')
+        kept = self.store.add_objects([(b1, None)])
+        kept.keep()
+        self.store.add_objects([(b2, None)])
+        self.store.add_objects([(b3, None)])
+        pack = self.store.repack()
+        self.assertEqual(2, len(self.store.packs))
+        self.assertEqual(set([b2.id, b3.id]), set(pack))
+        self.assertTrue(os.path.exists(kept._basename + '.pack'))
+        self.assertEqual(b1, self.store[b1.id])
+
+    def test_repack_unreachable(self):
+        blob = make_object(Blob, data='yummy data')
+        tree = Tree()
+        tree.add('blob', 0o100644, blob.id)
+        unreachable = make_object(Blob, data='unreachable data')
+        unreachable_loose = make_object(Blob, data='unreachable loose data')
+        self.store.add_objects([(blob, None), (unreachable, None)])
+        self.store.add_object(tree)
+        self.store.add_object(unreachable_loose)
+        # Objects that are still within the grace period are kept loose.
+        pack = self.store.repack([tree.id])
+        self.assertEqual(set([tree.id, blob.id]), set(pack))
+        self.assertTrue(self.store.contains_loose(unreachable.id))
+        self.assertTrue(self.store.contains_loose(unreachable_loose.id))
+        # Once they have expired, they are removed.
+        self.assertEqual(pack.name(),
+                         self.store.repack([tree.id], grace_period=-1).name())
+        self.assertEqual([], list(self.store._iter_loose_objects()))
+        self.assertNotIn(unreachable.id, self.store)
+        self.assertNotIn(unreachable_loose.id, self.store)
+        self.assertEqual(blob, self.store[blob.id])
+
+    def test_repack_multi_pack_index(self):
+        b1 = make_object(Blob, data='yummy data')
+        b2 = make_object(Blob, data='more yummy data')
+        self.store.add_objects([(b1, None)])
+        self.store.add_objects([(b2, None)])
+        self.store.write_multi_pack_index()
+        self.store.repack()
+        self.assertFalse(os.path.exists(os.path.join(
+            self.store.pack_dir, 'multi-pack-index')))
+        self.assertEqual(None, self.store._midx)
+        self.assertEqual(b1, self.store[b1.id])
+        self.assertEqual(b2, self.store[b2.id])
+
+    def _add_packs(self, sizes):
+        packs = []
+        for i, size in enumerate(sizes):
+            packs.append(self.store.add_objects(
+                [(make_object(Blob, data='pack %d blob %d' % (i, j)), None)
+                 for j in range(size)]))
+        return packs
+
+    def test_plan_geometric_repack(self):
+        self._add_packs([1, 1, 1, 7, 16])
+        self.assertEqual([1, 1, 1],
+                         [len(p) for (name, p)
+                          in self.store.plan_geometric_repack()])
+
+    def test_plan_geometric_repack_cascade(self):
+        # The merged pack would be too large to precede the pack of 5.
+        self._add_packs([1, 1, 1, 5, 16])
+        self.assertEqual([1, 1, 1, 5],
+                         [len(p) for (name, p)
+                          in self.store.plan_geometric_repack()])
+
+    def test_plan_geometric_repack_progression(self):
+        self._add_packs([1, 2, 4, 8])
+        self.assertEqual([], self.store.plan_geometric_repack())
+
+    def test_geometric_repack(self):
+        packs = self._add_packs([1, 1, 4])
+        shas = set()
+        for pack in packs:
+            shas.update(pack)
+        self.assertEqual(2, len(self.store.geometric_repack()))
+        self.assertEqual([2, 4], sorted(len(p) for p in self.store.packs))
+        self.assertEqual(None, self.store.geometric_repack())
+        for sha in shas:
+            self.assertTrue(self.store.contains_packed(sha))
+
+    def test_geometric_repack_keep(self):
+        packs = self._add_packs([1, 1, 1])
+        packs[0].keep()
+        self.assertEqual(2, len(self.store.geometric_repack()))
+        self.assertEqual([1, 2], sorted(len(p) for p in self.store.packs))
+        self.assertIn(packs[0], self.store.packs)
+
+    def _build_bitmap_history(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(4)]
+        trees = {1: [('a', blobs[0])],
+                 2: [('a', blobs[1]), ('d/b', blobs[0])],
+                 3: [('a', blobs[2])],
+                 4: [('a', blobs[1]), ('d/b', blobs[0]), ('c', blobs[3])]}
+        commits = build_commit_graph(self.store, [[1], [2, 1], [3, 1],
+                                                  [4, 2, 3]], trees)
+        pack = self.store.repack()
+        return pack, [c.id for c in commits]
+
+    def test_write_bitmap(self):
+        pack, (c1, c2, c3, c4) = self._build_bitmap_history()
+        self.store.write_bitmap(pack, [c2, c4])
+        bitmap = pack.bitmap
+        # Besides the tips, the newest other commit gets a bitmap.
+        self.assertEqual(set([c2, c3, c4]),
+                         set(c for c in (c1, c2, c3, c4) if c in bitmap))
+        for commit in (c2, c3, c4):
+            self.assertEqual(self.store._find_reachable([commit]),
+                             set(bitmap.iter_shas(bitmap[commit])))
+        self.assertEqual(set([c1, c2, c3, c4]),
+                         set(bitmap.iter_shas(bitmap.commits)))
+        self.assertEqual(0, bitmap.tags)
+        self.assertEqual(len(pack), len(list(bitmap.iter_shas(
+            bitmap.commits | bitmap.trees | bitmap.blobs))))
+
+    def test_write_bitmap_outside_pack(self):
+        c1, = build_commit_graph(self.store, [[1]])
+        pack = self.store.repack()
+        c2, = build_commit_graph(self.store, [[2]],
+                                 attrs={2: {'parents': [c1.id]}})
+        pack = self.store.add_objects([(c2, None)])
+        self.store.write_bitmap(pack)
+        self.assertEqual(0, len(pack.bitmap))
+
+    def test_repack_write_bitmap(self):
+        pack, (c1, c2, c3, c4) = self._build_bitmap_history()
+        tag = self.make_tag('c2', self.store[c2])
+        pack = self.store.repack([tag.id, c4], write_bitmap=True)
+        self.assertIn(c2, pack.bitmap)
+        self.assertIn(c4, pack.bitmap)
+        self.assertEqual(1, len(list(pack.bitmap.iter_shas(pack.bitmap.tags))))
+        # Bitmaps of removed packs are removed along with them.
+        self.store.add_object(make_object(Blob, data='more data'))
+        self.store.repack([c4])
+        self.assertEqual(
+            [], [name for name in os.listdir(self.store.pack_dir)
+                 if name.endswith('.bitmap')])
+
+    def test_find_missing_objects_bitmap(self):
+        pack, (c1, c2, c3, c4) = self._build_bitmap_history()
+        self.assertEqual(None,
+                         self.store.find_missing_objects_bitmap([c1], [c4]))
+        self.store.write_bitmap(pack, [c2])
+        reachable = self.store._find_reachable
+        for haves, wants in [([], [c4]), ([c1], [c4]), ([c3], [c2]),
+                             ([c2, '1' * 40], [c4]), ([c4], [c4])]:
+            missing = list(self.store.find_missing_objects_bitmap(
+                haves, wants))
+            self.assertEqual(
+                sorted(reachable(wants) - reachable(haves)),
+                sorted(sha for (sha, path) in missing))
+        # The objects the receiver has are recorded, for thin packs.
+        missing = self.store.find_missing_objects_bitmap([c2], [c4])
+        for sha in reachable([c4]):
+            self.assertEqual(sha in reachable([c2]), sha in missing.sha_done)
+
+    def test_find_missing_objects_bitmap_outside_pack(self):
+        pack, (c1, c2, c3, c4) = self._build_bitmap_history()
+        self.store.write_bitmap(pack)
+        c5, = build_commit_graph(
+            self.store, [[5]], trees={5: [('e', make_object(Blob, data='e'))]},
+            attrs={5: {'parents': [c4]}})
+        missing = self.store.find_missing_objects_bitmap([c2], [c5.id])
+        self.assertEqual(
+            sorted(self.store._find_reachable([c5.id]) -
+                   self.store._find_reachable([c2])),
+            sorted(sha for (sha, path) in missing))
+
+    def test_find_missing_objects_bitmap_tagged(self):
+        pack, (c1, c2, c3, c4) = self._build_bitmap_history()
+        tag = self.make_tag('c3', self.store[c3])
+        self.store.write_bitmap(pack)
+        missing = self.store.find_missing_objects_bitmap(
+            [c2], [c4], get_tagged=lambda: {c3: tag.id})
+        shas = [sha for (sha, path) in missing]
+        self.assertIn(tag.id, shas)
+        self.assertIn(c3, shas)
+        missing = self.store.find_missing_objects_bitmap(
+            [c3], [c4], get_tagged=lambda: {c3: tag.id})
+        self.assertNotIn(tag.id, [sha for (sha, path) in missing])
+
+    def test_write_commit_graph(self):
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 1, 2]])
+        self.assertEqual(None, self.store.commit_graph)
+        self.assertEqual(c3, self.store.lookup_commit(c3.id))
+        tag = self.make_tag('c2', c2)
+        self.store.write_commit_graph([tag.id, c1.id, '1' * 40])
+        self.assertEqual(set([c1.id, c2.id]), set(self.store.commit_graph))
+        entry = self.store.lookup_commit(c2.id)
+        self.assertIsInstance(entry, CommitGraphEntry)
+        self.assertEqual((c2.tree, c2.parents, c2.commit_time),
+                         (entry.tree, entry.parents, entry.commit_time))
+        # Commits that are not in the graph are inflated.
+        self.assertEqual(c3, self.store.lookup_commit(c3.id))
+        self.store.write_commit_graph([c3.id])
+        self.assertEqual(3, len(self.store.commit_graph))
+
+    def test_commit_graph_empty(self):
+        c1, = build_commit_graph(self.store, [[1]])
+        path = os.path.join(self.store.path, 'info', 'commit-graph')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'wb').close()
+        self.assertEqual(None, self.store.commit_graph)
+        self.assertEqual(c1, self.store.lookup_commit(c1.id))
+
+    def test_write_commit_graph_shallow(self):
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 2]])
+        c4, = build_commit_graph(self.store, [[4]],
+                                 attrs={4: {'parents': [c3.id]}})
+        os.remove(self.store._get_shafile_path(c2.id))
+        self.store.write_commit_graph([c4.id, c1.id])
+        self.assertEqual([c1.id], list(self.store.commit_graph))
+
+    def test_get_raw_many_pack_order(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(4)]
+        pack = self.store.add_objects([(b, None) for b in blobs])
+        by_offset = sorted(blobs,
+                           key=lambda b: pack.index.object_index(b.id))
+        self.assertEqual(
+            [b.id for b in by_offset],
+            [sha for (sha, type_num, raw) in
+             self.store.get_raw_many([b.id for b in blobs])])
+
+    def test_pack_filter(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(3)]
+        self.store.add_objects([(blobs[0], None)])
+        self.assertEqual(None, self.store._pack_filter)
+        for i in range(PACK_FILTER_MIN_MISSES):
+            self.assertNotIn('%040x' % i, self.store)
+        self.assertFalse(self.store.contains_packed(blobs[1].id))
+        self.assertNotEqual(None, self.store._pack_filter)
+        self.assertTrue(self.store.contains_packed(blobs[0].id))
+        self.assertEqual(blobs[0], self.store[blobs[0].id])
+        # Adding a pack or a loose object must not hide it.
+        self.store.add_objects([(blobs[1], None)])
+        self.assertEqual(None, self.store._pack_filter)
+        self.assertIn(blobs[1].id, self.store)
+        self.store.add_object(blobs[2])
+        self.assertIn(blobs[2].id, self.store)
+        self.assertEqual(blobs[2], self.store[blobs[2].id])
+        self.assertEqual(set(b.id for b in blobs), self.store.contains_many(
+            [b.id for b in blobs] + ['%040x' % 1]))
+
+    def test_contains_loose(self):
+        b = make_object(Blob, data='yummy data')
+        self.assertFalse(self.store.contains_loose(b.id))
+        self.store.add_object(b)
+        self.assertTrue(self.store.contains_loose(b.id))
+
+    def test_multi_pack_index(self):
+        blobs = [make_object(Blob, data='blob %d' % i) for i in range(3)]
+        self.store.add_objects([(blobs[0], None)])
+        self.store.add_objects([(blobs[0], None), (blobs[1], None)])
+        self.store.write_multi_pack_index()
+        self.assertTrue(os.path.exists(os.path.join(
+            self.store.pack_dir, 'multi-pack-index')))
+        self.store.add_objects([(blobs[2], None)])
+
+        store = DiskObjectStore(self.store_dir)
+        self.addCleanup(store.close)
+        self.assertEqual(3, len(store.packs))
+        self.assertEqual(2, len(store._midx.pack_names))
+        self.assertEqual(1, len(store._unindexed_packs()))
+        for blob in blobs:
+            self.assertTrue(store.contains_packed(blob.id))
+            self.assertIn(blob.id, store)
+            self.assertEqual(blob, store[blob.id])
+        missing = make_object(Blob, data='missing')
+        self.assertFalse(store.contains_packed(missing.id))
+        self.assertEqual(set(b.id for b in blobs),
+                         store.contains_many([b.id for b in blobs] +
+                                             [missing.id]))
+
+    def test_multi_pack_index_missing_pack(self):
+        b1 = make_object(Blob, data='yummy data')
+        b2 = make_object(Blob, data='more yummy data')
+        self.store.add_objects([(b1, None)])
+        pack = self.store.add_objects([(b2, None)])
+        self.store.write_multi_pack_index()
+        basename = os.path.join(self.store.pack_dir,
+                                'pack-' + pack.name())
+        pack.close()
+        os.remove(basename + '.pack')
+        os.remove(basename + '.idx')
+
+        store = DiskObjectStore(self.store_dir)
+        self.addCleanup(store.close)
+        self.assertEqual(None, store._midx)
+        self.assertEqual(b1, store[b1.id])
+        self.assertNotIn(b2.id, store)
+
+
+    def test_multi_pack_index_truncated(self):
+        b1 = make_object(Blob, data='yummy data')
+        self.store.add_objects([(b1, None)])
+        f = open(os.path.join(self.store.pack_dir, 'multi-pack-index'), 'wb')
+        try:
+            f.write('MIDX\x01\x01')
+        finally:
+            f.close()
+        store = DiskObjectStore(self.store_dir)
+        self.addCleanup(store.close)
+        self.assertEqual(b1, store[b1.id])
+
+
+class ShaBloomFilterTests(TestCase):
+
+    def test_empty(self):
+        f = ShaBloomFilter(0)
+        self.assertNotIn('\x01' * 20, f)
+
+    def test_add(self):
+        f = ShaBloomFilter(10)
+        shas = [make_object(Blob, data='blob %d' % i).sha().digest()
+                for i in range(10)]
+        f.update(shas[:5])
+        f.add(shas[5])
+        for sha in shas[:6]:
+            self.assertIn(sha, f)
+        self.assertNotIn('\x01' * 20, f)
+
 
 class TreeLookupPathTests(TestCase):
 
@@ -25,6 +25,7 @@ from hashlib import sha1
 import os
 import shutil
 import tempfile
+import types
 import zlib
 
 from dulwich.errors import (
@@ -44,36 +45,59 @@ from dulwich.objects import (
     Tree,
     Blob,
     )
+from dulwich import pack as pack_module
 from dulwich.pack import (
     OFS_DELTA,
     REF_DELTA,
     DELTA_TYPES,
+    DeltaBaseCache,
+    MappedReader,
     MemoryPackIndex,
     Pack,
+    PackBitmap,
     PackData,
+    _create_delta_py,
+    _read_zlib_chunks_py,
+    _take_msb_bytes_py,
+    _unpack_object_py,
     apply_delta,
+    bitmap_from_positions,
+    bitmap_positions,
     create_delta,
     deltify_pack_objects,
+    deltify_pack_records,
+    load_multi_pack_index,
+    load_pack_bitmap,
     load_pack_index,
+    read_ewah,
     UnpackedObject,
     read_zlib_chunks,
+    take_msb_bytes,
     write_pack_header,
     write_pack_index_v1,
     write_pack_index_v2,
+    write_multi_pack_index,
+    write_ewah,
     SHA1Writer,
     write_pack_object,
     write_pack,
     unpack_object,
     compute_file_sha,
+    write_pack_objects,
     PackStreamReader,
     DeltaChainIterator,
+    PackIndexer,
+    ParallelPackIndexer,
     )
 from dulwich.tests import (
+    SkipTest,
     TestCase,
     )
 from dulwich.tests.utils import (
     make_object,
     build_pack,
+    ext_functest_builder,
+    functest_builder,
     )
 
 pack1_sha = 'bc63ddad95e7321ee734ea11a7a62d314e0d7481'
@@ -123,6 +147,11 @@ class PackIndexTests(PackTests):
         self.assertEqual(p.object_index(tree_sha), 138)
         self.assertEqual(p.object_index(commit_sha), 12)
 
+    def test_object_index_many(self):
+        p = self.get_pack_index(pack1_sha)
+        self.assertEqual({a_sha: 178, tree_sha: 138},
+                         p.object_index_many([a_sha, pack1_sha, tree_sha]))
+
     def test_index_len(self):
         p = self.get_pack_index(pack1_sha)
         self.assertEqual(3, len(p))
@@ -152,6 +181,212 @@ class PackIndexTests(PackTests):
         self.assertEqual(set([tree_sha, commit_sha, a_sha]), set(p))
 
 
+class MultiPackIndexTests(TestCase):
+
+    def setUp(self):
+        super(MultiPackIndexTests, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def write_midx(self, packs):
+        path = os.path.join(self.tempdir, 'multi-pack-index')
+        f = GitFile(path, 'wb')
+        try:
+            sha = write_multi_pack_index(f, packs)
+        finally:
+            f.close()
+        midx = load_multi_pack_index(path)
+        self.addCleanup(midx.close)
+        self.assertEqual(sha, midx.get_stored_checksum())
+        midx.check()
+        return midx
+
+    def test_empty(self):
+        midx = self.write_midx([])
+        self.assertEqual([], midx.pack_names)
+        self.assertEqual(0, len(midx))
+        self.assertEqual([], list(midx))
+
+    def test_roundtrip(self):
+        sha1, sha2, sha3 = '\x01' * 20, '\x80' * 20, '\xff' * 20
+        midx = self.write_midx([
+            ('pack-b.idx', [(sha1, 12, 0), (sha3, 2**33, 0)]),
+            ('pack-a.idx', [(sha2, 2**31, 0), (sha1, 42, 0)]),
+            ])
+        self.assertEqual(['pack-a.idx', 'pack-b.idx'], midx.pack_names)
+        self.assertEqual(3, len(midx))
+        # sha1 is in both packs, the first one given wins.
+        self.assertEqual([(sha1, 1, 12), (sha2, 0, 2**31), (sha3, 1, 2**33)],
+                         list(midx.iterentries()))
+        self.assertEqual((1, 12), midx.object_pack_offset(sha1))
+        self.assertEqual((0, 2**31), midx.object_pack_offset(sha_to_hex(sha2)))
+        self.assertRaises(KeyError, midx.object_pack_offset, '\x02' * 20)
+        self.assertIn(sha3, midx)
+        self.assertNotIn('\x02' * 20, midx)
+        self.assertEqual({sha1: (1, 12), sha_to_hex(sha3): (1, 2**33)},
+                         midx.object_pack_offset_many(
+                             [sha1, sha_to_hex(sha3), '\x02' * 20]))
+
+    def test_bad_signature(self):
+        path = os.path.join(self.tempdir, 'multi-pack-index')
+        f = open(path, 'wb')
+        try:
+            f.write('PACK' + '\0' * 100)
+        finally:
+            f.close()
+        self.assertRaises(AssertionError, load_multi_pack_index, path)
+
+    def test_truncated(self):
+        self.write_midx([('pack-a.idx', [('\x01' * 20, 12, 0)])])
+        path = os.path.join(self.tempdir, 'multi-pack-index')
+        f = open(path, 'rb')
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        for size in (0, 6, 30, 100, len(contents) - 40):
+            f = open(path, 'wb')
+            try:
+                f.write(contents[:size])
+            finally:
+                f.close()
+            self.assertRaises(AssertionError, load_multi_pack_index, path)
+
+
+class EwahTests(TestCase):
+
+    def assertRoundtrips(self, bits):
+        f = BytesIO()
+        write_ewah(f, bits)
+        f.write('trailing')
+        self.assertEqual((bits, len(f.getvalue()) - 8),
+                         read_ewah(f.getvalue(), 0))
+
+    def test_empty(self):
+        self.assertRoundtrips(0)
+
+    def test_literals(self):
+        self.assertRoundtrips(0x5)
+        self.assertRoundtrips(0x123456789abcdef0123456789abcdef)
+
+    def test_runs(self):
+        self.assertRoundtrips(1 << 1000)
+        self.assertRoundtrips((1 << 640) - 1)
+        self.assertRoundtrips((((1 << 640) - 1) << 200) | 3)
+
+    def test_compressed(self):
+        f = BytesIO()
+        write_ewah(f, 1 << 6400)
+        # One marker with a run of 100 empty words and one literal word.
+        self.assertEqual(8 + 2 * 8 + 4, len(f.getvalue()))
+
+    def test_positions(self):
+        bits = bitmap_from_positions([3, 0, 64, 1000])
+        self.assertEqual(1 | 8 | (1 << 64) | (1 << 1000), bits)
+        self.assertEqual([0, 3, 64, 1000], list(bitmap_positions(bits)))
+        self.assertEqual(0, bitmap_from_positions([]))
+        self.assertEqual([], list(bitmap_positions(0)))
+
+
+class PackBitmapTests(PackTests):
+
+    def setUp(self):
+        super(PackBitmapTests, self).setUp()
+        for ext in ('.pack', '.idx'):
+            shutil.copy(
+                os.path.join(self.datadir, 'pack-%s%s' % (pack1_sha, ext)),
+                self.tempdir)
+        self.pack = Pack(os.path.join(self.tempdir, 'pack-%s' % pack1_sha))
+        self.addCleanup(self.pack.close)
+
+    def test_no_bitmap(self):
+        self.assertEqual(None, self.pack.bitmap)
+
+    def test_roundtrip(self):
+        # In pack order: commit, tree, blob.
+        sha = self.pack.write_bitmap((1, 2, 4, 0),
+                                     {hex_to_sha(commit_sha): 7})
+        bitmap = self.pack.bitmap
+        self.assertEqual((1, 2, 4, 0), (bitmap.commits, bitmap.trees,
+                                        bitmap.blobs, bitmap.tags))
+        self.assertEqual(1, len(bitmap))
+        self.assertIn(commit_sha, bitmap)
+        self.assertNotIn(tree_sha, bitmap)
+        self.assertEqual(7, bitmap[commit_sha])
+        self.assertRaises(KeyError, bitmap.__getitem__, tree_sha)
+        self.assertEqual(1, bitmap.position(tree_sha))
+        self.assertEqual(2, bitmap.position(hex_to_sha(a_sha)))
+        self.assertEqual([tree_sha, a_sha], list(bitmap.iter_shas(6)))
+        f = open(self.pack._bitmap_path, 'rb')
+        try:
+            self.assertEqual(sha, f.read()[-20:])
+        finally:
+            f.close()
+
+    def test_lazy(self):
+        self.pack.write_bitmap((1, 2, 4, 0), {hex_to_sha(commit_sha): 7})
+        bitmap = self.pack.bitmap
+        self.assertEqual({}, bitmap._decoded)
+        self.assertEqual(None, self.pack.reverse_index._offsets)
+        self.assertEqual(7, bitmap[commit_sha])
+        self.assertEqual([4], list(bitmap._decoded))
+        self.assertEqual(None, self.pack.reverse_index._offsets)
+
+    def test_xor(self):
+        f = BytesIO()
+        f.write('BITM\0\x01\0\x01\0\0\0\x02')
+        f.write(self.pack.index.get_pack_checksum())
+        for bits in (1, 2, 4, 0):
+            write_ewah(f, bits)
+        # The second bitmap is stored XORed with the first one.
+        f.write('\0\0\0\0\0\0')
+        write_ewah(f, 7)
+        f.write('\0\0\0\x01\x01\0')
+        write_ewah(f, 5)
+        bitmap = PackBitmap('bitmap', self.pack.index, contents=f.getvalue())
+        names = list(self.pack.index._itersha())
+        self.assertEqual(7, bitmap[names[0]])
+        self.assertEqual(2, bitmap[names[1]])
+
+    def test_truncated(self):
+        self.pack.write_bitmap((1, 2, 4, 0), {hex_to_sha(commit_sha): 7})
+        f = open(self.pack._bitmap_path, 'rb')
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        for size in (0, 6, 40, len(contents) - 30):
+            f = open(self.pack._bitmap_path, 'wb')
+            try:
+                f.write(contents[:size])
+            finally:
+                f.close()
+            self.assertRaises(AssertionError, load_pack_bitmap,
+                              self.pack._bitmap_path, self.pack.index)
+        self.assertEqual(None, self.pack.bitmap)
+
+    def test_unknown_commit(self):
+        self.assertRaises(KeyError, self.pack.write_bitmap, (1, 2, 4, 0),
+                          {'\xff' * 20: 7})
+
+    def test_other_pack(self):
+        self.pack.write_bitmap((1, 2, 4, 0), {})
+        index = self.get_pack_index(pack1_sha)
+        index.get_pack_checksum = lambda: '\0' * 20
+        self.assertRaises(AssertionError, load_pack_bitmap,
+                          self.pack._bitmap_path, index)
+
+    def test_bad_signature(self):
+        f = open(self.pack._bitmap_path, 'wb')
+        try:
+            f.write('PACK' + '\0' * 100)
+        finally:
+            f.close()
+        self.assertRaises(AssertionError, load_pack_bitmap,
+                          self.pack._bitmap_path, self.pack.index)
+        self.assertEqual(None, self.pack.bitmap)
+
+
 class TestPackDeltas(TestCase):
 
     test_string1 = 'The answer was flailing in the wind'
@@ -179,9 +414,28 @@ class TestPackDeltas(TestCase):
         self._test_roundtrip(self.test_string_empty, self.test_string_big)
 
     def test_overflow_64k(self):
-        self.skipTest("big strings don't work yet")
         self._test_roundtrip(self.test_string_huge, self.test_string_huge)
 
+    def _do_test_create_delta(self, create_delta_impl):
+        base = ''.join('line %d\n' % i for i in xrange(5000))
+        target = base[:1000] + 'x' * 300 + base[1500:] + 'tail'
+        delta = create_delta_impl(base, target)
+        self.assertEqual(target, ''.join(apply_delta(base, delta)))
+        self.assertTrue(len(delta) < 500)
+        self.assertEqual(self.test_string_huge,
+                         ''.join(apply_delta(self.test_string_huge,
+                             create_delta_impl(self.test_string_huge,
+                                               self.test_string_huge))))
+        self.assertEqual(self.test_string2,
+                         ''.join(apply_delta(self.test_string1,
+                             create_delta_impl(self.test_string1,
+                                               self.test_string2))))
+
+    test_create_delta = functest_builder(_do_test_create_delta,
+                                         _create_delta_py)
+    test_create_delta_extension = ext_functest_builder(_do_test_create_delta,
+                                                       create_delta)
+
 
 class TestPackData(PackTests):
     """Tests getting the data from the packfile."""
@@ -221,6 +475,52 @@ class TestPackData(PackTests):
           (178, 3, 'test 1\n', 1373561701)
           ], actual)
 
+    def test_iter_chunks(self):
+        path = os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha)
+        with open(path, 'rb') as f:
+            contents = f.read()
+        p = self.get_pack_data(pack1_sha)
+        self.assertEqual(contents, ''.join(p.iter_chunks()))
+        self.assertEqual(contents, ''.join(p.iter_chunks(chunk_size=7)))
+        f = BytesIO(contents)
+        p = PackData.from_file(f, len(contents))
+        self.assertEqual(contents, ''.join(p.iter_chunks(chunk_size=7)))
+
+    def test_resolve_object_caches_chain(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+            (Blob.type_num, 'base'),
+            (OFS_DELTA, (0, 'base1')),
+            (OFS_DELTA, (1, 'base12')),
+            (OFS_DELTA, (2, 'base123'))])
+        p = PackData.from_file(f, len(f.getvalue()))
+        offset = entries[3][0]
+        type_num, obj = p.get_object_at(offset)
+        self.assertEqual((Blob.type_num, ['base123']),
+                         p.resolve_object(offset, type_num, obj))
+        for entry in entries:
+            self.assertEqual((Blob.type_num, [entry[2]]),
+                             p.get_object_at(entry[0]))
+
+    def test_iterobjects_unmapped(self):
+        path = os.path.join(self.datadir, 'pack-%s.pack' % pack1_sha)
+        f = open(path, 'rb')
+        try:
+            mapped = list(PackData(path, file=f).iterobjects())
+        finally:
+            f.close()
+        f = BytesIO(open(path, 'rb').read())
+        p = PackData.from_file(f, len(f.getvalue()))
+        self.assertEqual(None, p._contents)
+        self.assertEqual(mapped, list(p.iterobjects()))
+
+    def test_mapped(self):
+        p = self.get_pack_data(pack1_sha)
+        self.addCleanup(p.close)
+        self.assertNotEqual(None, p._contents)
+        self.assertEqual((3, ['test 1\n']), p.get_object_at(178))
+        self.assertEqual(p.calculate_checksum(), p.get_stored_checksum())
+
     def test_iterentries(self):
         p = self.get_pack_data(pack1_sha)
         entries = set((sha_to_hex(s), o, c) for s, o, c in p.iterentries())
@@ -261,6 +561,48 @@ class TestPackData(PackTests):
           compute_file_sha(f, start_ofs=4, end_ofs=-4).hexdigest())
 
 
+class DeltaBaseCacheTests(TestCase):
+
+    def test_get(self):
+        cache = DeltaBaseCache(100)
+        self.assertRaises(KeyError, cache.__getitem__, 12)
+        cache.add(12, (3, ['foo']), 3)
+        self.assertEqual((3, ['foo']), cache[12])
+        self.assertTrue(12 in cache)
+        self.assertEqual(3, cache.get_cost(12))
+        self.assertEqual(None, cache.get_cost(13))
+
+    def test_too_large(self):
+        cache = DeltaBaseCache(5)
+        cache.add(12, (3, ['foobarbaz']), 9)
+        self.assertFalse(12 in cache)
+
+    def test_evicts_cheapest(self):
+        cache = DeltaBaseCache(10)
+        cache.add(12, (3, ['aaaa']), 4)
+        cache.add(20, (3, ['bbbb']), 40)
+        cache.add(28, (3, ['cccc']), 8)
+        self.assertFalse(12 in cache)
+        self.assertTrue(20 in cache)
+        self.assertTrue(28 in cache)
+        self.assertEqual(8, cache._size)
+
+    def test_aging(self):
+        cache = DeltaBaseCache(10)
+        cache.add(12, (3, ['aaaaa']), 50)
+        for i in range(20):
+            cache.add(100 + i, (3, ['bbbbb']), 10)
+            cache[100 + i]
+        self.assertFalse(12 in cache)
+        self.assertEqual(2, len(cache))
+
+    def test_clear(self):
+        cache = DeltaBaseCache(10)
+        cache.add(12, (3, ['aaaa']), 4)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+
 class TestPack(PackTests):
 
     def test_len(self):
@@ -279,6 +621,13 @@ class TestPack(PackTests):
         p = self.get_pack(pack1_sha)
         self.assertEqual(set([tree_sha, commit_sha, a_sha]), set(p))
 
+    def test_iter_object_types(self):
+        p = self.get_pack(pack1_sha)
+        self.assertEqual([(hex_to_sha(commit_sha), 12, Commit.type_num),
+                          (hex_to_sha(tree_sha), 138, Tree.type_num),
+                          (hex_to_sha(a_sha), 178, Blob.type_num)],
+                         list(p.iter_object_types()))
+
     def test_iterobjects(self):
         p = self.get_pack(pack1_sha)
         expected = set([p[s] for s in [commit_sha, tree_sha, a_sha]])
@@ -305,6 +654,18 @@ class TestPack(PackTests):
         self.assertEqual(obj.type_name, 'commit')
         self.assertEqual(obj.sha().hexdigest(), commit_sha)
 
+    def test_reverse_index(self):
+        p = self.get_pack(pack1_sha)
+        rev = p.reverse_index
+        # In pack order: commit, tree, blob.
+        self.assertEqual([commit_sha, tree_sha, a_sha],
+                         [sha_to_hex(rev.name(i)) for i in range(3)])
+        self.assertEqual(2, rev.position(a_sha))
+        self.assertRaises(KeyError, rev.position, '1' * 40)
+        offset = p.index.object_index(tree_sha)
+        self.assertEqual(tree_sha, sha_to_hex(rev.name_at(offset)))
+        self.assertRaises(KeyError, rev.name_at, offset + 1)
+
     def test_copy(self):
         origpack = self.get_pack(pack1_sha)
 
@@ -572,6 +933,27 @@ class BaseTestPackIndexWriting(object):
                 self.assertTrue(actual_crc is None)
 
 
+    def test_object_index_many(self):
+        shas = [hex_to_sha(h) for h in [
+          '00' * 20,
+          '6f670c0fb53f9463760b7295fbb814e965fb20c8',
+          '6f670c0fb53f9463760b7295fbb814e965fb20c9',
+          '6f8a0c0fb53f9463760b7295fbb814e965fb20c8',
+          'ff' * 20]]
+        entries = [(sha, i * 10, i) for (i, sha) in enumerate(shas)]
+        idx = self.index('many.idx', entries, pack_checksum)
+        missing = [hex_to_sha(h) for h in [
+          '01' * 20,
+          '6f670c0fb53f9463760b7295fbb814e965fb20c7',
+          '6f7a0c0fb53f9463760b7295fbb814e965fb20c8',
+          'fe' * 20]]
+        self.assertEqual(dict((sha, i * 10) for (i, sha) in enumerate(shas)),
+                         idx.object_index_many(shas + missing))
+        self.assertEqual({sha_to_hex(shas[1]): 10},
+                         idx.object_index_many([sha_to_hex(shas[1])]))
+        self.assertEqual({}, idx.object_index_many(missing))
+
+
 class BaseTestFilePackIndexWriting(BaseTestPackIndexWriting):
 
     def setUp(self):
@@ -643,6 +1025,8 @@ class TestPackIndexWritingv2(TestCase, BaseTestFilePackIndexWriting):
 
 class ReadZlibTests(TestCase):
 
+    read_zlib_chunks = staticmethod(_read_zlib_chunks_py)
+
     decomp = (
       'tree 4ada885c9196b6b6fa08744b5862bf92896fc002\n'
       'parent None\n'
@@ -661,38 +1045,52 @@ class ReadZlibTests(TestCase):
     def test_decompress_size(self):
         good_decomp_len = len(self.decomp)
         self.unpacked.decomp_len = -1
-        self.assertRaises(ValueError, read_zlib_chunks, self.read,
+        self.assertRaises(ValueError, self.read_zlib_chunks, self.read,
                           self.unpacked)
         self.unpacked.decomp_len = good_decomp_len - 1
-        self.assertRaises(zlib.error, read_zlib_chunks, self.read,
+        self.assertRaises(zlib.error, self.read_zlib_chunks, self.read,
                           self.unpacked)
         self.unpacked.decomp_len = good_decomp_len + 1
-        self.assertRaises(zlib.error, read_zlib_chunks, self.read,
+        self.assertRaises(zlib.error, self.read_zlib_chunks, self.read,
+                          self.unpacked)
+
+    def test_decompress_size_too_large(self):
+        # A corrupt header must not make the reader allocate what it says.
+        self.unpacked.decomp_len = 1 << 60
+        self.assertRaises(zlib.error, self.read_zlib_chunks, self.read,
                           self.unpacked)
 
+    def test_decompress_large(self):
+        decomp = ''.join('line %d\n' % i for i in range(300000))
+        read = BytesIO(zlib.compress(decomp) + self.extra).read
+        unpacked = UnpackedObject(Blob.type_num, None, len(decomp), None)
+        unused = self.read_zlib_chunks(read, unpacked)
+        self.assertEqual(decomp, ''.join(unpacked.decomp_chunks))
+        self.assertEqual(self.extra, unused + read())
+
     def test_decompress_truncated(self):
         read = BytesIO(self.comp[:10]).read
-        self.assertRaises(zlib.error, read_zlib_chunks, read, self.unpacked)
+        self.assertRaises(zlib.error, self.read_zlib_chunks, read, self.unpacked)
 
         read = BytesIO(self.comp).read
-        self.assertRaises(zlib.error, read_zlib_chunks, read, self.unpacked)
+        self.assertRaises(zlib.error, self.read_zlib_chunks, read, self.unpacked)
 
     def test_decompress_empty(self):
         unpacked = UnpackedObject(Tree.type_num, None, 0, None)
         comp = zlib.compress('')
         read = BytesIO(comp + self.extra).read
-        unused = read_zlib_chunks(read, unpacked)
+        unused = self.read_zlib_chunks(read, unpacked)
         self.assertEqual('', ''.join(unpacked.decomp_chunks))
         self.assertNotEquals('', unused)
         self.assertEqual(self.extra, unused + read())
 
     def test_decompress_no_crc32(self):
         self.unpacked.crc32 = None
-        read_zlib_chunks(self.read, self.unpacked)
+        self.read_zlib_chunks(self.read, self.unpacked)
         self.assertEqual(None, self.unpacked.crc32)
 
     def _do_decompress_test(self, buffer_size, **kwargs):
-        unused = read_zlib_chunks(self.read, self.unpacked,
+        unused = self.read_zlib_chunks(self.read, self.unpacked,
                                   buffer_size=buffer_size, **kwargs)
         self.assertEqual(self.decomp, ''.join(self.unpacked.decomp_chunks))
         self.assertEqual(zlib.crc32(self.comp), self.unpacked.crc32)
@@ -722,6 +1120,136 @@ class ReadZlibTests(TestCase):
         self.assertEqual(self.comp, ''.join(self.unpacked.comp_chunks))
 
 
+class ReadZlibExtensionTests(ReadZlibTests):
+
+    read_zlib_chunks = staticmethod(read_zlib_chunks)
+
+    def setUp(self):
+        super(ReadZlibExtensionTests, self).setUp()
+        if not isinstance(read_zlib_chunks, types.BuiltinFunctionType):
+            raise SkipTest("read_zlib_chunks extension not found")
+
+
+class UnpackObjectTests(TestCase):
+
+    def _do_test_take_msb_bytes(self, take_msb_bytes_impl):
+        read = BytesIO('\x91\x82\x03rest').read
+        self.assertEqual(([0x91, 0x82, 0x03], None), take_msb_bytes_impl(read))
+        self.assertEqual('rest', read())
+        read = BytesIO('\x91\x82\x03').read
+        bytes, crc32 = take_msb_bytes_impl(read, 0)
+        self.assertEqual(zlib.crc32('\x91\x82\x03') & 0xffffffff,
+                         crc32 & 0xffffffff)
+
+    test_take_msb_bytes = functest_builder(_do_test_take_msb_bytes,
+                                           _take_msb_bytes_py)
+    test_take_msb_bytes_extension = ext_functest_builder(
+        _do_test_take_msb_bytes, take_msb_bytes)
+
+    def _do_test_unpack_object(self, unpack_object_impl):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob' * 1000),
+          (OFS_DELTA, (0, 'blob' * 999 + 'blob1')),
+          (REF_DELTA, (0, 'blob2' + 'blob' * 999)),
+          ])
+        data = f.getvalue()
+        for i, (offset, type_num, obj, sha, crc32) in enumerate(entries):
+            reader = MappedReader(data, offset)
+            unpacked, unused = unpack_object_impl(
+              reader.read, read_some=reader.read_some, compute_crc32=True,
+              include_comp=True, zlib_bufsize=7)
+            self.assertEqual(crc32, unpacked.crc32)
+            if i == 0:
+                self.assertEqual(Blob.type_num, unpacked.pack_type_num)
+                self.assertEqual(obj, ''.join(unpacked.obj_chunks))
+                self.assertEqual(None, unpacked.delta_base)
+            elif i == 1:
+                self.assertEqual(OFS_DELTA, unpacked.pack_type_num)
+                self.assertEqual(offset - entries[0][0], unpacked.delta_base)
+            else:
+                self.assertEqual(REF_DELTA, unpacked.pack_type_num)
+                self.assertEqual(entries[0][3], unpacked.delta_base)
+            self.assertEqual(unpacked.decomp_len,
+                             len(''.join(unpacked.decomp_chunks)))
+            end = reader.offset - len(unused)
+            self.assertEqual(zlib.decompress(''.join(unpacked.comp_chunks)),
+                             ''.join(unpacked.decomp_chunks))
+            self.assertEqual(crc32, zlib.crc32(data[offset:end]) & 0xffffffff)
+
+    test_unpack_object = functest_builder(_do_test_unpack_object,
+                                          _unpack_object_py)
+    test_unpack_object_extension = ext_functest_builder(
+        _do_test_unpack_object, unpack_object)
+
+    def _do_test_unpack_object_no_crc32(self, unpack_object_impl):
+        f = BytesIO()
+        build_pack(f, [(Blob.type_num, 'blob')])
+        f.seek(12)
+        unpacked, unused = unpack_object_impl(f.read)
+        self.assertEqual(None, unpacked.crc32)
+        self.assertEqual(None, unpacked.comp_chunks)
+        self.assertEqual('blob', ''.join(unpacked.obj_chunks))
+        self.assertEqual(20, len(unused + f.read()))
+
+    test_unpack_object_no_crc32 = functest_builder(
+        _do_test_unpack_object_no_crc32, _unpack_object_py)
+    test_unpack_object_no_crc32_extension = ext_functest_builder(
+        _do_test_unpack_object_no_crc32, unpack_object)
+
+    def _do_test_unpack_object_corrupt(self, unpack_object_impl):
+        f = BytesIO()
+        build_pack(f, [(Blob.type_num, 'blob')])
+        data = f.getvalue()
+        read = BytesIO(data[12:16] + 'garbage' + data[16:]).read
+        self.assertRaises(zlib.error, unpack_object_impl, read)
+
+    test_unpack_object_corrupt = functest_builder(
+        _do_test_unpack_object_corrupt, _unpack_object_py)
+    test_unpack_object_corrupt_extension = ext_functest_builder(
+        _do_test_unpack_object_corrupt, unpack_object)
+
+    def test_unpack_object_py_helpers(self):
+        # The Python version must not use the C helpers, which replace
+        # take_msb_bytes and read_zlib_chunks when the extension is built.
+        def fail(*args, **kwargs):
+            self.fail('extension function called')
+        for name in ('take_msb_bytes', 'read_zlib_chunks'):
+            self.addCleanup(setattr, pack_module, name,
+                           getattr(pack_module, name))
+            setattr(pack_module, name, fail)
+        self._do_test_unpack_object(_unpack_object_py)
+
+
+class MappedReaderTests(TestCase):
+
+    def test_read(self):
+        reader = MappedReader('abcdef', 1)
+        self.assertEqual('bc', reader.read(2))
+        self.assertEqual(3, reader.offset)
+        self.assertEqual('def', reader.read(10))
+        self.assertEqual('', reader.read(1))
+
+    def test_read_some(self):
+        reader = MappedReader('abcdef', 2)
+        chunk = reader.read_some(3)
+        self.assertEqual('cde', str(chunk))
+        self.assertEqual(5, reader.offset)
+        self.assertEqual('f', str(reader.read_some(3)))
+        self.assertFalse(reader.read_some(3))
+
+    def test_unpack_object(self):
+        f = BytesIO()
+        build_pack(f, [(Blob.type_num, 'blob')])
+        reader = MappedReader(f.getvalue(), 12)
+        unpacked, unused = unpack_object(
+          reader.read, read_some=reader.read_some, include_comp=True)
+        self.assertEqual(['blob'], unpacked.obj_chunks)
+        self.assertEqual(zlib.compress('blob'), ''.join(unpacked.comp_chunks))
+        self.assertEqual(len(f.getvalue()) - 20,
+                         reader.offset - len(unused))
+
+
 class DeltifyTests(TestCase):
 
     def test_empty(self):
@@ -743,6 +1271,107 @@ class DeltifyTests(TestCase):
             ],
             list(deltify_pack_objects([(b1, ""), (b2, "")])))
 
+    def test_depth(self):
+        blobs = [Blob.from_string("a" * (100 + i)) for i in range(4)]
+        records = list(deltify_pack_objects(
+            [(b, "") for b in blobs], depth=2))
+        # Each object can only use a base that is not already at the
+        # maximum chain depth.
+        bases = dict((r[1], r[2]) for r in records)
+        for sha in bases:
+            chain = 0
+            while bases[sha] is not None:
+                sha = bases[sha]
+                chain += 1
+            self.assertTrue(chain <= 2)
+
+    def test_processes(self):
+        objects = []
+        for path in ('a', 'b', 'c'):
+            for i in range(5):
+                b = Blob.from_string(("%s\n" % path) * (100 + i))
+                objects.append((b, path))
+        serial = list(deltify_pack_objects(objects, window=2))
+        parallel = list(deltify_pack_objects(objects, window=2,
+                                             processes=2))
+        # Chunks are split at path boundaries, and the window never
+        # reaches across paths for these objects, so the output matches.
+        self.assertEqual(serial, parallel)
+
+    def test_write_pack_objects(self):
+        blobs = [Blob.from_string("line\n" * (100 + i)) for i in range(3)]
+        f = BytesIO()
+        entries, sha = write_pack_objects(f, [(b, "") for b in blobs],
+                                          deltify=True)
+        f.seek(0)
+        data = PackData.from_file(f, len(f.getvalue()))
+        self.assertEqual(
+            set([OFS_DELTA]),
+            set(u.pack_type_num for u in data._iter_unpacked()
+                if u.pack_type_num in DELTA_TYPES))
+        pack = Pack.from_objects(
+            data, MemoryPackIndex(data.sorted_entries(), sha))
+        self.assertEqual(sorted(b.id for b in blobs), sorted(pack))
+        for b in blobs:
+            self.assertEqual(b.as_raw_string(), pack[b.id].as_raw_string())
+
+    def test_pack_records_reused_delta(self):
+        b1 = Blob.from_string("a" * 101)
+        b2 = Blob.from_string("a" * 100)
+        b3 = Blob.from_string("a" * 102)
+        delta = create_delta(b1.as_raw_string(), b2.as_raw_string())
+        read = []
+
+        def records():
+            for record in [
+                    (3, b1.sha().digest(), None, b1.as_raw_string()),
+                    (3, b3.sha().digest(), None, b3.as_raw_string()),
+                    (3, b2.sha().digest(), b1.sha().digest(), delta)]:
+                read.append(record[1])
+                yield record
+        it = deltify_pack_records(records())
+        # The delta is passed through as soon as it is read, preceded by
+        # its base, which is kept whole.
+        self.assertEqual(
+            (3, b1.sha().digest(), None, b1.as_raw_string()), next(it))
+        self.assertEqual(
+            (3, b2.sha().digest(), b1.sha().digest(), delta), next(it))
+        self.assertEqual(3, len(read))
+        self.assertEqual(
+            [(3, b3.sha().digest(), None, b3.as_raw_string())], list(it))
+
+    def test_pack_records_batches(self):
+        blobs = [Blob.from_string("line\n" * (100 + i)) for i in range(4)]
+        records = [(3, b.sha().digest(), None, b.as_raw_string())
+                   for b in blobs]
+        result = list(deltify_pack_records(records, batch_objects=2))
+        self.assertEqual(sorted(b.sha().digest() for b in blobs),
+                         sorted(r[1] for r in result))
+        # Deltas are only searched for within a batch.
+        batches = [set(r[1] for r in records[:2]),
+                   set(r[1] for r in records[2:])]
+        for type_num, sha, delta_base, raw in result:
+            if delta_base is not None:
+                self.assertTrue(any(sha in batch and delta_base in batch
+                                    for batch in batches))
+        self.assertEqual(2, len([r for r in result if r[2] is None]))
+
+    def test_pack_records_paths(self):
+        a1 = Blob.from_string("a\n" * 100)
+        a2 = Blob.from_string("a\n" * 101)
+        b = Blob.from_string("b" * 201)
+        records = [(3, o.sha().digest(), None, o.as_raw_string())
+                   for o in (a1, a2, b)]
+        paths = {a1.id: 'a', a2.id: 'a', b.id: 'b'}
+        # b sorts between a2 and a1 by size, so with a window of one a1
+        # only finds a2 as a delta base if they are grouped by path.
+        bases = dict((r[1], r[2]) for r in deltify_pack_records(
+            records, window=1))
+        self.assertEqual(None, bases[a1.sha().digest()])
+        bases = dict((r[1], r[2]) for r in deltify_pack_records(
+            records, paths, window=1))
+        self.assertEqual(a2.sha().digest(), bases[a1.sha().digest()])
+
 
 class TestPackStreamReader(TestCase):
 
@@ -936,6 +1565,39 @@ class DeltaChainIteratorTests(TestCase):
         entries = build_pack(f, objects_spec)
         self.assertEntriesMatch(range(n + 1), entries, self.make_pack_iter(f))
 
+    def test_very_long_chain(self):
+        # Deeper than the default recursion limit.
+        n = 1500
+        objects_spec = [(Blob.type_num, 'blob')]
+        for i in range(n):
+            objects_spec.append((OFS_DELTA, (i, 'blob%i' % i)))
+        f = BytesIO()
+        entries = build_pack(f, objects_spec)
+        self.assertEntriesMatch(range(n + 1), entries, self.make_pack_iter(f))
+
+    def test_stats_long_chain(self):
+        objects_spec = [(Blob.type_num, 'blob')]
+        for i in range(10):
+            objects_spec.append((OFS_DELTA, (i, 'blob%i' % i)))
+        f = BytesIO()
+        build_pack(f, objects_spec)
+        pack_iter = self.make_pack_iter(f)
+        list(pack_iter._walk_all_chains())
+        # Each base is dropped before the delta against it is followed.
+        self.assertEqual(1, pack_iter.peak_stack_size)
+        self.assertEqual(len('blob8'), pack_iter.peak_base_size)
+
+    def test_stats_branchy_chain(self):
+        objects_spec = [(Blob.type_num, 'blob')]
+        for i in range(10):
+            objects_spec.append((OFS_DELTA, (0, 'blob%i' % i)))
+        f = BytesIO()
+        build_pack(f, objects_spec)
+        pack_iter = self.make_pack_iter(f)
+        list(pack_iter._walk_all_chains())
+        self.assertEqual(10, pack_iter.peak_stack_size)
+        self.assertEqual(len('blob'), pack_iter.peak_base_size)
+
     def test_ext_ref(self):
         blob, = self.store_blobs(['blob'])
         f = BytesIO()
@@ -1024,3 +1686,79 @@ class DeltaChainIteratorTests(TestCase):
             self.fail()
         except KeyError as e:
             self.assertEqual((sorted([b2.id, b3.id]),), (sorted(e.args[0]),))
+
+
+class ParallelPackIndexerTests(TestCase):
+
+    def setUp(self):
+        super(ParallelPackIndexerTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def build_pack_file(self, objects_spec):
+        f = open(os.path.join(self.tempdir, 'test.pack'), 'w+b')
+        self.addCleanup(f.close)
+        entries = build_pack(f, objects_spec, store=self.store)
+        f.seek(0)
+        return f, entries
+
+    def expected_entries(self, entries):
+        return sorted((sha, offset, crc32)
+                      for offset, type_num, data, sha, crc32 in entries)
+
+    def test_pack_data(self):
+        objects_spec = [(Blob.type_num, 'blob'), (Tree.type_num, 'tree')]
+        for i in range(20):
+            objects_spec.append((OFS_DELTA, (i // 2, 'blob%i' % i)))
+        objects_spec.append((REF_DELTA, (1, 'tree1')))
+        f, entries = self.build_pack_file(objects_spec)
+        data = PackData('test.pack', file=f)
+        expected = sorted(PackIndexer.for_pack_data(data))
+        self.assertEqual(self.expected_entries(entries), expected)
+        indexer = ParallelPackIndexer.for_pack_data(data, threads=3)
+        self.assertEqual(expected, sorted(indexer))
+
+    def test_unmapped_pack_data(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+          (Blob.type_num, 'blob'),
+          (OFS_DELTA, (0, 'blob1')),
+          (REF_DELTA, (1, 'blob2')),
+          ])
+        data = PackData('test.pack', file=f)
+        indexer = ParallelPackIndexer.for_pack_data(data, threads=2)
+        self.assertEqual(self.expected_entries(entries), sorted(indexer))
+
+    def test_thin_pack_file(self):
+        b1, b2 = [make_object(Blob, data=d) for d in ('foo', 'bar')]
+        self.store.add_objects([(b1, None), (b2, None)])
+        f, entries = self.build_pack_file([
+          (REF_DELTA, (2, 'foo99')),
+          (Blob.type_num, 'baz'),
+          (REF_DELTA, (b1.id, 'foo1')),
+          (REF_DELTA, (b2.id, 'bar2')),
+          ])
+        indexer = ParallelPackIndexer(
+          f, resolve_ext_ref=self.store.get_raw, threads=2)
+        for unpacked in PackStreamReader(f.read).read_objects():
+            indexer.record(unpacked)
+        self.assertEqual(self.expected_entries(entries), sorted(indexer))
+        self.assertEqual(sorted([hex_to_sha(b1.id), hex_to_sha(b2.id)]),
+                         sorted(indexer.ext_refs()))
+
+    def test_bad_ext_ref(self):
+        blob = make_object(Blob, data='blob')
+        self.store.add_object(blob)
+        f, entries = self.build_pack_file([
+          (Blob.type_num, 'baz'),
+          (REF_DELTA, (blob.id, 'blob1')),
+          ])
+        indexer = ParallelPackIndexer(f, threads=2)
+        for unpacked in PackStreamReader(f.read).read_objects():
+            indexer.record(unpacked)
+        try:
+            list(indexer)
+            self.fail()
+        except KeyError as e:
+            self.assertEqual(([blob.id],), e.args)
@@ -77,6 +77,70 @@ class UpdateServerInfoTests(PorcelainTestCase):
             'info', 'refs')))
 
 
+class GcTests(PorcelainTestCase):
+
+    def test_simple(self):
+        c1, c2, c3 = build_commit_graph(self.repo.object_store, [[1], [2, 1],
+            [3, 1, 2]])
+        self.repo.refs["refs/heads/master"] = c2.id
+        pack = porcelain.gc(self.repo.path, grace_period=-1)
+        self.assertEqual([pack.name()],
+                         [p.name() for p in self.repo.object_store.packs])
+        self.assertIn(c1.id, pack)
+        self.assertIn(c2.id, pack)
+        self.assertNotIn(c3.id, self.repo.object_store)
+        self.assertEqual(None, pack.bitmap)
+        self.assertEqual({"refs/heads/master": c2.id},
+                         self.repo.refs.get_packed_refs())
+
+    def test_bare_bitmap(self):
+        repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo_dir)
+        repo = Repo.init_bare(repo_dir)
+        c1, c2 = build_commit_graph(repo.object_store, [[1], [2, 1]])
+        repo.refs["refs/heads/master"] = c2.id
+        pack = porcelain.gc(repo.path)
+        self.assertIn(c2.id, pack.bitmap)
+
+    def test_reftable(self):
+        config = self.repo.get_config()
+        config.set(('core', ), 'repositoryformatversion', '1')
+        config.set(('extensions', ), 'refstorage', 'reftable')
+        config.write_to_path()
+        repo = Repo(self.repo.path)
+        c1, c2 = build_commit_graph(repo.object_store, [[1], [2, 1]])
+        repo.refs["refs/heads/master"] = c1.id
+        repo.refs["refs/heads/master"] = c2.id
+        pack = porcelain.gc(repo.path, grace_period=-1)
+        self.assertIn(c2.id, pack)
+        self.assertEqual(1, len(repo.refs._get_tables()))
+        self.assertEqual(c2.id, repo.refs["refs/heads/master"])
+
+
+class PackRefsTests(PorcelainTestCase):
+
+    def test_tags(self):
+        c1, = build_commit_graph(self.repo.object_store, [[1]])
+        self.repo.refs["refs/heads/master"] = c1.id
+        porcelain.tag(self.repo.path, "tryme", "foo <foo@bar.com>", "bar",
+                      annotated=True)
+        self.assertEqual(["refs/tags/tryme"],
+                         porcelain.pack_refs(self.repo.path))
+        tag = self.repo.refs["refs/tags/tryme"]
+        self.assertEqual({"refs/tags/tryme": tag},
+                         self.repo.refs.get_packed_refs())
+        self.assertEqual(c1.id, self.repo.refs.get_peeled("refs/tags/tryme"))
+
+    def test_all(self):
+        c1, = build_commit_graph(self.repo.object_store, [[1]])
+        self.repo.refs["refs/heads/master"] = c1.id
+        self.assertEqual(["refs/heads/master"],
+                         porcelain.pack_refs(self.repo.path, all=True))
+        self.assertEqual({"refs/heads/master": c1.id},
+                         self.repo.refs.get_packed_refs())
+        self.assertEqual(c1.id, self.repo.refs["HEAD"])
+
+
 class CommitTests(PorcelainTestCase):
 
     def test_custom_author(self):
@@ -160,6 +160,22 @@ class RefsContainerTests(object):
         # refs/heads/loop does not show up even if it exists
         self.assertEqual(_TEST_REFS, self._refs.as_dict())
 
+    def test_iter_refs(self):
+        refs = list(self._refs.iter_refs())
+        names = [name for (name, sha, peeled) in refs]
+        self.assertEqual(sorted(names), names)
+        self.assertEqual(_TEST_REFS,
+                         dict((name, sha) for (name, sha, peeled) in refs))
+        for name, sha, peeled in refs:
+            self.assertEqual(self._refs.get_peeled(name), peeled)
+
+    def test_iter_refs_base(self):
+        self.assertEqual(
+            [('refs/tags/refs-0.1', _TEST_REFS['refs/tags/refs-0.1']),
+             ('refs/tags/refs-0.2', _TEST_REFS['refs/tags/refs-0.2'])],
+            [(name, sha) for (name, sha, peeled)
+             in self._refs.iter_refs('refs/tags')])
+
     def test_setitem(self):
         self._refs['refs/some/ref'] = '42d06bd4b77fed026b154d16493e5deab78f02ec'
         self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
@@ -236,7 +252,38 @@ class RefsContainerTests(object):
           'refs/tags/refs-0.2', '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8'))
         self.assertFalse('refs/tags/refs-0.2' in self._refs)
 
+    def test_transaction(self):
+        nines = '9' * 40
+        t = self._refs.transaction()
+        t.set_if_equals('refs/heads/master',
+                        '42d06bd4b77fed026b154d16493e5deab78f02ec', nines)
+        t.add_if_new('refs/heads/new', nines)
+        t.remove_if_equals('refs/tags/refs-0.2',
+                           '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8')
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         self._refs['refs/heads/master'])
+        self.assertTrue(t.commit())
+        self.assertEqual(nines, self._refs['refs/heads/master'])
+        self.assertEqual(nines, self._refs['refs/heads/new'])
+        self.assertFalse('refs/tags/refs-0.2' in self._refs)
+
+    def test_transaction_failed(self):
+        nines = '9' * 40
+        t = self._refs.transaction()
+        t.set_if_equals('refs/heads/master',
+                        '42d06bd4b77fed026b154d16493e5deab78f02ec', nines)
+        t.remove_if_equals('refs/tags/refs-0.2',
+                           '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8')
+        t.add_if_new('refs/heads/packed', nines)
+        self.assertFalse(t.commit())
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
 
+    def test_transaction_duplicate(self):
+        nines = '9' * 40
+        t = self._refs.transaction()
+        t.set_if_equals('refs/heads/master', None, nines)
+        self.assertRaises(ValueError, t.remove_if_equals,
+                          'refs/heads/master', None)
 
 
 class DictRefsContainerTests(RefsContainerTests, TestCase):
@@ -271,6 +318,139 @@ class DiskRefsContainerTests(RefsContainerTests, TestCase):
           'refs/tags/refs-0.1': 'df6800012397fb85c56e7418dd4eb9405dee075c',
           }, self._refs.get_packed_refs())
 
+    def test_get_packed_refs_cached(self):
+        packed_refs = self._refs.get_packed_refs()
+        self.assertTrue(packed_refs is self._refs.get_packed_refs())
+
+    def test_get_packed_refs_changed(self):
+        self._refs.get_packed_refs()
+        f = GitFile(os.path.join(self._refs.path, 'packed-refs'), 'wb')
+        try:
+            write_packed_refs(f, {
+                'refs/heads/other': '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8'})
+        finally:
+            f.close()
+        self.assertEqual({
+          'refs/heads/other': '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8',
+          }, self._refs.get_packed_refs())
+        self.assertEqual('3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8',
+                         self._refs['refs/heads/other'])
+
+    def test_get_packed_refs_removed(self):
+        self._refs.get_packed_refs()
+        os.remove(os.path.join(self._refs.path, 'packed-refs'))
+        self.assertEqual({}, self._refs.get_packed_refs())
+        self.assertFalse('refs/heads/packed' in self._refs)
+
+    def test_iter_refs_loose_and_packed(self):
+        # A loose ref overrides the packed one, and has no peeled value.
+        self._refs['refs/heads/packed'] = (
+            '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8')
+        self._refs['refs/heads/packed-loose'] = (
+            '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8')
+        self.assertEqual([
+          ('refs/heads/40-char-ref-aaaaaaaaaaaaaaaaaa',
+           '42d06bd4b77fed026b154d16493e5deab78f02ec', None),
+          ('refs/heads/master', '42d06bd4b77fed026b154d16493e5deab78f02ec',
+           None),
+          ('refs/heads/packed', '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8',
+           None),
+          ('refs/heads/packed-loose',
+           '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8', None),
+          ], list(self._refs.iter_refs('refs/heads')))
+        self.assertEqual([
+          ('refs/tags/refs-0.1', 'df6800012397fb85c56e7418dd4eb9405dee075c',
+           '42d06bd4b77fed026b154d16493e5deab78f02ec'),
+          ('refs/tags/refs-0.2', '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8',
+           None),
+          ], list(self._refs.iter_refs('refs/tags')))
+
+    def test_pack_refs(self):
+        self.assertEqual(['refs/tags/refs-0.2'],
+                         self._refs.pack_refs(self._repo.object_store))
+        self.assertFalse(os.path.exists(
+            self._refs.refpath('refs/tags/refs-0.2')))
+        self.assertTrue(os.path.exists(self._refs.refpath('refs/heads/master')))
+        self.assertEqual({
+          'refs/heads/packed': '42d06bd4b77fed026b154d16493e5deab78f02ec',
+          'refs/tags/refs-0.1': 'df6800012397fb85c56e7418dd4eb9405dee075c',
+          'refs/tags/refs-0.2': '3ec9c43c84ff242e3ef4a9fc5bc111fd780a76a8',
+          }, self._refs.get_packed_refs())
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         self._refs.get_peeled('refs/tags/refs-0.2'))
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
+
+    def test_pack_refs_all(self):
+        self.assertEqual(
+            ['refs/heads/40-char-ref-aaaaaaaaaaaaaaaaaa', 'refs/heads/master',
+             'refs/tags/refs-0.2'],
+            sorted(self._refs.pack_refs(self._repo.object_store, all=True)))
+        # The symbolic ref stays loose.
+        self.assertEqual(['loop'], os.listdir(self._refs.refpath('refs/heads')))
+        self.assertEqual([], os.listdir(self._refs.refpath('refs/tags')))
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
+        for name in _TEST_REFS:
+            if name == 'HEAD':
+                continue
+            self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                             self._refs.get_peeled(name))
+        f = open(os.path.join(self._refs.path, 'packed-refs'), 'rb')
+        try:
+            self.assertEqual(
+                '^42d06bd4b77fed026b154d16493e5deab78f02ec\n',
+                f.readlines()[-1])
+        finally:
+            f.close()
+
+    def test_pack_refs_reads_loose_refs_locked(self):
+        lock_held = []
+        read_loose_refs = self._refs._read_loose_refs
+
+        def _read_loose_refs(base, refs):
+            lock_held.append(os.path.exists(
+                os.path.join(self._refs.path, 'packed-refs.lock')))
+            return read_loose_refs(base, refs)
+        self._refs._read_loose_refs = _read_loose_refs
+        self._refs.pack_refs(self._repo.object_store)
+        self.assertEqual(set([True]), set(lock_held))
+
+    def test_pack_refs_peel_unpeeled_file(self):
+        # Without the peeled trait, the tags already packed are peeled.
+        f = open(os.path.join(self._refs.path, 'packed-refs'), 'wb')
+        try:
+            f.write('df6800012397fb85c56e7418dd4eb9405dee075c '
+                    'refs/tags/refs-0.1\n')
+        finally:
+            f.close()
+        self._refs.pack_refs(self._repo.object_store)
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         self._refs.get_peeled('refs/tags/refs-0.1'))
+
+    def test_pack_refs_keep_packed_peeled(self):
+        # With the peeled trait, the refs already packed are not peeled
+        # again.
+        f = open(os.path.join(self._refs.path, 'packed-refs'), 'wb')
+        try:
+            f.write('# pack-refs with: peeled\n'
+                    'df6800012397fb85c56e7418dd4eb9405dee075c '
+                    'refs/tags/refs-0.1\n')
+        finally:
+            f.close()
+        self._refs.pack_refs(self._repo.object_store)
+        self.assertEqual('df6800012397fb85c56e7418dd4eb9405dee075c',
+                         self._refs.get_peeled('refs/tags/refs-0.1'))
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         self._refs.get_peeled('refs/tags/refs-0.2'))
+
+    def test_pack_refs_nested(self):
+        self._refs['refs/tags/a/b/c'] = (
+            '42d06bd4b77fed026b154d16493e5deab78f02ec')
+        self._refs.pack_refs(self._repo.object_store)
+        self.assertFalse(os.path.exists(self._refs.refpath('refs/tags/a')))
+        self.assertTrue(os.path.isdir(self._refs.refpath('refs/tags')))
+        self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
+                         self._refs['refs/tags/a/b/c'])
+
     def test_get_peeled_not_packed(self):
         # not packed
         self.assertEqual(None, self._refs.get_peeled('refs/tags/refs-0.2'))
@@ -409,6 +589,44 @@ class DiskRefsContainerTests(RefsContainerTests, TestCase):
           'df6800012397fb85c56e7418dd4eb9405dee075c'))
         self.assertRaises(KeyError, lambda: self._refs['refs/tags/refs-0.1'])
 
+    def test_transaction_symref(self):
+        nines = '9' * 40
+        t = self._refs.transaction()
+        t.set_if_equals('HEAD', '42d06bd4b77fed026b154d16493e5deab78f02ec',
+                        nines)
+        self.assertTrue(t.commit())
+        self.assertEqual(nines, self._refs['refs/heads/master'])
+        self.assertEqual('ref: refs/heads/master',
+                         self._refs.read_ref('HEAD'))
+
+    def test_transaction_packed(self):
+        nines = '9' * 40
+        t = self._refs.transaction()
+        t.remove_if_equals('refs/tags/refs-0.1',
+                           'df6800012397fb85c56e7418dd4eb9405dee075c')
+        t.set_if_equals('refs/heads/packed',
+                        '42d06bd4b77fed026b154d16493e5deab78f02ec', nines)
+        self.assertTrue(t.commit())
+        self.assertNotIn('refs/tags/refs-0.1', self._refs.get_packed_refs())
+        self.assertRaises(KeyError, lambda: self._refs['refs/tags/refs-0.1'])
+        self.assertEqual(nines, self._refs['refs/heads/packed'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self._refs.path, 'packed-refs.lock')))
+
+    def test_transaction_partial_failure(self):
+        nines = '9' * 40
+        t = self._refs.transaction()
+        t.set_if_equals('refs/heads/a', None, nines)
+        t.set_if_equals('refs/heads/b', None, nines)
+        # A directory in the way makes the rename of the second ref fail.
+        os.makedirs(self._refs.refpath('refs/heads/b/c'))
+        with self.assertRaises(errors.RefsTransactionError) as cm:
+            t.commit()
+        self.assertEqual(['refs/heads/a'], cm.exception.updated)
+        self.assertEqual(nines, self._refs['refs/heads/a'])
+        self.assertFalse(os.path.exists(
+            self._refs.refpath('refs/heads/b.lock')))
+
     def test_read_ref(self):
         self.assertEqual('ref: refs/heads/master', self._refs.read_ref("HEAD"))
         self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec',
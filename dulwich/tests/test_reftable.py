@@ -0,0 +1,227 @@
+# test_reftable.py -- Tests for reading and writing reftables
+# Copyright (C) 2014 The Dulwich contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) a later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for reading and writing reftables."""
+
+from io import BytesIO
+import os
+import shutil
+import tempfile
+
+from dulwich.object_store import (
+    MemoryObjectStore,
+    )
+from dulwich.objects import (
+    Commit,
+    Tag,
+    )
+from dulwich.reftable import (
+    RefRecord,
+    Reftable,
+    ReftableRefsContainer,
+    _encode_varint,
+    _read_varint,
+    write_reftable,
+    )
+from dulwich.repo import Repo
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.test_refs import (
+    RefsContainerTests,
+    _TEST_REFS,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
+
+
+class VarintTests(TestCase):
+
+    def test_roundtrip(self):
+        for value in (0, 1, 127, 128, 255, 16511, 16512, 2**32, 2**63):
+            encoded = _encode_varint(value)
+            self.assertEqual((value, len(encoded)),
+                             _read_varint(encoded, 0))
+
+    def test_encoding(self):
+        self.assertEqual('\x7f', _encode_varint(127))
+        self.assertEqual('\x80\x00', _encode_varint(128))
+
+
+class ReftableTests(TestCase):
+
+    def write_table(self, records, block_size=256):
+        f = BytesIO()
+        write_reftable(f, records, 1, 3, block_size)
+        return Reftable('test.ref', f.getvalue())
+
+    def test_empty(self):
+        table = self.write_table([])
+        self.assertEqual(92, len(table))
+        self.assertEqual([], list(table))
+        self.assertEqual(None, table.get('refs/heads/master'))
+
+    def test_roundtrip(self):
+        records = [
+            RefRecord('HEAD', 3, 'ref: refs/heads/master', None),
+            RefRecord('refs/heads/gone', 2, None, None),
+            RefRecord('refs/heads/master', 1, '1' * 40, None),
+            RefRecord('refs/tags/v1', 1, '2' * 40, '3' * 40),
+            ]
+        table = self.write_table(records)
+        self.assertEqual(1, table.min_update_index)
+        self.assertEqual(3, table.max_update_index)
+        self.assertEqual(records, list(table))
+        self.assertEqual(records[3], table.get('refs/tags/v1'))
+        self.assertEqual(None, table.get('refs/tags/v2'))
+        self.assertEqual(records[2:], list(table.iter_records('refs/heads/i')))
+
+    def test_index(self):
+        # Enough records for several blocks and two levels of index.
+        records = [RefRecord('refs/tags/v%05d' % i, 1 + i % 3, '%040x' % i,
+                             None)
+                   for i in range(3000)]
+        table = self.write_table(records)
+        self.assertNotEqual(0, table._ref_index_position)
+        self.assertEqual(records, list(table))
+        for record in records[::7]:
+            self.assertEqual(record, table.get(record.name))
+        self.assertEqual(None, table.get('refs/tags/v1000a'))
+        self.assertEqual(None, table.get('refs/tags/v99999'))
+        self.assertEqual(records[2990:],
+                         list(table.iter_records('refs/tags/v0299')))
+
+    def test_bad_signature(self):
+        self.assertRaises(AssertionError, Reftable, 'test.ref', 'PACK' * 30)
+
+    def test_bad_checksum(self):
+        f = BytesIO()
+        write_reftable(f, [RefRecord('HEAD', 1, '1' * 40, None)], 1, 1)
+        contents = f.getvalue()
+        self.assertRaises(AssertionError, Reftable, 'test.ref',
+                          contents[:-1] + chr(ord(contents[-1]) ^ 1))
+
+
+class ReftableRefsContainerTests(RefsContainerTests, TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self._refs = ReftableRefsContainer(
+            os.path.join(self.tempdir, 'reftable'), block_size=256)
+        self._refs.update_refs(_TEST_REFS)
+
+    def test_update_refs(self):
+        nines = '9' * 40
+        self.assertTrue(self._refs.update_refs(
+            {'refs/heads/master': nines, 'refs/tags/refs-0.1': None},
+            {'refs/heads/master': _TEST_REFS['refs/heads/master'],
+             'refs/heads/new': None}))
+        self.assertEqual(nines, self._refs['refs/heads/master'])
+        self.assertFalse('refs/tags/refs-0.1' in self._refs)
+
+    def test_update_refs_mismatch(self):
+        nines = '9' * 40
+        self.assertFalse(self._refs.update_refs(
+            {'refs/heads/master': nines, 'refs/heads/packed': nines},
+            {'refs/heads/master': _TEST_REFS['refs/heads/master'],
+             'refs/heads/packed': nines}))
+        self.assertEqual(_TEST_REFS, self._refs.as_dict())
+
+    def test_stack(self):
+        for i in range(50):
+            self._refs['refs/heads/branch%d' % i] = '%040x' % i
+        del self._refs['refs/heads/branch7']
+        # Tables are merged as they are added, so the stack stays short.
+        self.assertTrue(len(self._refs._get_tables()) < 10)
+        self.assertEqual(len(self._refs._get_tables()),
+                         len(os.listdir(self._refs.path)) - 1)
+        refs = self._refs.as_dict('refs/heads')
+        self.assertEqual(52, len(refs))
+        self.assertFalse('branch7' in refs)
+        self.assertEqual('%040x' % 8, refs['branch8'])
+
+    def test_compact(self):
+        del self._refs['refs/heads/master']
+        self._refs.compact()
+        self.assertEqual(1, len(self._refs._get_tables()))
+        expected = dict(_TEST_REFS)
+        del expected['refs/heads/master']
+        self.assertEqual(expected, self._refs.as_dict())
+        # The deletion record is dropped too.
+        self.assertEqual(
+            sorted(expected),
+            [r.name for r in self._refs._get_tables()[0]])
+
+    def test_pack_refs(self):
+        store = MemoryObjectStore()
+        c1, = build_commit_graph(store, [[1]])
+        tag = make_object(Tag, name='tag', message='',
+                          tagger='Tagger <test@example.com>',
+                          tag_time=12345, tag_timezone=0,
+                          object=(Commit, c1.id))
+        store.add_object(tag)
+        self._refs['refs/tags/tag'] = tag.id
+        self._refs['refs/heads/master'] = c1.id
+        self.assertEqual(['refs/tags/tag'], self._refs.pack_refs(store))
+        self.assertEqual(1, len(self._refs._get_tables()))
+        self.assertEqual(c1.id, self._refs.get_peeled('refs/tags/tag'))
+        self.assertEqual(None, self._refs.get_peeled('refs/heads/master'))
+        self.assertEqual(tag.id, self._refs['refs/tags/tag'])
+        # Nothing changed, so the table is not written again.
+        table, = self._refs._get_tables()
+        self.assertEqual([], self._refs.pack_refs(store, all=True))
+        self.assertEqual([table], self._refs._get_tables())
+
+    def test_other_container(self):
+        # Changes made through another container are picked up.
+        other = ReftableRefsContainer(self._refs.path)
+        self.assertEqual(_TEST_REFS, other.as_dict())
+        self._refs['refs/heads/master'] = '9' * 40
+        self.assertEqual('9' * 40, other['refs/heads/master'])
+
+
+class ReftableRepoTests(TestCase):
+
+    def test_open(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        repo = Repo.init_bare(path)
+        config = repo.get_config()
+        config.set(('core', ), 'repositoryformatversion', '1')
+        config.set(('extensions', ), 'refstorage', 'reftable')
+        config.write_to_path()
+        repo = Repo(path)
+        self.assertTrue(isinstance(repo.refs, ReftableRefsContainer))
+        repo.refs.set_symbolic_ref('HEAD', 'refs/heads/master')
+        repo.refs['HEAD'] = '9' * 40
+        self.assertEqual({'HEAD': '9' * 40, 'refs/heads/master': '9' * 40},
+                         repo.get_refs())
+
+    def test_open_unknown_format(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        repo = Repo.init_bare(path)
+        config = repo.get_config()
+        config.set(('core', ), 'repositoryformatversion', '1')
+        config.set(('extensions', ), 'refstorage', 'reftabel')
+        config.write_to_path()
+        self.assertRaises(ValueError, Repo, path)
@@ -27,10 +27,14 @@ import warnings
 
 from dulwich import errors
 from dulwich.object_store import (
+    FullPackIterator,
+    ObjectStoreGraphWalker,
     tree_lookup_path,
     )
 from dulwich import objects
 from dulwich.config import Config
+from dulwich.objects import sha_to_hex
+from dulwich.pack import write_pack_objects
 from dulwich.repo import (
     Repo,
     MemoryRepo,
@@ -39,6 +43,8 @@ from dulwich.tests import (
     TestCase,
     )
 from dulwich.tests.utils import (
+    make_commit,
+    make_object,
     open_repo,
     tear_down_repo,
     setup_warning_catcher,
@@ -309,6 +315,146 @@ class RepositoryTests(TestCase):
         r = Repo(temp_dir)
         self.assertEqual(r.head(), 'a90fa2d900a17e99b433217e988c4eb4a2e9a097')
 
+    def test_fetch_objects_full_pack(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        r = Repo.init_bare(tmp_dir)
+        blob = make_object(objects.Blob, data='a')
+        tree = objects.Tree()
+        tree.add('a', 0100644, blob.id)
+        c = make_commit(tree=tree.id)
+        pack = r.object_store.add_objects(
+            [(blob, None), (tree, None), (c, None)])
+        r.refs['refs/heads/master'] = c.id
+        want_all = lambda refs: list(set(refs.values()))
+        walker = ObjectStoreGraphWalker([], lambda sha: [])
+        # Without a bitmap, it is not known whether all objects in the pack
+        # are reachable.
+        objects_iter = r.fetch_objects(want_all, walker, None)
+        self.assertFalse(isinstance(objects_iter, FullPackIterator))
+        r.object_store.write_bitmap(pack)
+        objects_iter = r.fetch_objects(want_all, walker, None)
+        self.assertTrue(isinstance(objects_iter, FullPackIterator))
+        self.assertEqual(3, len(objects_iter))
+        self.assertEqual(set([blob.id, tree.id, c.id]),
+                         set(sha for (sha, path) in objects_iter.itershas()))
+        # With a loose object, the pack is no longer sent as it is.
+        r.object_store.add_object(make_object(objects.Blob, data='b'))
+        objects_iter = r.fetch_objects(want_all, walker, None)
+        self.assertFalse(isinstance(objects_iter, FullPackIterator))
+        self.assertEqual(3, len(objects_iter))
+
+    def test_fetch_objects_full_pack_unreachable(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        r = Repo.init_bare(tmp_dir)
+        blob = make_object(objects.Blob, data='a')
+        unreachable = make_object(objects.Blob, data='b')
+        tree = objects.Tree()
+        tree.add('a', 0100644, blob.id)
+        c = make_commit(tree=tree.id)
+        pack = r.object_store.add_objects(
+            [(blob, None), (unreachable, None), (tree, None), (c, None)])
+        r.object_store.write_bitmap(pack, [c.id])
+        r.refs['refs/heads/master'] = c.id
+        want_all = lambda refs: list(set(refs.values()))
+        walker = ObjectStoreGraphWalker([], lambda sha: [])
+        objects_iter = r.fetch_objects(want_all, walker, None)
+        self.assertFalse(isinstance(objects_iter, FullPackIterator))
+        self.assertEqual(set([blob.id, tree.id, c.id]),
+                         set(sha for (sha, path) in objects_iter.itershas()))
+
+    def test_fetch_objects_bitmap(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        r = Repo.init_bare(tmp_dir)
+        blob = make_object(objects.Blob, data='a')
+        tree = objects.Tree()
+        tree.add('a', 0100644, blob.id)
+        c1 = make_commit(tree=tree.id)
+        c2 = make_commit(tree=tree.id, parents=[c1.id], message='2')
+        r.object_store.add_objects(
+            [(blob, None), (tree, None), (c1, None), (c2, None)])
+        r.refs['refs/heads/master'] = c2.id
+        r.object_store.write_bitmap(r.object_store.packs[0])
+        calls = []
+        find_missing = r.object_store.find_missing_objects_bitmap
+        def find_missing_objects_bitmap(*args):
+            calls.append(args)
+            return find_missing(*args)
+        r.object_store.find_missing_objects_bitmap = \
+            find_missing_objects_bitmap
+        want_all = lambda refs: list(set(refs.values()))
+        walker = ObjectStoreGraphWalker([c1.id], lambda sha: [])
+        objects_iter = r.fetch_objects(want_all, walker, None)
+        self.assertEqual(1, len(calls))
+        self.assertEqual([c2.id],
+                         [sha for (sha, path) in objects_iter.itershas()])
+
+    def test_fetch_objects_bitmap_thin(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        r = Repo.init_bare(tmp_dir)
+        lines = ['line %d\n' % i for i in range(200)]
+        blob1 = make_object(objects.Blob, data=''.join(lines))
+        blob2 = make_object(objects.Blob, data=''.join(lines[:150]))
+        tree1 = objects.Tree()
+        tree1.add('a', 0100644, blob1.id)
+        tree2 = objects.Tree()
+        tree2.add('a', 0100644, blob2.id)
+        c1 = make_commit(tree=tree1.id)
+        c2 = make_commit(tree=tree2.id, parents=[c1.id], message='2')
+        f, commit, abort = r.object_store.add_pack()
+        write_pack_objects(
+            f, [(o, None) for o in (blob1, blob2, tree1, tree2, c1, c2)],
+            deltify=True)
+        pack = commit()
+        r.refs['refs/heads/master'] = c2.id
+        want_all = lambda refs: list(set(refs.values()))
+
+        def fetch_deltas():
+            walker = ObjectStoreGraphWalker([c1.id], lambda sha: [])
+            objects_iter = r.fetch_objects(want_all, walker, None)
+            return sorted((sha_to_hex(sha), delta_base)
+                          for (type_num, sha, delta_base, raw)
+                          in objects_iter.iter_pack_records(thin=True)
+                          if delta_base is not None)
+
+        deltas = fetch_deltas()
+        self.assertIn((blob2.id, blob1.sha().digest()), deltas)
+        r.object_store.write_bitmap(pack)
+        self.assertEqual(deltas, fetch_deltas())
+
+    def test_fetch_objects_deltify(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        r = Repo.init_bare(tmp_dir)
+        lines = ['line %d\n' % i for i in range(200)]
+        blob1 = make_object(objects.Blob, data=''.join(lines))
+        blob2 = make_object(objects.Blob, data=''.join(lines[:150]))
+        tree = objects.Tree()
+        tree.add('a', 0100644, blob1.id)
+        tree.add('b', 0100644, blob2.id)
+        c = make_commit(tree=tree.id)
+        for o in (blob1, blob2, tree, c):
+            r.object_store.add_object(o)
+        r.refs['refs/heads/master'] = c.id
+        want_all = lambda refs: list(set(refs.values()))
+
+        def fetch_deltas(deltify):
+            walker = ObjectStoreGraphWalker([], lambda sha: [])
+            objects_iter = r.fetch_objects(want_all, walker, None)
+            return [(sha_to_hex(sha), delta_base)
+                    for (type_num, sha, delta_base, raw)
+                    in objects_iter.iter_pack_records(deltify=deltify)
+                    if delta_base is not None]
+
+        # Loose objects have no stored deltas, so deltas are only sent if
+        # they are searched for.
+        self.assertEqual([], fetch_deltas(False))
+        self.assertEqual([(blob2.id, blob1.sha().digest())],
+                         fetch_deltas(True))
+
     def test_common_revisions(self):
         """
         This test demonstrates that ``find_common_revisions()`` actually returns
@@ -20,6 +20,7 @@
 
 from io import BytesIO
 import os
+import shutil
 import tempfile
 
 from dulwich.errors import (
@@ -27,6 +28,7 @@ from dulwich.errors import (
     NotGitRepository,
     UnexpectedCommandError,
     HangupException,
+    RefsTransactionError,
     )
 from dulwich.objects import (
     Commit,
@@ -35,6 +37,9 @@ from dulwich.objects import (
 from dulwich.object_store import (
     MemoryObjectStore,
     )
+from dulwich.pack import (
+    write_pack_objects,
+    )
 from dulwich.repo import (
     MemoryRepo,
     Repo,
@@ -57,6 +62,7 @@ from dulwich.server import (
     )
 from dulwich.tests import TestCase
 from dulwich.tests.utils import (
+    build_commit_graph,
     make_commit,
     make_object,
     )
@@ -300,6 +306,7 @@ class ReceivePackHandlerTestCase(TestCase):
         backend = DictBackend({'/': self._repo})
         self._handler = ReceivePackHandler(
           backend, ['/', 'host=lolcathost'], TestProto())
+        self._handler.set_client_capabilities([])
 
     def test_apply_pack_del_ref(self):
         refs = {
@@ -313,6 +320,91 @@ class ReceivePackHandlerTestCase(TestCase):
         self.assertEqual(status[1][0], 'refs/heads/fake-branch')
         self.assertEqual(status[1][1], 'ok')
 
+    def test_apply_pack_index_threads(self):
+        self._send_empty_pack()
+        calls = []
+
+        def add_thin_pack(read_all, read_some, **kwargs):
+            calls.append(kwargs)
+        self._repo.object_store.add_thin_pack = add_thin_pack
+        update_refs = [[ZERO_SHA, ONE, 'refs/heads/master']]
+        self._handler._apply_pack(update_refs)
+        self._handler.index_threads = 4
+        self._handler._apply_pack(update_refs)
+        self.assertEqual([{}, {'threads': 4}], calls)
+
+    def _send_empty_pack(self):
+        f = BytesIO()
+        write_pack_objects(f, [])
+        f.seek(0)
+        self._handler.proto.read = f.read
+
+    def test_apply_pack_atomic(self):
+        self._send_empty_pack()
+        self._repo.refs._update({
+            'refs/heads/master': TWO,
+            'refs/heads/fake-branch': ONE})
+        self._handler.set_client_capabilities(['atomic', 'delete-refs'])
+        update_refs = [[TWO, THREE, 'refs/heads/master'],
+                       [ONE, ZERO_SHA, 'refs/heads/fake-branch'],
+                       [ZERO_SHA, FOUR, 'refs/heads/new']]
+        status = self._handler._apply_pack(update_refs)
+        self.assertEqual([('unpack', 'ok'), ('refs/heads/master', 'ok'),
+                          ('refs/heads/fake-branch', 'ok'),
+                          ('refs/heads/new', 'ok')], status)
+        self.assertEqual({'refs/heads/master': THREE,
+                          'refs/heads/new': FOUR},
+                         self._repo.refs.as_dict())
+
+    def test_apply_pack_atomic_failure(self):
+        self._send_empty_pack()
+        self._repo.refs._update({
+            'refs/heads/master': TWO,
+            'refs/heads/fake-branch': ONE})
+        self._handler.set_client_capabilities(['atomic'])
+        update_refs = [[TWO, THREE, 'refs/heads/master'],
+                       [TWO, FOUR, 'refs/heads/fake-branch']]
+        status = self._handler._apply_pack(update_refs)
+        self.assertEqual(('unpack', 'ok'), status[0])
+        self.assertEqual(
+            [('refs/heads/master', 'atomic push failure'),
+             ('refs/heads/fake-branch', 'atomic push failure')],
+            status[1:])
+        self.assertEqual({'refs/heads/master': TWO,
+                          'refs/heads/fake-branch': ONE},
+                         self._repo.refs.as_dict())
+
+    def test_apply_pack_atomic_partial_failure(self):
+        self._send_empty_pack()
+        self._repo.refs._update({'refs/heads/master': TWO})
+        self._handler.set_client_capabilities(['atomic'])
+
+        def commit_transaction(updates, expected):
+            raise RefsTransactionError(['refs/heads/master'], OSError())
+        self._repo.refs._commit_transaction = commit_transaction
+        update_refs = [[TWO, THREE, 'refs/heads/master'],
+                       [ZERO_SHA, FOUR, 'refs/heads/new']]
+        status = self._handler._apply_pack(update_refs)
+        self.assertEqual(
+            [('refs/heads/master', 'ok'),
+             ('refs/heads/new', 'failed to update ref')],
+            status[1:])
+
+    def test_apply_pack_atomic_bad_ref(self):
+        self._send_empty_pack()
+        self._repo.refs._update({'refs/heads/master': TWO})
+        self._handler.set_client_capabilities(['atomic'])
+        update_refs = [[TWO, THREE, 'refs/heads/master'],
+                       [ZERO_SHA, FOUR, 'refs/heads/bad..name']]
+        status = self._handler._apply_pack(update_refs)
+        self.assertEqual(
+            [('unpack', 'ok'),
+             ('refs/heads/master', 'atomic push failure'),
+             ('refs/heads/bad..name', 'bad ref')],
+            status)
+        self.assertEqual({'refs/heads/master': TWO},
+                         self._repo.refs.as_dict())
+
 
 class ProtocolGraphWalkerEmptyTestCase(TestCase):
     def setUp(self):
@@ -507,6 +599,38 @@ class ProtocolGraphWalkerTestCase(TestCase):
           ])
 
 
+class CommitGraphProtocolGraphWalkerTestCase(TestCase):
+
+    def setUp(self):
+        super(CommitGraphProtocolGraphWalkerTestCase, self).setUp()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self._repo = Repo.init_bare(tempdir)
+        self.addCleanup(self._repo.object_store.close)
+        # Create the following commit tree:
+        #   3---5
+        #  /
+        # 1---2---4
+        self._commits = build_commit_graph(
+            self._repo.object_store, [[1], [2, 1], [3, 1], [4, 2], [5, 3]])
+        self._repo.object_store.write_commit_graph(
+            [c.id for c in self._commits])
+        backend = DictBackend({'/': self._repo})
+        self._walker = ProtocolGraphWalker(
+            TestUploadPackHandler(backend, ['/', 'host=lolcats'], TestProto()),
+            self._repo.object_store, self._repo.get_peeled)
+
+    def test_all_wants_satisfied(self):
+        c1, c2, c3, c4, c5 = [c.id for c in self._commits]
+        self.assertNotEqual(None, self._repo.object_store.commit_graph)
+        self._walker.set_wants([c4, c5])
+        self.assertTrue(self._walker.all_wants_satisfied([c4, c5]))
+        self.assertTrue(self._walker.all_wants_satisfied([c1]))
+        self.assertFalse(self._walker.all_wants_satisfied([c2]))
+        self.assertFalse(self._walker.all_wants_satisfied([c3]))
+        self.assertTrue(self._walker.all_wants_satisfied([c2, c3]))
+
+
 class TestProtocolGraphWalker(object):
 
     def __init__(self):
@@ -21,6 +21,13 @@
 from itertools import (
     permutations,
     )
+import os
+import shutil
+import tempfile
+
+from dulwich.commit_graph import (
+    CommitGraphEntry,
+    )
 
 from dulwich.diff_tree import (
     CHANGE_ADD,
@@ -34,6 +41,7 @@ from dulwich.errors import (
     MissingCommitError,
     )
 from dulwich.object_store import (
+    DiskObjectStore,
     MemoryObjectStore,
     )
 from dulwich.objects import (
@@ -415,3 +423,41 @@ class WalkerTest(TestCase):
     def test_empty_walk(self):
         c1, c2, c3 = self.make_linear_commits(3)
         self.assertWalkYields([], [c3.id], exclude=[c3.id])
+
+
+class CommitGraphWalkerTest(TestCase):
+
+    def setUp(self):
+        super(CommitGraphWalkerTest, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.store = DiskObjectStore.init(
+            os.path.join(self.tempdir, 'objects'))
+        self.addCleanup(self.store.close)
+
+    def test_exclude(self):
+        c1, c2, c3, c4 = build_commit_graph(
+            self.store, [[1], [2, 1], [3, 2], [4, 1]])
+        self.store.write_commit_graph([c3.id, c4.id])
+        entries = list(Walker(self.store, [c3.id], exclude=[c4.id]))
+        # Commits are only inflated when asked for.
+        self.assertEqual([CommitGraphEntry, CommitGraphEntry],
+                         [type(e._commit) for e in entries])
+        self.assertEqual([c3, c2], [e.commit for e in entries])
+
+    def test_paths(self):
+        blob_a1 = make_object(Blob, data='a1')
+        blob_a2 = make_object(Blob, data='a2')
+        blob_b = make_object(Blob, data='b')
+        c1, c2, c3 = build_commit_graph(
+            self.store, [[1], [2, 1], [3, 2]],
+            trees={1: [('a', blob_a1)],
+                   2: [('a', blob_a1), ('b', blob_b)],
+                   3: [('a', blob_a2), ('b', blob_b)]})
+        self.store.write_commit_graph([c3.id])
+        walker = Walker(self.store, [c3.id], paths=['a'])
+        self.assertEqual(
+            [TestWalkEntry(c3, [TreeChange(CHANGE_MODIFY, ('a', F, blob_a1.id),
+                                           ('a', F, blob_a2.id))]),
+             TestWalkEntry(c1, [TreeChange.add(('a', F, blob_a1.id))])],
+            list(walker))
@@ -139,6 +139,21 @@ class DumbHandlersTestCase(WebTestCase):
         self.assertContentTypeEquals('some/thing')
         self.assertTrue(f.closed)
 
+    def test_send_file_file_wrapper(self):
+        wrapped = []
+
+        def file_wrapper(f, block_size):
+            wrapped.append((f, block_size))
+            return iter([f.read()])
+
+        self._environ['wsgi.file_wrapper'] = file_wrapper
+        f = BytesIO('foobar')
+        output = ''.join(send_file(self._req, f, 'some/thing'))
+        self.assertEqual('foobar', output)
+        self.assertEqual([(f, 10240)], wrapped)
+        self.assertEqual(HTTP_OK, self._status)
+        self.assertContentTypeEquals('some/thing')
+
     def test_send_file_error(self):
         class TestFile(object):
             def __init__(self, exc_class):
@@ -25,6 +25,9 @@ import collections
 import heapq
 import itertools
 
+from dulwich.commit_graph import (
+    CommitGraphEntry,
+    )
 from dulwich.diff_tree import (
     RENAME_CHANGE_TYPES,
     tree_changes,
@@ -48,12 +51,20 @@ class WalkEntry(object):
     """Object encapsulating a single result from a walk."""
 
     def __init__(self, walker, commit):
-        self.commit = commit
+        # A Commit, or a CommitGraphEntry until the commit is needed.
+        self._commit = commit
         self._store = walker.store
         self._get_parents = walker.get_parents
         self._changes = None
         self._rename_detector = walker.rename_detector
 
+    @property
+    def commit(self):
+        """The Commit of this entry."""
+        if isinstance(self._commit, CommitGraphEntry):
+            self._commit = self._store[self._commit.id]
+        return self._commit
+
     def changes(self):
         """Get the tree changes for this entry.
 
@@ -63,16 +74,18 @@ class WalkEntry(object):
             objects; see dulwich.diff.tree_changes_for_merge.
         """
         if self._changes is None:
-            commit = self.commit
+            commit = self._commit
+            lookup_commit = self._store.lookup_commit
             if not self._get_parents(commit):
                 changes_func = tree_changes
                 parent = None
             elif len(self._get_parents(commit)) == 1:
                 changes_func = tree_changes
-                parent = self._store[self._get_parents(commit)[0]].tree
+                parent = lookup_commit(self._get_parents(commit)[0]).tree
             else:
                 changes_func = tree_changes_for_merge
-                parent = [self._store[p].tree for p in self._get_parents(commit)]
+                parent = [lookup_commit(p).tree
+                          for p in self._get_parents(commit)]
             self._changes = list(changes_func(
               self._store, parent, commit.tree,
               rename_detector=self._rename_detector))
@@ -80,11 +93,15 @@ class WalkEntry(object):
 
     def __repr__(self):
         return '<WalkEntry commit=%s, changes=%r>' % (
-          self.commit.id, self.changes())
+          self._commit.id, self.changes())
 
 
 class _CommitTimeQueue(object):
-    """Priority queue of WalkEntry objects by commit time."""
+    """Priority queue of WalkEntry objects by commit time.
+
+    Commits are looked up with lookup_commit, so the commit graph is used
+    where possible and only the commits that are returned get inflated.
+    """
 
     def __init__(self, walker):
         self._walker = walker
@@ -105,7 +122,7 @@ class _CommitTimeQueue(object):
 
     def _push(self, commit_id):
         try:
-            commit = self._store[commit_id]
+            commit = self._store.lookup_commit(commit_id)
         except KeyError:
             raise MissingCommitError(commit_id)
         if commit_id not in self._pq_set and commit_id not in self._done:
@@ -125,7 +142,7 @@ class _CommitTimeQueue(object):
                     # some caching (which DiskObjectStore currently does not).
                     # We could either add caching in this class or pass around
                     # parsed queue entry objects instead of commits.
-                    todo.append(self._store[parent])
+                    todo.append(self._store.lookup_commit(parent))
                 excluded.add(parent)
 
     def next(self):
@@ -214,7 +231,9 @@ class Walker(object):
             default rename_detector.
         :param since: Timestamp to list commits after.
         :param until: Timestamp to list commits before.
-        :param get_parents: Method to retrieve the parents of a commit
+        :param get_parents: Method to retrieve the parents of a commit, which
+            is passed a Commit or, for commits in the commit graph of the
+            store, a CommitGraphEntry
         :param queue_cls: A class to use for a queue of commits, supporting the
             iterator protocol. The constructor takes a single argument, the
             Walker.
@@ -275,7 +294,7 @@ class Walker(object):
         :return: True if the WalkEntry should be returned by this walk, or False
             otherwise (e.g. if it doesn't match any requested paths).
         """
-        commit = entry.commit
+        commit = entry._commit
         if self.since is not None and commit.commit_time < self.since:
             return False
         if self.until is not None and commit.commit_time > self.until:
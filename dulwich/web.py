@@ -91,11 +91,22 @@ def get_repo(backend, mat):
 def send_file(req, f, content_type):
     """Send a file-like object to the request output.
 
+    If the WSGI server provides wsgi.file_wrapper, the file is handed to it,
+    so that the server can use sendfile or similar to send it.
+
     :param req: The HTTPGitRequest object to send output to.
     :param f: An open file-like object to send; will be closed.
     :param content_type: The MIME type for the file.
-    :return: Iterator over the contents of the file, as chunks.
+    :return: Iterable over the contents of the file, as chunks.
     """
+    file_wrapper = req.environ.get('wsgi.file_wrapper')
+    if f is not None and file_wrapper is not None:
+        req.respond(HTTP_OK, content_type)
+        return file_wrapper(f, 10240)
+    return _send_file_chunks(req, f, content_type)
+
+
+def _send_file_chunks(req, f, content_type):
     if f is None:
         yield req.not_found('File not found')
         return
@@ -131,17 +142,14 @@ def get_loose_object(req, backend, mat):
     sha = mat.group(1) + mat.group(2)
     logger.info('Sending loose object %s', sha)
     object_store = get_repo(backend, mat).object_store
-    if not object_store.contains_loose(sha):
-        yield req.not_found('Object not found')
-        return
     try:
-        data = object_store[sha].as_legacy_object()
+        f = object_store.open_loose_object(sha)
     except IOError:
-        yield req.error('Error reading object')
-        return
+        return [req.error('Error reading object')]
+    if f is None:
+        return [req.not_found('Object not found')]
     req.cache_forever()
-    req.respond(HTTP_OK, 'application/x-git-loose-object')
-    yield data
+    return send_file(req, f, 'application/x-git-loose-object')
 
 
 def get_pack_file(req, backend, mat):
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# Compare the C and pure-Python versions of unpack_object by unpacking every
+# object in a set of packs over and over.
+#
+# Example usage:
+#  python examples/unpack_benchmark.py [pack ...]
+#
+# Without arguments, the packs in dulwich/tests/data/packs are used.
+
+import glob
+import os
+import sys
+import timeit
+
+from dulwich import pack
+from dulwich.pack import (
+    MappedReader,
+    PackData,
+    )
+
+if len(sys.argv) > 1:
+    paths = sys.argv[1:]
+else:
+    paths = glob.glob(os.path.join(os.path.dirname(__file__), '..',
+                                   'dulwich', 'tests', 'data', 'packs',
+                                   '*.pack'))
+
+packs = []
+for path in paths:
+    data = PackData(path)
+    offsets = [unpacked.offset for unpacked in data._iter_unpacked()]
+    packs.append((data, offsets))
+
+
+def unpack_all(unpack_object):
+    for data, offsets in packs:
+        contents = data._contents
+        for offset in offsets:
+            reader = MappedReader(contents, offset)
+            unpack_object(reader.read, read_some=reader.read_some,
+                          compute_crc32=True)
+
+
+def run(name, unpack_object):
+    timer = timeit.Timer(lambda: unpack_all(unpack_object))
+    best = min(timer.repeat(repeat=5, number=number))
+    print("%-8s %.3fs" % (name, best))
+    return best
+
+
+num_objects = sum(len(offsets) for data, offsets in packs)
+number = max(1, 10000 // num_objects)
+print("Unpacking %d objects from %d packs %d times" % (
+    num_objects, len(packs), number))
+if pack.unpack_object is pack._unpack_object_py:
+    print("C extension not found, only timing the Python version.")
+    run("python", pack._unpack_object_py)
+else:
+    py_time = run("python", pack._unpack_object_py)
+    c_time = run("c", pack.unpack_object)
+    print("speedup  %.1fx" % (py_time / c_time))
@@ -18,6 +18,38 @@ import os
 import sys
 if sys.platform == 'win32':
     include_dirs.append('dulwich')
+    zlib_library = 'zlib'
+else:
+    zlib_library = 'z'
+
+
+def has_zlib():
+    """Check whether a program using zlib can be compiled and linked."""
+    import shutil
+    import tempfile
+    from distutils.ccompiler import new_compiler
+    from distutils.errors import CCompilerError, DistutilsError
+    from distutils.sysconfig import customize_compiler
+    tmpdir = tempfile.mkdtemp()
+    try:
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        src = os.path.join(tmpdir, 'zlibtest.c')
+        f = open(src, 'w')
+        try:
+            f.write('#include <zlib.h>\n'
+                    'int main(void) { return zlibVersion() == 0; }\n')
+        finally:
+            f.close()
+        objects = compiler.compile([src], output_dir=tmpdir,
+                                   include_dirs=include_dirs)
+        compiler.link_executable(objects, os.path.join(tmpdir, 'zlibtest'),
+                                 libraries=[zlib_library])
+    except (CCompilerError, DistutilsError):
+        return False
+    finally:
+        shutil.rmtree(tmpdir)
+    return True
 
 
 class DulwichDistribution(Distribution):
@@ -50,6 +82,13 @@ if sys.platform == 'darwin' and os.path.exists('/usr/bin/xcodebuild'):
 
 setup_kwargs = {}
 
+# Reading packs in C needs zlib; without it, _pack is built without the
+# functions that inflate objects, and the Python versions are used.
+pack_kwargs = {}
+if has_zlib():
+    pack_kwargs['define_macros'] = [('HAVE_ZLIB', None)]
+    pack_kwargs['libraries'] = [zlib_library]
+
 if has_setuptools:
     setup_kwargs['test_suite'] = 'dulwich.tests.test_suite'
 
@@ -77,7 +116,7 @@ setup(name='dulwich',
           Extension('dulwich._objects', ['dulwich/_objects.c'],
                     include_dirs=include_dirs),
           Extension('dulwich._pack', ['dulwich/_pack.c'],
-              include_dirs=include_dirs),
+              include_dirs=include_dirs, **pack_kwargs),
           Extension('dulwich._diff_tree', ['dulwich/_diff_tree.c'],
               include_dirs=include_dirs),
       ],